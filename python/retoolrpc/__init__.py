@@ -1,4 +1,31 @@
 from .rpc import RetoolRPC
-from .utils.types import RetoolContext, RetoolRPCConfig
+from .utils.attachments import Attachment
+from .utils.cache import AsyncCache
+from .utils.middleware import FunctionCall
+from .utils.rate_limit import RateLimiter
+from .utils.runtime import run
+from .utils.types import (
+    CacheConfig,
+    CircuitBreakerConfig,
+    ProfilingConfig,
+    RetoolContext,
+    RetoolRPCConfig,
+    RetryPolicy,
+    StatusServerConfig,
+)
 
-__all__ = ["RetoolRPC", "RetoolRPCConfig", "RetoolContext"]
+__all__ = [
+    "RetoolRPC",
+    "RetoolRPCConfig",
+    "RetoolContext",
+    "ProfilingConfig",
+    "Attachment",
+    "FunctionCall",
+    "RateLimiter",
+    "RetryPolicy",
+    "CircuitBreakerConfig",
+    "StatusServerConfig",
+    "AsyncCache",
+    "CacheConfig",
+    "run",
+]
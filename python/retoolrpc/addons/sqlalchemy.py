@@ -0,0 +1,340 @@
+from typing import Any, Dict, List, Optional, cast
+
+from retoolrpc.rpc import RetoolRPC
+from retoolrpc.utils.types import Argument, ArgumentType, Permissions, RetoolContext
+
+try:
+    from sqlalchemy import Column, CursorResult, delete, inspect, select, update
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+except ImportError as err:  # pragma: no cover
+    raise ImportError(
+        "The SQLAlchemy addon requires SQLAlchemy 2 with asyncio support: "
+        'pip install "sqlalchemy[asyncio]>=2"'
+    ) from err
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class SQLAlchemyMixin:
+    """
+    Adds `register_model` to RetoolRPC, e.g.
+    `class RetoolRPCSQLAlchemy(SQLAlchemyMixin, RetoolRPC): ...`
+    """
+
+    def register_model(
+        self,
+        model: Any,
+        session_factory: async_sessionmaker[AsyncSession],
+        read_attributes: Optional[List[str]] = None,
+        write_attributes: Optional[List[str]] = None,
+        find_by_attributes: Optional[List[str]] = None,
+        permissions: Optional[Permissions] = None,
+    ) -> None:
+        if not isinstance(self, RetoolRPC):
+            raise TypeError("SQLAlchemyMixin must be used with RetoolRPC.")
+        register_model(
+            self,
+            model,
+            session_factory,
+            read_attributes=read_attributes,
+            write_attributes=write_attributes,
+            find_by_attributes=find_by_attributes,
+            permissions=permissions,
+        )
+
+
+def _argument_type(column: Column) -> ArgumentType:
+    """
+    Map the Python type of a column to a Retool RPC argument type.
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return "string"
+
+    if issubclass(python_type, bool):
+        return "boolean"
+    if issubclass(python_type, (int, float)) or python_type.__name__ == "Decimal":
+        return "number"
+    if issubclass(python_type, (dict, list)):
+        return "json"
+    return "string"
+
+
+def _argument(
+    argument_type: ArgumentType,
+    description: str,
+    required: bool = False,
+    array: bool = False,
+) -> Argument:
+    return {
+        "type": argument_type,
+        "description": description,
+        "required": required,
+        "array": array,
+    }
+
+
+def _page_size(limit: Optional[float]) -> int:
+    if not limit:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def register_model(
+    rpc: RetoolRPC,
+    model: Any,
+    session_factory: async_sessionmaker[AsyncSession],
+    read_attributes: Optional[List[str]] = None,
+    write_attributes: Optional[List[str]] = None,
+    find_by_attributes: Optional[List[str]] = None,
+    permissions: Optional[Permissions] = None,
+) -> None:
+    """
+    Register a set of CRUD functions for a SQLAlchemy model, named
+    `<Model> > create`, `<Model> > findAll`, etc.
+
+    Reads select only the read attributes as plain rows instead of loading ORM
+    objects, and multi-row reads run as a single statement. `findAll`, `findBy` and
+    `findByPks` page through their records with a keyset cursor on the primary key,
+    so a call never loads more than one page into memory.
+    """
+    mapper = inspect(model)
+    if len(mapper.primary_key) != 1:
+        raise ValueError(
+            f"Model {model.__name__} must have a single column primary key."
+        )
+
+    model_name = model.__name__[0].upper() + model.__name__[1:]
+    columns = {column.key: column for column in mapper.columns}
+    primary_key = mapper.primary_key[0]
+    primary_key_attribute = mapper.get_property_by_column(primary_key).key
+    primary_key_type = _argument_type(primary_key)
+
+    read_attributes = read_attributes or list(columns.keys())
+    write_attributes = write_attributes or list(columns.keys())
+    find_by_attributes = find_by_attributes or read_attributes
+
+    read_columns = [getattr(model, attr) for attr in read_attributes]
+    primary_key_column = getattr(model, primary_key_attribute)
+    write_attribute_args = {
+        attr: _argument(_argument_type(columns[attr]), f"{model_name} {attr}")
+        for attr in write_attributes
+    }
+    find_by_attribute_args = {
+        attr: _argument(_argument_type(columns[attr]), f"{model_name} {attr}")
+        for attr in find_by_attributes
+    }
+
+    def primary_key_argument(description: str) -> Dict[str, Argument]:
+        return {"primaryKey": _argument(primary_key_type, description, required=True)}
+
+    if {"cursor", "limit"} & set(find_by_attributes):
+        raise ValueError(
+            "cursor and limit are the paging arguments of findBy, they cannot be "
+            "find by attributes."
+        )
+    page_args = {
+        "cursor": _argument(
+            primary_key_type, "nextCursor returned by the previous page"
+        ),
+        "limit": _argument("number", f"Page size, at most {MAX_PAGE_SIZE}"),
+    }
+
+    async def read_page(statement: Any, args: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Read the page of the records selected by `statement` that follows
+        `args["cursor"]`, with at most `args["limit"]` records.
+        """
+        page_size = _page_size(args.get("limit"))
+        statement = statement.add_columns(primary_key_column.label("__cursor__"))
+        if args.get("cursor") is not None:
+            statement = statement.where(primary_key_column > args["cursor"])
+        # Fetch one extra row to know whether there is a next page.
+        statement = statement.order_by(primary_key_column).limit(page_size + 1)
+
+        async with session_factory() as session:
+            result = await session.execute(statement)
+            rows = result.mappings().all()
+
+        next_cursor = (
+            rows[page_size - 1]["__cursor__"] if len(rows) > page_size else None
+        )
+        return {
+            "records": [
+                {attr: row[attr] for attr in read_attributes or []}
+                for row in rows[:page_size]
+            ],
+            "nextCursor": next_cursor,
+        }
+
+    def pick_write_attributes(args: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            attr: args[attr]
+            for attr in write_attributes or []
+            if args.get(attr) is not None
+        }
+
+    async def find_by_primary_key(session: AsyncSession, value: Any) -> Any:
+        result = await session.execute(
+            select(*read_columns).where(primary_key_column == value)
+        )
+        row = result.mappings().first()
+        return dict(row) if row is not None else None
+
+    async def create(args: Dict[str, Any], context: Optional[RetoolContext]) -> Any:
+        async with session_factory() as session, session.begin():
+            record = model(**pick_write_attributes(args))
+            session.add(record)
+            await session.flush()
+            return {attr: getattr(record, attr) for attr in read_attributes or []}
+
+    async def update_record(
+        args: Dict[str, Any], context: Optional[RetoolContext]
+    ) -> Any:
+        async with session_factory() as session, session.begin():
+            result = await session.execute(
+                update(model)
+                .where(primary_key_column == args["primaryKey"])
+                .values(**pick_write_attributes(args))
+            )
+            return {"updated": cast(CursorResult, result).rowcount}
+
+    async def create_or_update(
+        args: Dict[str, Any], context: Optional[RetoolContext]
+    ) -> Any:
+        # Note: this is susceptible to race condition if there is no unique index
+        # on the find attributes. It's the user's responsibility to avoid
+        # duplicate inserts
+        find_attributes = args["findAttributes"]
+        async with session_factory() as session, session.begin():
+            result = await session.execute(
+                select(model).filter_by(**find_attributes).limit(1)
+            )
+            record = result.scalars().first()
+            if record is None:
+                record = model(**{**find_attributes, **pick_write_attributes(args)})
+                session.add(record)
+            else:
+                for attr, value in pick_write_attributes(args).items():
+                    setattr(record, attr, value)
+            await session.flush()
+            return {attr: getattr(record, attr) for attr in read_attributes or []}
+
+    async def delete_record(
+        args: Dict[str, Any], context: Optional[RetoolContext]
+    ) -> Any:
+        async with session_factory() as session, session.begin():
+            result = await session.execute(
+                delete(model).where(primary_key_column == args["primaryKey"])
+            )
+            return {"deleted": cast(CursorResult, result).rowcount}
+
+    async def find_all(args: Dict[str, Any], context: Optional[RetoolContext]) -> Any:
+        return await read_page(select(*read_columns), args)
+
+    async def find_by_pk(args: Dict[str, Any], context: Optional[RetoolContext]) -> Any:
+        async with session_factory() as session:
+            return await find_by_primary_key(session, args["primaryKey"])
+
+    async def find_by_pks(
+        args: Dict[str, Any], context: Optional[RetoolContext]
+    ) -> Any:
+        # One IN (...) statement instead of a query per primary key.
+        return await read_page(
+            select(*read_columns).where(primary_key_column.in_(args["primaryKeys"])),
+            args,
+        )
+
+    async def find_by(args: Dict[str, Any], context: Optional[RetoolContext]) -> Any:
+        attributes_values = {
+            attr: args[attr]
+            for attr in find_by_attributes or []
+            if args.get(attr) is not None
+        }
+        return await read_page(
+            select(*read_columns).filter_by(**attributes_values), args
+        )
+
+    # register a set of functions for a model
+    rpc.register(
+        {
+            "name": f"{model_name} > create",
+            "arguments": write_attribute_args,
+            "implementation": create,
+            "permissions": permissions,
+        }
+    )
+    rpc.register(
+        {
+            "name": f"{model_name} > update",
+            "arguments": {
+                **primary_key_argument("Primary key of the record to update"),
+                **write_attribute_args,
+            },
+            "implementation": update_record,
+            "permissions": permissions,
+        }
+    )
+    rpc.register(
+        {
+            "name": f"{model_name} > createOrUpdate",
+            "arguments": {
+                "findAttributes": _argument(
+                    "dict", "Attributes used to find the record", required=True
+                ),
+                **write_attribute_args,
+            },
+            "implementation": create_or_update,
+            "permissions": permissions,
+        }
+    )
+    rpc.register(
+        {
+            "name": f"{model_name} > delete",
+            "arguments": primary_key_argument("Primary key of the record to delete"),
+            "implementation": delete_record,
+            "permissions": permissions,
+        }
+    )
+    rpc.register(
+        {
+            "name": f"{model_name} > findAll",
+            "arguments": page_args,
+            "implementation": find_all,
+            "permissions": permissions,
+        }
+    )
+    rpc.register(
+        {
+            "name": f"{model_name} > findByPk",
+            "arguments": primary_key_argument("Primary key of the record"),
+            "implementation": find_by_pk,
+            "permissions": permissions,
+        }
+    )
+    rpc.register(
+        {
+            "name": f"{model_name} > findByPks",
+            "arguments": {
+                "primaryKeys": _argument(
+                    primary_key_type,
+                    "Primary keys of the records",
+                    required=True,
+                    array=True,
+                ),
+                **page_args,
+            },
+            "implementation": find_by_pks,
+            "permissions": permissions,
+        }
+    )
+    rpc.register(
+        {
+            "name": f"{model_name} > findBy",
+            "arguments": {**find_by_attribute_args, **page_args},
+            "implementation": find_by,
+            "permissions": permissions,
+        }
+    )
@@ -0,0 +1,176 @@
+"""
+Replay queries captured with the `capture_file` option against a local agent,
+without a Retool server, and report throughput and latency per function.
+
+Usage: python -m retoolrpc.replay capture.jsonl --agent handlers:rpc_agent
+           [--speed 1|10|max] [--concurrency 1] [--limit N]
+
+`--agent` is the import path of the RetoolRPC instance whose functions are
+called, or of a function that returns one. Queries are sent at their captured
+pace divided by `--speed`, or back to back with `max`.
+"""
+
+import argparse
+import asyncio
+import math
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from retoolrpc.rpc import RetoolRPC
+from retoolrpc.utils.capture import CapturedQuery, read_capture
+from retoolrpc.utils.imports import import_string
+
+
+class FunctionStats:
+    """
+    The replayed calls of a function.
+    """
+
+    def __init__(self) -> None:
+        self.latencies_ms: List[float] = []
+        self.captured_ms: List[float] = []
+        self.errors = 0
+
+    @property
+    def calls(self) -> int:
+        return len(self.latencies_ms)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of the values, 0 if there are none.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class ReplayReport:
+    def __init__(self, functions: Dict[str, FunctionStats], elapsed_s: float) -> None:
+        self.functions = functions
+        self.elapsed_s = elapsed_s
+
+    @property
+    def calls(self) -> int:
+        return sum(stats.calls for stats in self.functions.values())
+
+    def format(self) -> str:
+        lines = [
+            f"{'function':<32} {'calls':>7} {'errors':>7} {'calls/s':>9} "
+            f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} "
+            f"{'captured p50':>13}"
+        ]
+        for function_name, stats in sorted(self.functions.items()):
+            lines.append(
+                f"{function_name:<32} {stats.calls:>7} {stats.errors:>7} "
+                f"{stats.calls / self.elapsed_s:>9.1f} "
+                f"{percentile(stats.latencies_ms, 0.5):>9.2f} "
+                f"{percentile(stats.latencies_ms, 0.95):>9.2f} "
+                f"{percentile(stats.latencies_ms, 0.99):>9.2f} "
+                f"{max(stats.latencies_ms):>9.2f} "
+                f"{percentile(stats.captured_ms, 0.5):>13.2f}"
+            )
+        lines.append(
+            f"{self.calls} calls in {self.elapsed_s:.2f}s "
+            f"({self.calls / self.elapsed_s:.1f} calls/s)"
+        )
+        return "\n".join(lines)
+
+
+async def replay(
+    rpc: RetoolRPC,
+    queries: Iterable[CapturedQuery],
+    speed: Optional[float] = 1.0,
+    concurrency: int = 1,
+) -> ReplayReport:
+    """
+    Call `execute_function` for every captured query. Queries start at their
+    captured offset from the first query divided by `speed`, or as soon as
+    possible if `speed` is None, with at most `concurrency` running at a time.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    functions: Dict[str, FunctionStats] = {}
+    running: Set[asyncio.Task] = set()
+
+    async def execute(query: CapturedQuery, stats: FunctionStats) -> None:
+        # Redacted context values keep the shape of a RetoolContext.
+        context: Any = query["context"]
+        started_at = time.perf_counter()
+        try:
+            await rpc.execute_function(query["method"], query["parameters"], context)
+        except Exception:
+            stats.errors += 1
+        finally:
+            stats.latencies_ms.append((time.perf_counter() - started_at) * 1000)
+            semaphore.release()
+
+    first_received_at: Optional[float] = None
+    replay_started_at = loop.time()
+    for query in queries:
+        if speed is not None:
+            if first_received_at is None:
+                first_received_at = query["receivedAt"]
+            delay = (
+                replay_started_at
+                + (query["receivedAt"] - first_received_at) / speed
+                - loop.time()
+            )
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        await semaphore.acquire()
+        stats = functions.setdefault(query["method"], FunctionStats())
+        if query["durationMs"] is not None:
+            stats.captured_ms.append(query["durationMs"])
+        task = asyncio.create_task(execute(query, stats))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    await asyncio.gather(*running)
+    return ReplayReport(functions, max(loop.time() - replay_started_at, 1e-9))
+
+
+def _parse_speed(value: str) -> Optional[float]:
+    if value == "max":
+        return None
+    speed = float(value.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or max")
+    return speed
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m retoolrpc.replay",
+        description="Replay captured queries against a local agent.",
+    )
+    parser.add_argument("capture_file")
+    parser.add_argument(
+        "--agent",
+        required=True,
+        help="import path of the RetoolRPC instance, e.g. handlers:rpc_agent",
+    )
+    parser.add_argument(
+        "--speed",
+        type=_parse_speed,
+        default=1.0,
+        help="replay speed factor, e.g. 1, 10, or max (default: 1)",
+    )
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    agent: Any = import_string(args.agent)
+    rpc = agent if isinstance(agent, RetoolRPC) else agent()
+    queries: Iterable[CapturedQuery] = read_capture(args.capture_file)
+    if args.limit is not None:
+        queries = (query for _, query in zip(range(args.limit), queries))
+
+    report = asyncio.run(replay(rpc, queries, args.speed, args.concurrency))
+    print(report.format())
+
+
+if __name__ == "__main__":
+    main()
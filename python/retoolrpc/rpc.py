@@ -1,29 +1,104 @@
 import asyncio
+import contextvars
 import datetime
+import functools
+import importlib
+import sys
+import threading
+import time
 import uuid
-from typing import Any, Dict, Literal, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import (
+    Any,
+    Coroutine,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-from retoolrpc.utils.api import RetoolAPI
-from retoolrpc.utils.errors import FunctionNotFoundError, create_agent_server_error
-from retoolrpc.utils.helpers import is_client_error
+import httpx
+from retoolrpc.utils.api import PopQueryRequest, RetoolAPI
+from retoolrpc.utils.arguments import LazyArguments, decode_query, materialize
+from retoolrpc.utils.attachments import Attachment, to_attachment
+from retoolrpc.utils.cache import AsyncCache
+from retoolrpc.utils.capture import QueryRecorder
+from retoolrpc.utils.circuit_breaker import CircuitBreaker
+from retoolrpc.utils.errors import (
+    DEFAULT_ERROR_STACK_FRAMES,
+    AgentShuttingDownError,
+    FunctionNotFoundError,
+    ResultTooLargeError,
+    create_agent_server_error,
+)
+from retoolrpc.utils.handover import release_pid_file, take_over_pid_file
+from retoolrpc.utils.helpers import (
+    is_client_error,
+    is_registration_error,
+    is_retryable_error,
+)
+from retoolrpc.utils.imports import LazyImplementation
 from retoolrpc.utils.logger import Logger
-from retoolrpc.utils.polling import loop_with_backoff
+from retoolrpc.utils.metrics import Metrics
+from retoolrpc.utils.middleware import (
+    ERROR_METADATA_ATTRIBUTE,
+    CallNext,
+    FunctionCall,
+    Middleware,
+    compose,
+)
+from retoolrpc.utils.polling import LoopState, loop_with_backoff
+from retoolrpc.utils.profiling import Profiler
+from retoolrpc.utils.registration_cache import RegistrationCache, hash_operations
+from retoolrpc.utils.reloader import DEFAULT_RELOAD_INTERVAL_MS, ModuleWatcher
+from retoolrpc.utils.resources import ResourceCloser, ResourceFactory, Resources
+from retoolrpc.utils.responses import (
+    ExecutionResult,
+    QueryResponse,
+    QueryTimings,
+    ResponseEnvelope,
+)
+from retoolrpc.utils.retry import RetryMiddleware
 from retoolrpc.utils.schema import parse_function_arguments
+from retoolrpc.utils.serialization import (
+    encode_result,
+    estimate_size,
+    truncate_result,
+)
+from retoolrpc.utils.status import StatusServer
+from retoolrpc.utils.transport import (
+    DEFAULT_LONG_POLL_TIMEOUT_MS,
+    LongPollingTransport,
+    PollingTransport,
+    QueryTransport,
+)
 from retoolrpc.utils.types import (
     AgentServerError,
     AgentServerStatus,
+    CacheConfig,
+    ErrorStackMode,
+    FunctionOptions,
     FunctionSpecWithoutName,
+    Implementation,
     RegisterFunctionSpec,
     RetoolContext,
     RetoolRPCConfig,
 )
-from retoolrpc.version import __version__
 
 MINIMUM_POLLING_INTERVAL_MS = 100
 DEFAULT_POLLING_INTERVAL_MS = 1000
 DEFAULT_POLLING_TIMEOUT_MS = 5000
 DEFAULT_ENVIRONMENT_NAME = "production"
 DEFAULT_VERSION = "0.0.1"
+DEFAULT_DRAIN_TIMEOUT_MS = 30000
+DEFAULT_TIMEOUT_MAX_WORKERS = 8
+# How many times in a row the agent registers again after popQuery rejected it.
+MAX_REREGISTRATION_ATTEMPTS = 3
 
 
 class RetoolRPC:
@@ -43,14 +118,74 @@ class RetoolRPC:
             config.polling_timeout_ms or DEFAULT_POLLING_TIMEOUT_MS
         )
         self._version = config.version or DEFAULT_VERSION
+        self._result_format = config.result_format or "rows"
+        self._max_result_bytes = config.max_result_bytes
+        self._truncate_oversized_results = bool(config.truncate_oversized_results)
+        self._lazy_arguments = bool(config.lazy_arguments)
+        self._error_stack_mode: ErrorStackMode = config.error_stack_mode or "full"
+        self._error_stack_frames = (
+            config.error_stack_frames or DEFAULT_ERROR_STACK_FRAMES
+        )
+        self._prewarm_imports = config.prewarm_imports is not False
+        self._shutdown_signals = config.shutdown_signals or ()
+        self._drain_timeout_ms = (
+            config.drain_timeout_ms
+            if config.drain_timeout_ms is not None
+            else DEFAULT_DRAIN_TIMEOUT_MS
+        )
+        self._pid_file = config.pid_file
+        self._status_server_config = config.status_server
+        self._capture_file = config.capture_file
+        self._timeout_max_workers = (
+            config.timeout_max_workers or DEFAULT_TIMEOUT_MAX_WORKERS
+        )
         self._agent_uuid = config.agent_uuid or str(uuid.uuid4())
 
+        self._response_envelope = ResponseEnvelope(
+            self._resource_id, self._environment_name, self._agent_uuid
+        )
         self._retool_api = RetoolAPI(
             host_url=self._host_url,
             api_key=self._api_key,
             polling_timeout_ms=self._polling_timeout_ms,
         )
         self._logger = Logger(log_level=config.log_level)
+        self._transport = self._create_transport(config)
+        self._next_poll_delay_ms = self._polling_interval_ms
+        self._profiler = (
+            Profiler(config.profiling, self._logger) if config.profiling else None
+        )
+        # A versionHash is registered for an agent UUID: an agent with a random UUID
+        # cannot reuse the versionHash of its previous run.
+        self._registration_cache = (
+            RegistrationCache(
+                config.registration_cache_dir,
+                host_url=self._host_url,
+                resource_id=self._resource_id,
+                environment_name=self._environment_name,
+                version=self._version,
+                agent_uuid=self._agent_uuid,
+            )
+            if config.registration_cache_dir and config.agent_uuid
+            else None
+        )
+        if config.registration_cache_dir and not config.agent_uuid:
+            self._logger.warn(
+                "registration_cache_dir is ignored without an agent_uuid, set one "
+                "to reuse the registration of the agent across restarts"
+            )
+        self._reregistration_attempts = 0
+        self._registered_operations_hash: Optional[str] = None
+        self._registration_outdated = False
+        self._module_watcher = (
+            ModuleWatcher(
+                self._logger,
+                on_change=self.reload_modules,
+                interval_ms=config.hot_reload_interval_ms or DEFAULT_RELOAD_INTERVAL_MS,
+            )
+            if config.hot_reload
+            else None
+        )
 
         self._logger.debug(
             "Retool RPC Configuration",
@@ -65,49 +200,598 @@ class RetoolRPC:
             },
         )
         self._functions = {}
+        self._functions_lock = threading.Lock()
+        self._middlewares: List[Middleware] = []
+        # Middleware chains of the functions that have middlewares, composed when
+        # the function or the middlewares are registered.
+        self._pipelines: Dict[str, CallNext] = {}
+        self._circuit_breakers: Dict[str, CircuitBreaker] = {}
+        self.metrics = Metrics()
+        # Shared by all functions, e.g. `await rpc.cache.get_or_load(key, loader)`.
+        self.cache = AsyncCache(
+            config.cache or CacheConfig(), self.metrics, self._logger
+        )
+        self.resources = Resources(self._logger)
+        self._prewarm_task: Optional[asyncio.Task] = None
+        self._reload_task: Optional[asyncio.Task] = None
+        # The registration or query loop of the listening agent.
+        self._loop_task: Optional[asyncio.Task] = None
+        self._drain_deadline: Optional[asyncio.TimerHandle] = None
+        # Runs sync implementations of functions with a timeout, created on first use.
+        self._timeout_executor: Optional[ThreadPoolExecutor] = None
+        self._stopping = False
+        self._in_flight_queries = 0
+        # Whether the agent is waiting for popQuery.
+        self._polling = False
+        # State of the running loop and of the last poll, reported by `status`.
+        self._loop_state = LoopState()
+        self._last_poll_at: Optional[float] = None
+        self._status_server: Optional[StatusServer] = None
+        self._recorder: Optional[QueryRecorder] = None
+        self._pop_query_options: Optional[PopQueryRequest] = None
+
+    def _create_transport(self, config: RetoolRPCConfig) -> QueryTransport:
+        if isinstance(config.transport, QueryTransport):
+            return config.transport
+        if config.transport == "long_polling":
+            return LongPollingTransport(
+                polling_interval_ms=self._polling_interval_ms,
+                polling_timeout_ms=self._polling_timeout_ms,
+                long_poll_timeout_ms=(
+                    config.long_poll_timeout_ms or DEFAULT_LONG_POLL_TIMEOUT_MS
+                ),
+            )
+        if config.transport in (None, "polling"):
+            return PollingTransport(self._polling_interval_ms)
+        raise ValueError(f"Unknown transport '{config.transport}'.")
 
     async def listen(self):
+        for function_name, spec in self._functions.items():
+            self._check_resources(function_name, spec)
         self._logger.info("Starting RPC agent")
-        register_result = await loop_with_backoff(
-            self._polling_interval_ms, self._logger, self.register_agent
+        self._stopping = False
+        if self._profiler:
+            self._profiler.install_signal_handler()
+        installed_signals = self._install_shutdown_handlers()
+        if self._prewarm_imports:
+            # Import lazy implementations while the agent registers.
+            self._prewarm_task = asyncio.create_task(self.prewarm())
+        if self._module_watcher:
+            self._module_watcher.watch(self._implementation_modules())
+            self._reload_task = asyncio.create_task(self._module_watcher.run())
+        try:
+            if self._status_server_config is not None:
+                self._status_server = StatusServer(
+                    self._status_server_config, self.status, self._logger
+                )
+                await self._status_server.start()
+            await self.resources.start()
+            if self._use_cached_registration():
+                register_result = "done"
+            else:
+                self._loop_state = LoopState()
+                register_result = await self._run_loop(
+                    loop_with_backoff(
+                        self._polling_interval_ms,
+                        self._logger,
+                        self.register_agent,
+                        self._loop_state,
+                    )
+                )
+            if register_result == "done":
+                self._logger.info("Agent registered")
+                if self._pid_file:
+                    previous_pid = take_over_pid_file(self._pid_file)
+                    if previous_pid is not None:
+                        self._logger.info(f"Taking over from agent {previous_pid}")
+                self._logger.info("Starting processing query")
+                self._loop_state = LoopState()
+                await self._run_loop(
+                    loop_with_backoff(
+                        lambda: self._next_poll_delay_ms,
+                        self._logger,
+                        self.fetch_query_and_execute,
+                        self._loop_state,
+                    )
+                )
+        finally:
+            await self._shutdown(installed_signals)
+
+    def stop(self) -> None:
+        """
+        Drain the listening agent: stop polling, let the running query finish and
+        post its response, then return from `listen`. A query still running after
+        the drain timeout is cancelled and fails with an AgentShuttingDownError.
+        Calling it again stops right away.
+        """
+        if self._stopping:
+            self._cancel_loop()
+            return
+        self._stopping = True
+        # A query popped by a short poll that is still running would be lost if the
+        # poll was cancelled, so the poll finishes and its query is drained.
+        if self._in_flight_queries == 0 and not (
+            self._polling and not self._transport.cancel_poll_on_stop
+        ):
+            self._logger.info("Stopping RPC agent")
+            self._cancel_loop()
+            return
+
+        self._logger.info(
+            f"Stopping RPC agent, waiting up to {self._drain_timeout_ms}ms for "
+            + (
+                f"{self._in_flight_queries} running queries"
+                if self._in_flight_queries
+                else "the running poll"
+            )
         )
-        if register_result == "done":
-            self._logger.info("Agent registered")
-            self._logger.info("Starting processing query")
-            await loop_with_backoff(
-                self._polling_interval_ms, self._logger, self.fetch_query_and_execute
+        self._drain_deadline = asyncio.get_running_loop().call_later(
+            self._drain_timeout_ms / 1000, self._cancel_loop
+        )
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Report the state of the agent, as served by the status server. The agent is
+        ready when it is registered, its last poll succeeded and it is not draining.
+        """
+        if self._stopping:
+            state = "draining"
+        elif self._version_hash is None:
+            state = "registering"
+        else:
+            state = "registered"
+        loop_state = self._loop_state
+        return {
+            "state": state,
+            "ready": state == "registered" and loop_state.consecutive_errors == 0,
+            "agentUuid": self._agent_uuid,
+            "versionHash": self._version_hash,
+            "lastPollAt": (
+                datetime.datetime.fromtimestamp(
+                    self._last_poll_at, datetime.timezone.utc
+                ).isoformat()
+                if self._last_poll_at is not None
+                else None
+            ),
+            "consecutiveErrors": loop_state.consecutive_errors,
+            "lastError": loop_state.last_error,
+            "backoffDelayMs": loop_state.backoff_delay_ms,
+            "inFlightQueries": self._in_flight_queries,
+            "functions": self.metrics.snapshot(),
+        }
+
+    def _cancel_loop(self) -> None:
+        if self._in_flight_queries:
+            self._logger.warn(
+                f"Cancelling {self._in_flight_queries} queries that did not finish"
             )
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+
+    async def _run_loop(self, loop: Coroutine[Any, Any, AgentServerStatus]) -> Any:
+        """
+        Run a registration or query loop in a task that `stop` can cancel. Returns
+        None if the loop was stopped.
+        """
+        if self._stopping:
+            loop.close()
+            return None
+        self._loop_task = asyncio.create_task(loop)
+        try:
+            return await self._loop_task
+        except asyncio.CancelledError:
+            if not self._stopping:
+                raise
+            return None
+        finally:
+            self._loop_task = None
+
+    def _install_shutdown_handlers(self) -> List[int]:
+        installed_signals = []
+        for signal_number in self._shutdown_signals:
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                continue
+            installed_signals.append(signal_number)
+        return installed_signals
+
+    async def _shutdown(self, installed_signals: Iterable[int]) -> None:
+        if self._drain_deadline is not None:
+            self._drain_deadline.cancel()
+            self._drain_deadline = None
+        event_loop = asyncio.get_running_loop()
+        for signal_number in installed_signals:
+            event_loop.remove_signal_handler(signal_number)
+        if self._profiler is not None:
+            self._profiler.remove_signal_handler()
+
+        background_tasks = [
+            task for task in (self._prewarm_task, self._reload_task) if task is not None
+        ]
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        self._prewarm_task = self._reload_task = None
+        await self.cache.close()
+        await self.resources.close()
+        if self._timeout_executor is not None:
+            # Threads of timed out calls cannot be stopped, so do not wait for them.
+            self._timeout_executor.shutdown(wait=False, cancel_futures=True)
+            self._timeout_executor = None
+
+        if self._status_server is not None:
+            await self._status_server.close()
+            self._status_server = None
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+        if self._pid_file:
+            release_pid_file(self._pid_file)
+        await self._retool_api.aclose()
+        if self._stopping:
+            self._logger.info("RPC agent stopped")
 
     def register(self, spec: RegisterFunctionSpec):
-        self._functions[spec["name"]] = {
+        """
+        Register a function. Can be called while the agent is listening, in which
+        case the agent registers its new operations before the next poll.
+        """
+        if "retry" in spec and not spec.get("idempotent"):
+            self._logger.warn(
+                f"Function {spec['name']} has a retry policy but is not marked "
+                "idempotent, it will not be retried"
+            )
+        implementation = spec["implementation"]
+        function_spec: FunctionSpecWithoutName = {
             "arguments": spec["arguments"],
-            "implementation": spec["implementation"],
+            "implementation": (
+                LazyImplementation(implementation)
+                if isinstance(implementation, str)
+                else implementation
+            ),
             "permissions": spec["permissions"] or {},
         }
+        for option in FunctionOptions.__optional_keys__:
+            if option in spec:
+                function_spec[option] = spec[option]  # type: ignore[literal-required]
+        if self._loop_task is not None:
+            # Resources can be added after registration until the agent listens.
+            self._check_resources(spec["name"], function_spec)
+        self._update_functions({spec["name"]: function_spec})
+
+    def _check_resources(
+        self, function_name: str, spec: FunctionSpecWithoutName
+    ) -> None:
+        missing = [
+            name for name in spec.get("resources", []) if name not in self.resources
+        ]
+        if missing:
+            raise ValueError(
+                f'Function "{function_name}" uses resources that are not added: '
+                f"{', '.join(missing)}."
+            )
+
+    def add_resource(
+        self,
+        name: str,
+        factory: ResourceFactory,
+        close: Optional[ResourceCloser] = None,
+    ) -> None:
+        """
+        Add a resource shared by the calls of the functions that list `name` in
+        their `resources` option, e.g. a database pool. The resource is created by
+        `factory` when the agent starts listening, and closed with `close`, or its
+        own `aclose` or `close` method, when it stops.
+        """
+        self.resources.add(name, factory, close)
+
+    def use(self, middleware: Middleware) -> None:
+        """
+        Add a middleware that wraps every function. Middlewares added first are
+        the outermost.
+        """
+        with self._functions_lock:
+            self._middlewares = [*self._middlewares, middleware]
+            self._pipelines = {
+                function_name: pipeline
+                for function_name, spec in self._functions.items()
+                if (pipeline := self._compose_pipeline(function_name, spec)) is not None
+            }
+
+    def _compose_pipeline(
+        self, function_name: str, spec: FunctionSpecWithoutName
+    ) -> Optional[CallNext]:
+        middlewares = [*self._middlewares, *spec.get("middlewares", [])]
+
+        circuit_breaker_config = spec.get("circuit_breaker")
+        if circuit_breaker_config is None:
+            self._circuit_breakers.pop(function_name, None)
+        else:
+            # Keep the state of the breaker unless its configuration changed.
+            circuit_breaker = self._circuit_breakers.get(function_name)
+            if circuit_breaker is None or (
+                circuit_breaker.config != circuit_breaker_config
+            ):
+                circuit_breaker = CircuitBreaker(
+                    function_name, circuit_breaker_config, self.metrics
+                )
+                self._circuit_breakers[function_name] = circuit_breaker
+            middlewares.append(circuit_breaker)
+
+        retry = spec.get("retry") if spec.get("idempotent") else None
+        if retry is not None or spec.get("timeout_ms"):
+            # Innermost, so other middlewares run once per call.
+            middlewares.append(RetryMiddleware(retry, spec.get("timeout_ms")))
+        if not middlewares:
+            # Functions without middlewares are called directly.
+            return None
+
+        implementation = spec["implementation"]
+        resource_names = spec.get("resources")
+        # A timeout cannot interrupt a sync implementation running on the loop.
+        in_thread = bool(spec.get("timeout_ms"))
+
+        async def call_implementation(call: FunctionCall) -> Any:
+            return await self._call_implementation(
+                implementation, call.arguments, call.context, resource_names, in_thread
+            )
+
+        return compose(middlewares, call_implementation)
+
+    def unregister(self, function_name: str) -> bool:
+        """
+        Remove a registered function. Queries that are already running finish.
+        Returns False if no function with the given name was registered.
+        """
+        if function_name not in self._functions:
+            return False
+        self._update_functions({}, removed=[function_name])
+        return True
+
+    def _update_functions(
+        self,
+        updated: Dict[str, FunctionSpecWithoutName],
+        removed: Iterable[str] = (),
+    ) -> None:
+        # Swap in a new function table instead of mutating the current one, so a
+        # running query keeps using the spec it looked up.
+        with self._functions_lock:
+            functions = dict(self._functions)
+            functions.update(updated)
+            pipelines = dict(self._pipelines)
+            for function_name, spec in updated.items():
+                pipeline = self._compose_pipeline(function_name, spec)
+                if pipeline is not None:
+                    pipelines[function_name] = pipeline
+                else:
+                    pipelines.pop(function_name, None)
+            for function_name in removed:
+                functions.pop(function_name, None)
+                pipelines.pop(function_name, None)
+                self._circuit_breakers.pop(function_name, None)
+            self._functions = functions
+            self._pipelines = pipelines
+            self._registration_outdated = True
+
+        if self._module_watcher:
+            self._module_watcher.watch(self._implementation_modules())
+
+    def _implementation_modules(self) -> Set[str]:
+        modules = set()
+        for spec in self._functions.values():
+            impl = spec["implementation"]
+            module_name = (
+                impl.module_name
+                if isinstance(impl, LazyImplementation)
+                else getattr(impl, "__module__", None)
+            )
+            if module_name and module_name != "__main__":
+                modules.add(module_name)
+        return modules
+
+    def reload_modules(self, module_names: Iterable[str]) -> None:
+        """
+        Reload the given handler modules and swap in the reloaded implementations.
+        Functions registered from a nested scope cannot be found again after a
+        reload and keep their current implementation.
+        """
+        reloaded = set()
+        for module_name in module_names:
+            module = sys.modules.get(module_name)
+            if module is None:
+                continue
+            importlib.reload(module)
+            reloaded.add(module_name)
+            self._logger.info(f"Reloaded module: {module_name}")
+
+        updated: Dict[str, FunctionSpecWithoutName] = {}
+        for function_name, spec in self._functions.items():
+            impl = spec["implementation"]
+            if isinstance(impl, LazyImplementation):
+                if impl.module_name in reloaded:
+                    updated[function_name] = {
+                        **spec,
+                        "implementation": LazyImplementation(impl.import_path),
+                    }
+                continue
+
+            impl_module_name = getattr(impl, "__module__", None)
+            qualified_name = getattr(impl, "__qualname__", "")
+            if impl_module_name not in reloaded:
+                continue
+            if "<locals>" in qualified_name:
+                self._logger.warn(
+                    f"Cannot reload implementation of {function_name}, it is not "
+                    "defined at module level"
+                )
+                continue
+
+            reloaded_impl: Any = sys.modules[impl_module_name]
+            for attribute in qualified_name.split("."):
+                reloaded_impl = getattr(reloaded_impl, attribute)
+            updated[function_name] = {**spec, "implementation": reloaded_impl}
+
+        if updated:
+            self._update_functions(updated)
+
+    async def prewarm(self):
+        """
+        Import all lazy implementations in a background thread.
+        """
+        for function_name, spec in list(self._functions.items()):
+            impl = spec["implementation"]
+            if not isinstance(impl, LazyImplementation) or impl.resolved:
+                continue
+
+            try:
+                await asyncio.to_thread(impl.resolve)
+                self._logger.debug(f"Imported implementation: {impl.import_path}")
+            except Exception as err:
+                self._logger.error(
+                    f"Error importing implementation of {function_name}: {str(err)}"
+                )
 
     async def execute_function(
-        self, function_name: str, function_arguments: Any, context: RetoolContext
+        self,
+        function_name: str,
+        function_arguments: Any,
+        context: RetoolContext,
+        query_uuid: Optional[str] = None,
     ):
-        self._logger.info(f"Executing function: {function_name}, context: {context}")
+        execution_result = await self._execute(
+            function_name, function_arguments, context, query_uuid
+        )
+        return execution_result.as_dict()
+
+    async def _execute(
+        self,
+        function_name: str,
+        function_arguments: Any,
+        context: RetoolContext,
+        query_uuid: Optional[str] = None,
+        timings: Optional[QueryTimings] = None,
+    ) -> ExecutionResult:
+        if self._logger.should_log("info"):
+            # Formatting the context is skipped when it would not be logged.
+            self._logger.info(
+                f"Executing function: {function_name}, context: {context}"
+            )
         if function_name == "__testConnection__":
-            return {"result": self.test_connection(context), "arguments": {}}
+            return ExecutionResult(self.test_connection(context), {})
 
         function_spec = self._functions.get(function_name)
         if not function_spec:
             raise FunctionNotFoundError(function_name)
 
-        parsed_arguments = parse_function_arguments(
-            function_arguments, function_spec["arguments"]
-        )
-        self._logger.debug("Parsed arguments: ", parsed_arguments)
+        # Implementations are typed to take a dict, LazyArguments is a read-only
+        # mapping.
+        parsed_arguments: Any
+        parse_started_at = time.perf_counter_ns()
+        if self._lazy_arguments:
+            parsed_arguments = LazyArguments(
+                function_arguments, function_spec["arguments"]
+            )
+        else:
+            parsed_arguments = parse_function_arguments(
+                function_arguments, function_spec["arguments"]
+            )
+            self._logger.debug("Parsed arguments: ", parsed_arguments)
 
-        impl = function_spec["implementation"]
+        execute_started_at = time.perf_counter_ns()
+        if timings is not None:
+            timings.parse_ns = execute_started_at - parse_started_at
+
+        pipeline = self._pipelines.get(function_name)
+        call: Optional[FunctionCall] = None
+        profiler = self._profiler
+        with (
+            profiler.profile(function_name, query_uuid)
+            if profiler is not None and profiler.should_profile(function_name)
+            else nullcontext()
+        ):
+            self.metrics.increment(function_name, "calls")
+            try:
+                if pipeline is None:
+                    result = await self._call_implementation(
+                        function_spec["implementation"],
+                        parsed_arguments,
+                        context,
+                        function_spec.get("resources"),
+                    )
+                else:
+                    call = FunctionCall(
+                        function_name, parsed_arguments, context, query_uuid
+                    )
+                    result = await pipeline(call)
+            except Exception as err:
+                self.metrics.increment(function_name, "errors")
+                if call is not None and call.metadata:
+                    setattr(err, ERROR_METADATA_ATTRIBUTE, call.metadata)
+                raise
+            finally:
+                if timings is not None:
+                    timings.execute_ns = time.perf_counter_ns() - execute_started_at
+
+        if call is not None:
+            return ExecutionResult(result, call.arguments, call.metadata)
+        return ExecutionResult(result, parsed_arguments)
+
+    async def _call_implementation(
+        self,
+        impl: Union[Implementation, LazyImplementation],
+        arguments: Any,
+        context: RetoolContext,
+        resource_names: Optional[List[str]] = None,
+        in_thread: bool = False,
+    ) -> Any:
+        """
+        Call an implementation. With `in_thread`, a sync implementation runs in a
+        worker thread, so that the caller can stop waiting for it.
+        """
+        if isinstance(impl, LazyImplementation):
+            impl = (
+                impl.resolve()
+                if impl.resolved
+                else await asyncio.to_thread(impl.resolve)
+            )
+
+        resources = (
+            {name: await self.resources.get(name) for name in resource_names}
+            if resource_names
+            else {}
+        )
         if asyncio.iscoroutinefunction(impl):
-            result = await impl(parsed_arguments, context)
-        else:
-            result = impl(parsed_arguments, context)
+            return await impl(arguments, context, **resources)
+        if in_thread:
+            call = functools.partial(
+                impl, arguments, context, **resources  # type: ignore[arg-type]
+            )
+            return await asyncio.get_running_loop().run_in_executor(
+                self._get_timeout_executor(), contextvars.copy_context().run, call
+            )
+        return impl(arguments, context, **resources)
 
-        return {"result": result, "arguments": parsed_arguments}
+    def _get_timeout_executor(self) -> ThreadPoolExecutor:
+        """
+        The threads of sync implementations with a timeout. They are not taken from
+        the default executor, which also resolves host names and imports lazy
+        implementations, so that hung implementations cannot block the agent.
+        """
+        if self._timeout_executor is None:
+            self._timeout_executor = ThreadPoolExecutor(
+                max_workers=self._timeout_max_workers,
+                thread_name_prefix="retoolrpc-timeout",
+            )
+        return self._timeout_executor
+
+    def toggle_profiling(self) -> bool:
+        """
+        Turn profiling on or off at runtime and return the new state.
+        """
+        if self._profiler is None:
+            raise ValueError("Profiling is not configured for this agent.")
+        return self._profiler.toggle()
 
     def test_connection(self, context: RetoolContext):
         return {
@@ -117,13 +801,37 @@ class RetoolRPC:
             "context": context,
         }
 
-    async def register_agent(self) -> AgentServerStatus:
+    def _operations_metadata(self) -> Dict[str, Any]:
         functions_metadata = {}
         for function_name, spec in self._functions.items():
             functions_metadata[function_name] = {
                 "arguments": spec["arguments"],
                 "permissions": spec["permissions"],
             }
+        return functions_metadata
+
+    def _use_cached_registration(self) -> bool:
+        """
+        Reuse the versionHash of a previous registration with the same operations,
+        so the agent can start polling without calling registerAgent.
+        """
+        if self._registration_cache is None:
+            return False
+
+        operations_hash = hash_operations(self._operations_metadata())
+        version_hash = self._registration_cache.get(operations_hash)
+        if version_hash is None:
+            return False
+
+        self._version_hash = version_hash
+        self._registered_operations_hash = operations_hash
+        self._logger.info(f"Agent registered with cached versionHash: {version_hash}")
+        return True
+
+    async def register_agent(self) -> AgentServerStatus:
+        self._registration_outdated = False
+        functions_metadata = self._operations_metadata()
+        operations_hash = hash_operations(functions_metadata)
 
         register_agent_response = await self._retool_api.register_agent(
             options={
@@ -136,7 +844,9 @@ class RetoolRPC:
         )
 
         if not register_agent_response.is_success:
-            if is_client_error(register_agent_response.status_code):
+            status_code = register_agent_response.status_code
+            # Transient errors are raised, so the loop backs off and retries.
+            if is_client_error(status_code) and not is_retryable_error(status_code):
                 self._logger.error(
                     "Error registering agent: "
                     f"{register_agent_response.status_code} "
@@ -152,22 +862,134 @@ class RetoolRPC:
 
         agent_response_data = register_agent_response.json()
         self._version_hash = agent_response_data["versionHash"]
+        self._registered_operations_hash = operations_hash
         self._logger.info(f"Agent registered with versionHash: {self._version_hash}")
 
+        if self._registration_cache is not None:
+            try:
+                self._registration_cache.set(
+                    operations_hash, agent_response_data["versionHash"]
+                )
+            except OSError as err:
+                self._logger.warn(f"Error caching agent registration: {str(err)}")
+
         return "done"
 
-    async def fetch_query_and_execute(self) -> AgentServerStatus:
-        pending_query_fetch = await self._retool_api.pop_query(
-            options={
+    async def _reregister_agent(
+        self, rejected_response: httpx.Response
+    ) -> AgentServerStatus:
+        """
+        Register the agent again in place after the server rejected its versionHash,
+        e.g. because it is stale or the registration expired. The HTTP clients,
+        imported implementations and caches of the running agent are kept.
+        """
+        self._reregistration_attempts += 1
+        self._logger.warn(
+            f"Agent registration rejected ({rejected_response.status_code}): "
+            f"{rejected_response.text}. Registering agent again "
+            f"(attempt {self._reregistration_attempts}/{MAX_REREGISTRATION_ATTEMPTS})"
+        )
+        if self._registration_cache is not None:
+            self._registration_cache.invalidate()
+
+        register_result = await self.register_agent()
+        return "continue" if register_result == "done" else register_result
+
+    async def _register_updated_operations(self) -> AgentServerStatus:
+        """
+        Register the agent again if functions were registered or unregistered
+        while listening and the operations metadata changed. If the server rejects
+        the new operations, the agent keeps polling with its last accepted
+        registration until the functions change again.
+        """
+        if (
+            hash_operations(self._operations_metadata())
+            == self._registered_operations_hash
+        ):
+            self._registration_outdated = False
+            return "done"
+
+        self._logger.info("Functions changed, registering agent again")
+        try:
+            register_result = await self.register_agent()
+        except Exception:
+            self._registration_outdated = True
+            raise
+        if register_result == "stop":
+            self._logger.warn(
+                "Updated functions were rejected, keeping versionHash "
+                f"{self._version_hash}"
+            )
+            return "done"
+        return register_result
+
+    def _limit_result_size(self, function_name: str, result: Any) -> Tuple[Any, bool]:
+        """
+        Check the estimated size of a result against the limit of the function.
+        Returns the result, truncated if it is over the limit and truncation is
+        enabled, and whether it was truncated. Raises ResultTooLargeError otherwise.
+        """
+        function_spec: FunctionOptions = self._functions.get(function_name) or {}
+        max_result_bytes = function_spec.get("max_result_bytes", self._max_result_bytes)
+        if max_result_bytes is None:
+            return result, False
+        if estimate_size(result, max_result_bytes) <= max_result_bytes:
+            return result, False
+
+        if function_spec.get(
+            "truncate_oversized_results", self._truncate_oversized_results
+        ):
+            truncated_result = truncate_result(result, max_result_bytes)
+            if truncated_result is not None:
+                self._logger.warn(
+                    f'Truncated the result of function "{function_name}" to '
+                    f"{max_result_bytes} bytes"
+                )
+                return truncated_result, True
+        raise ResultTooLargeError(function_name, max_result_bytes)
+
+    def _pop_query_request(self) -> PopQueryRequest:
+        """
+        The popQuery request, which is the same for every poll until the agent
+        registers with a new versionHash.
+        """
+        if (
+            self._pop_query_options is None
+            or self._pop_query_options["versionHash"] != self._version_hash
+        ):
+            self._pop_query_options = {
                 "resourceId": self._resource_id,
                 "environmentName": self._environment_name,
                 "agentUuid": self._agent_uuid,
                 "versionHash": self._version_hash,
             }
-        )
+        return self._pop_query_options
+
+    async def fetch_query_and_execute(self) -> AgentServerStatus:
+        if self._stopping:
+            return "stop"
+        if self._registration_outdated and self._registered_operations_hash:
+            register_result = await self._register_updated_operations()
+            if register_result != "done":
+                return register_result
+
+        self._polling = True
+        try:
+            pending_query_fetch = await self._transport.pop_query(
+                self._retool_api, self._pop_query_request()
+            )
+        finally:
+            self._polling = False
 
         if not pending_query_fetch.is_success:
-            if is_client_error(pending_query_fetch.status_code):
+            if (
+                is_registration_error(pending_query_fetch.status_code)
+                and self._reregistration_attempts < MAX_REREGISTRATION_ATTEMPTS
+            ):
+                return await self._reregister_agent(pending_query_fetch)
+
+            status_code = pending_query_fetch.status_code
+            if is_client_error(status_code) and not is_retryable_error(status_code):
                 self._logger.error(
                     f"Error fetching query ({pending_query_fetch.status_code}): "
                     f"{pending_query_fetch.text}"
@@ -179,61 +1001,181 @@ class RetoolRPC:
                 f"{pending_query_fetch.status_code}. Retrying..."
             )
 
-        query_data = pending_query_fetch.json()
-        if "query" in query_data and query_data["query"] is not None:
-            query = query_data["query"]
-            self._logger.debug(
-                "Executing query", query
-            )  # This might contain sensitive information
+        self._reregistration_attempts = 0
+        self._last_poll_at = time.time()
+        decode_started_at = time.perf_counter_ns()
+        query_data = decode_query(pending_query_fetch.content, self._lazy_arguments)
+        decode_ns = time.perf_counter_ns() - decode_started_at
+        received_query = "query" in query_data and query_data["query"] is not None
+        self._next_poll_delay_ms = self._transport.next_poll_delay_ms(received_query)
+        if received_query:
+            self._in_flight_queries += 1
+            try:
+                await self._execute_query(
+                    query_data["query"], QueryTimings(decode_ns=decode_ns)
+                )
+            finally:
+                self._in_flight_queries -= 1
+
+        # A draining agent stops once its running query is done.
+        return "stop" if self._stopping else "continue"
 
-            agent_received_query_at = datetime.datetime.utcnow().isoformat()
+    async def _execute_query(
+        self, query: Dict[str, Any], timings: QueryTimings
+    ) -> None:
+        """
+        Execute a popped query and post its response, with the durations of its
+        phases in the response metadata and in the metrics.
+        """
+        self._logger.debug(
+            "Executing query", query
+        )  # This might contain sensitive information
 
-            query_uuid = query["queryUuid"]
-            query_info = query["queryInfo"]
+        agent_received_query_at = datetime.datetime.now(
+            datetime.timezone.utc
+        ).isoformat()
+        received_at = time.time()
+        started_at = time.perf_counter_ns()
 
-            status: Literal["success", "error"] = "success"
-            agent_server_error: Optional[AgentServerError] = None
-            execution_response: Optional[Any] = None
-            execution_arguments: Optional[Dict[str, Any]] = None
-            try:
-                execution_result = await self.execute_function(
-                    query_info["method"],
-                    query_info["parameters"],
-                    query_info["context"],
+        query_uuid = query["queryUuid"]
+        query_info = query["queryInfo"]
+        capture_id = self._capture_query(query_info, received_at)
+
+        status: Literal["success", "error"] = "success"
+        agent_server_error: Optional[AgentServerError] = None
+        execution_response: Optional[Any] = None
+        execution_arguments: Optional[Dict[str, Any]] = None
+        result_format: Optional[str] = None
+        attachment: Optional[Attachment] = None
+        truncated = False
+        execution_metadata: Optional[Dict[str, Any]] = None
+        cancelled = False
+        try:
+            execution_result = await self._execute(
+                query_info["method"],
+                query_info["parameters"],
+                query_info["context"],
+                query_uuid,
+                timings,
+            )
+            serialize_started_at = time.perf_counter_ns()
+            attachment = to_attachment(execution_result.result)
+            if attachment is not None:
+                execution_response = attachment.reference()
+                result_format = "attachment"
+            else:
+                function_spec = self._functions.get(query_info["method"])
+                encoded_result, result_format = encode_result(
+                    execution_result.result,
+                    bool(function_spec and function_spec.get("columnar")),
+                    self._result_format,
                 )
-                execution_response = execution_result["result"]
-                execution_arguments = execution_result["arguments"]
-                status = "success"
-            except Exception as err:
-                agent_server_error = create_agent_server_error(err)
-                status = "error"
+                execution_response, truncated = self._limit_result_size(
+                    query_info["method"], encoded_result
+                )
+            execution_arguments = execution_result.arguments
+            execution_metadata = execution_result.metadata
+            if isinstance(execution_arguments, LazyArguments):
+                execution_arguments = execution_arguments.materialized()
+            timings.serialize_ns = time.perf_counter_ns() - serialize_started_at
+            status = "success"
+        except Exception as err:
+            agent_server_error = create_agent_server_error(
+                err, self._error_stack_mode, self._error_stack_frames
+            )
+            execution_metadata = getattr(err, ERROR_METADATA_ATTRIBUTE, None)
+            status = "error"
+        except asyncio.CancelledError:
+            if not self._stopping:
+                raise
+            # Cancelled at the drain deadline: the query fails instead of being
+            # left without a response.
+            cancelled = True
+            agent_server_error = create_agent_server_error(
+                AgentShuttingDownError(query_info["method"]), self._error_stack_mode
+            )
+            status = "error"
+        if status == "error" and attachment is not None:
+            # Error responses have no attachment, e.g. when the result is the path
+            # of a missing file.
+            attachment.close()
+            attachment = None
 
-            agent_finished_query_at = datetime.datetime.utcnow().isoformat()
+        agent_finished_query_at = datetime.datetime.now(
+            datetime.timezone.utc
+        ).isoformat()
+        if capture_id is not None:
+            self._capture_outcome(
+                capture_id, (time.perf_counter_ns() - started_at) / 1e6, status
+            )
 
+        response = QueryResponse(
+            query_uuid=query_uuid,
+            status=status,
+            data=execution_response,
+            error=agent_server_error,
+            received_at=agent_received_query_at,
+            finished_at=agent_finished_query_at,
+            parameters=execution_arguments,
+            result_format=result_format,
+            truncated=truncated,
+            extra_metadata=execution_metadata,
+            timings=timings,
+        )
+        post_started_at = time.perf_counter_ns()
+        try:
             update_query_response = await self._retool_api.post_query_response(
-                options={
-                    "resourceId": self._resource_id,
-                    "environmentName": self._environment_name,
-                    "versionHash": self._version_hash,
-                    "agentUuid": self._agent_uuid,
-                    "queryUuid": query_uuid,
-                    "status": status,
-                    "data": execution_response,
-                    "metadata": {
-                        "packageLanguage": "python",
-                        "packageVersion": __version__,
-                        "agentReceivedQueryAt": agent_received_query_at,
-                        "agentFinishedQueryAt": agent_finished_query_at,
-                        "parameters": execution_arguments,
-                    },
-                    "error": agent_server_error,
-                }
-            )
-
-            self._logger.debug(
-                "Update query response status: ",
-                update_query_response.status_code,
-                update_query_response.text,
-            )
-
-        return "continue"
+                self._response_envelope.encode(response, self._version_hash),
+                attachment=attachment,
+            )
+        finally:
+            if attachment is not None:
+                attachment.close()
+        timings.post_ns = time.perf_counter_ns() - post_started_at
+        if query_info["method"] in self._functions:
+            try:
+                self.metrics.record_timings(query_info["method"], timings.as_dict())
+            except Exception as err:
+                # A failing metrics hook must not stop the agent.
+                self._logger.warn(f"Error recording query timings: {str(err)}")
+
+        self._logger.debug(
+            "Update query response status: ",
+            update_query_response.status_code,
+            update_query_response.text,
+        )
+        if cancelled:
+            # The response is posted, the agent can now stop.
+            raise asyncio.CancelledError()
+
+    def _capture_query(
+        self, query_info: Dict[str, Any], received_at: float
+    ) -> Optional[str]:
+        """
+        Capture a popped query before it runs, and return its capture id.
+        """
+        if self._capture_file is None:
+            return None
+        try:
+            if self._recorder is None:
+                self._recorder = QueryRecorder(self._capture_file)
+            return self._recorder.record(
+                query_info["method"],
+                materialize(query_info["parameters"]),
+                query_info.get("context"),
+                received_at,
+            )
+        except (OSError, TypeError, ValueError) as err:
+            # A capture problem must not fail the query.
+            self._logger.warn(f"Error capturing query: {str(err)}")
+            return None
+
+    def _capture_outcome(
+        self, capture_id: str, duration_ms: float, status: str
+    ) -> None:
+        if self._recorder is None:
+            return
+        try:
+            self._recorder.record_outcome(capture_id, duration_ms, status)
+        except (OSError, ValueError) as err:
+            self._logger.warn(f"Error capturing query: {str(err)}")
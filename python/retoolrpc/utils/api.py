@@ -1,6 +1,8 @@
-from typing import Any, Dict, Literal, Optional, TypedDict
+from typing import Any, Dict, Literal, Optional, TypedDict, Union
 
 import httpx
+from retoolrpc.utils.attachments import Attachment, MultipartBody
+from retoolrpc.utils.serialization import dumps
 from retoolrpc.utils.types import AgentServerError
 from retoolrpc.version import __version__
 
@@ -16,6 +18,15 @@ class PopQueryRequest(TypedDict):
     versionHash: Optional[str]
 
 
+class LongPollQueryRequest(PopQueryRequest, total=False):
+    """
+    Request structure for popQuery endpoint when long polling.
+    """
+
+    # How long the server may hold the request open waiting for a query.
+    waitTimeoutMs: int
+
+
 class RegisterAgentRequest(TypedDict):
     """
     Request structure for registerAgent endpoint.
@@ -28,7 +39,7 @@ class RegisterAgentRequest(TypedDict):
     operations: Dict[str, Any]
 
 
-class PostQueryResponseRequestMetdata(TypedDict):
+class PostQueryResponseRequestMetdata(TypedDict, total=False):
     """
     Request structure for postQueryResponse endpoint.
     """
@@ -38,6 +49,10 @@ class PostQueryResponseRequestMetdata(TypedDict):
     agentReceivedQueryAt: str
     agentFinishedQueryAt: str
     parameters: Optional[Dict[str, Any]]
+    # Set for tabular results: "columnar" or "rows".
+    resultFormat: str
+    # Set when the result exceeded its size limit and was truncated.
+    truncated: bool
 
 
 class PostQueryResponseRequest(TypedDict):
@@ -57,6 +72,16 @@ class PostQueryResponseRequest(TypedDict):
 
 
 class RetoolAPI:
+    """
+    Client for the RetoolRPC endpoints of the Retool server.
+
+    Requests go through a single `httpx.AsyncClient`, created on the first request
+    and closed with `aclose`, so that connections are kept alive between polls:
+    creating a client builds its own SSL context, which costs more CPU than the
+    request itself. The URLs, the headers and the encoded popQuery body, which only
+    changes with the versionHash, are computed once instead of for every poll.
+    """
+
     def __init__(self, host_url: str, api_key: str, polling_timeout_ms: int) -> None:
         """
         Initialize the RetoolAPI with given host_url and api_key.
@@ -64,58 +89,75 @@ class RetoolAPI:
         self._host_url = host_url
         self._api_key = api_key
         self._polling_timeput_ms = polling_timeout_ms
-
-    async def pop_query(self, options: PopQueryRequest) -> httpx.Response:
-        headers = {
-            "Authorization": f"Bearer {self._api_key}",
+        self._pop_query_url = f"{host_url}/api/v1/retoolrpc/popQuery"
+        self._register_agent_url = f"{host_url}/api/v1/retoolrpc/registerAgent"
+        self._post_query_response_url = f"{host_url}/api/v1/retoolrpc/postQueryResponse"
+        self._headers = {
+            "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json",
             "User-Agent": f"RetoolRPC/{__version__} (Python)",
         }
+        self._client: Optional[httpx.AsyncClient] = None
+        # The last popQuery request and its encoded body.
+        self._pop_query_request: Optional[PopQueryRequest] = None
+        self._pop_query_body = b""
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(headers=self._headers)
+        return self._client
+
+    async def aclose(self) -> None:
+        """
+        Close the connections of the client. A later request opens new ones.
+        """
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    async def pop_query(
+        self, options: PopQueryRequest, timeout_ms: Optional[int] = None
+    ) -> httpx.Response:
+        timeout_ms = timeout_ms or self._polling_timeput_ms
+        if options != self._pop_query_request:
+            self._pop_query_request = options.copy()
+            self._pop_query_body = dumps(options)
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    url=f"{self._host_url}/api/v1/retoolrpc/popQuery",
-                    headers=headers,
-                    json=options,
-                    timeout=self._polling_timeput_ms / 1000,  # Convert to seconds
-                )
-                response.raise_for_status()
-                return response
+            # Error statuses are handled by the caller, e.g. a rejected versionHash
+            # triggers a new registration.
+            return await self._get_client().post(
+                url=self._pop_query_url,
+                content=self._pop_query_body,
+                timeout=timeout_ms / 1000,  # Convert to seconds
+            )
         except httpx.TimeoutException as err:
-            raise TimeoutError(
-                f"Polling timeout after {self._polling_timeput_ms}ms"
-            ) from err
-        except Exception as err:
-            raise err
+            raise TimeoutError(f"Polling timeout after {timeout_ms}ms") from err
 
     async def register_agent(self, options: RegisterAgentRequest) -> httpx.Response:
-        headers = {
-            "Authorization": f"Bearer {self._api_key}",
-            "Content-Type": "application/json",
-            "User-Agent": f"RetoolRPC/{__version__} (Python)",
-        }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url=f"{self._host_url}/api/v1/retoolrpc/registerAgent",
-                headers=headers,
-                json=options,
-            )
-            response.raise_for_status()
-            return response
+        return await self._get_client().post(url=self._register_agent_url, json=options)
 
     async def post_query_response(
-        self, options: PostQueryResponseRequest
+        self,
+        options: Union[PostQueryResponseRequest, bytes],
+        attachment: Optional[Attachment] = None,
     ) -> httpx.Response:
-        headers = {
-            "Authorization": f"Bearer {self._api_key}",
-            "Content-Type": "application/json",
-            "User-Agent": f"RetoolRPC/{__version__} (Python)",
-        }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url=f"{self._host_url}/api/v1/retoolrpc/postQueryResponse",
-                headers=headers,
-                json=options,
-            )
-            response.raise_for_status()
-            return response
+        """
+        Post the response of a query, given as a request or as an already encoded
+        request body. A binary result is sent as an attachment: the request is then
+        multipart, with the JSON response in the `response` part and the content
+        streamed in the `attachment` part.
+        """
+        content: Any = options if isinstance(options, bytes) else dumps(options)
+        headers = None
+        if attachment is not None:
+            content = MultipartBody(content, attachment)
+            headers = {"Content-Type": content.content_type}
+            content_length = content.content_length()
+            if content_length is not None:
+                headers["Content-Length"] = str(content_length)
+
+        response = await self._get_client().post(
+            url=self._post_query_response_url, headers=headers, content=content
+        )
+        response.raise_for_status()
+        return response
@@ -0,0 +1,131 @@
+from typing import Any, Dict, Iterator, Mapping
+
+from retoolrpc.utils.errors import InvalidArgumentsError
+from retoolrpc.utils.helpers import is_falsy_argument_value
+from retoolrpc.utils.schema import ArgumentParser
+from retoolrpc.utils.serialization import loads
+from retoolrpc.utils.types import Arguments
+
+try:
+    import simdjson
+except ImportError:  # pragma: no cover
+    simdjson = None  # type: ignore[assignment]
+
+
+def materialize(value: Any) -> Any:
+    """
+    Convert a simdjson proxy to Python objects. Other values are returned as is.
+    """
+    if simdjson is not None:
+        if isinstance(value, simdjson.Object):
+            return value.as_dict()
+        if isinstance(value, simdjson.Array):
+            return value.as_list()
+    return value
+
+
+def decode_query(content: bytes, lazy_arguments: bool = False) -> Dict[str, Any]:
+    """
+    Decode a popQuery response. With `lazy_arguments` and simdjson installed, only
+    the envelope (queryUuid, method, context, ...) is converted to Python objects,
+    and the parameters are left as a simdjson object that is decoded argument by
+    argument when they are accessed.
+    """
+    if not lazy_arguments or simdjson is None:
+        return loads(content)
+
+    # A parser per query: documents are invalidated when their parser is reused.
+    document: Any = simdjson.Parser().parse(content)
+    query = document.get("query")
+    if query is None:
+        return {"query": None}
+
+    # Iterate over keys: items() of a simdjson object materializes the values.
+    query_info = query["queryInfo"]
+    return {
+        "query": {
+            **{
+                key: materialize(query[key])
+                for key in query.keys()
+                if key != "queryInfo"
+            },
+            "queryInfo": {
+                key: (
+                    query_info[key]
+                    if key == "parameters"
+                    else materialize(query_info[key])
+                )
+                for key in query_info.keys()
+            },
+        }
+    }
+
+
+class LazyArguments(Mapping[str, Any]):
+    """
+    The arguments of a function, parsed and validated one by one when the
+    implementation accesses them. Required arguments are checked upfront.
+
+    Only arguments of the function schema are exposed, like for eagerly parsed
+    arguments. The mapping is read-only.
+    """
+
+    def __init__(self, arguments: Any, schema: Arguments) -> None:
+        if not isinstance(arguments, Mapping) and not _is_simdjson_object(arguments):
+            raise ValueError("The given arguments are invalid.")
+
+        self._arguments = arguments
+        self._parser = ArgumentParser(schema)
+        self._schema = schema
+        self._parsed: Dict[str, Any] = {}
+
+        missing_errors = [
+            f'Argument "{arg_name}" is required but missing.'
+            for arg_name, arg_definition in schema.items()
+            if arg_definition["required"]
+            and is_falsy_argument_value(arguments.get(arg_name))
+        ]
+        if missing_errors:
+            raise InvalidArgumentsError(
+                "\n".join(["Invalid parameter(s) found:"] + missing_errors)
+            )
+
+    def __getitem__(self, arg_name: str) -> Any:
+        if arg_name in self._parsed:
+            return self._parsed[arg_name]
+        if arg_name not in self._schema or arg_name not in self._arguments:
+            raise KeyError(arg_name)
+
+        arg_value = materialize(self._arguments[arg_name])
+        if is_falsy_argument_value(arg_value):
+            parsed_value = arg_value
+        else:
+            parsed_value, parsed_error = self._parser.parse_argument(
+                arg_name, arg_value
+            )
+            if parsed_error is not None:
+                raise InvalidArgumentsError(
+                    "\n".join(["Invalid parameter(s) found:", parsed_error])
+                )
+
+        self._parsed[arg_name] = parsed_value
+        return parsed_value
+
+    def __iter__(self) -> Iterator[str]:
+        return (arg_name for arg_name in self._schema if arg_name in self._arguments)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"LazyArguments({list(self)})"
+
+    def materialized(self) -> Dict[str, Any]:
+        """
+        Return the arguments that were accessed so far.
+        """
+        return dict(self._parsed)
+
+
+def _is_simdjson_object(value: Any) -> bool:
+    return simdjson is not None and isinstance(value, simdjson.Object)
@@ -0,0 +1,231 @@
+import io
+import mmap
+import os
+import stat
+import uuid
+from typing import (
+    Any,
+    AsyncIterator,
+    Iterator,
+    List,
+    Optional,
+    TypedDict,
+    Union,
+)
+
+CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_PART_NAME = "attachment"
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+# Not available on every platform, e.g. Windows.
+_MADV_DONTNEED = getattr(mmap, "MADV_DONTNEED", None)
+
+BinarySource = Union[bytes, bytearray, memoryview, os.PathLike, io.IOBase]
+
+
+class AttachmentReference(TypedDict):
+    """
+    Placed in the `data` of postQueryResponse in place of a binary result.
+    """
+
+    # Name of the multipart part that holds the content.
+    part: str
+    # None if the size is not known upfront, e.g. for a pipe.
+    size: Optional[int]
+    contentType: str
+    filename: Optional[str]
+
+
+class Attachment:
+    """
+    A binary function result. It is uploaded as a separate part of the
+    postQueryResponse request instead of being base64 encoded into the JSON data.
+
+    Implementations can return `bytes`, `bytearray`, `memoryview`, a `pathlib.Path`
+    or a binary file object directly, or wrap them in an Attachment to set the
+    content type and file name. Plain strings are always treated as text results,
+    not as file paths.
+    """
+
+    def __init__(
+        self,
+        source: BinarySource,
+        content_type: str = DEFAULT_CONTENT_TYPE,
+        filename: Optional[str] = None,
+    ) -> None:
+        self.source = source
+        self.content_type = content_type
+        self.filename = filename
+        if filename is None and isinstance(source, os.PathLike):
+            self.filename = os.path.basename(os.fspath(source))
+
+    @property
+    def size(self) -> Optional[int]:
+        """
+        Size of the content in bytes, from the current position of a file object.
+        None if it is not known upfront: for pipes, sockets and files that report
+        a size of 0, e.g. in /proc, which are read until their end. Reading it
+        checks that the content is accessible, e.g. that a file exists.
+        """
+        if isinstance(self.source, (bytes, bytearray, memoryview)):
+            return memoryview(self.source).nbytes
+        if isinstance(self.source, os.PathLike):
+            return _known_size(os.stat(self.source))
+        if isinstance(self.source, io.BytesIO):
+            with self.source.getbuffer() as view:
+                return max(0, view.nbytes - self.source.tell())
+        return _remaining_size(self.source)
+
+    def reference(self) -> AttachmentReference:
+        return {
+            "part": ATTACHMENT_PART_NAME,
+            "size": self.size,
+            "contentType": self.content_type,
+            "filename": self.filename,
+        }
+
+    def chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+        """
+        Yield the content in chunks that are views of it, without copying it.
+        Files are memory mapped: their pages are loaded by the kernel as they are
+        sent, and dropped from the process once the next chunk is requested. Files
+        of unknown size are read in chunks instead.
+
+        Views are not released explicitly: the HTTP transport may still hold
+        chunks, and the buffer or map is freed with its last view.
+        """
+        if isinstance(self.source, (bytes, bytearray, memoryview)):
+            yield from _view_chunks(memoryview(self.source).cast("B"), chunk_size)
+        elif isinstance(self.source, io.BytesIO):
+            view = self.source.getbuffer()[self.source.tell() :]
+            yield from _view_chunks(view, chunk_size)
+        elif isinstance(self.source, os.PathLike):
+            with open(self.source, "rb") as file:
+                yield from _file_chunks(file, chunk_size)
+        else:
+            # File objects returned by an implementation are closed once sent.
+            with self.source:
+                yield from _file_chunks(self.source, chunk_size)
+
+    def close(self) -> None:
+        """
+        Close a file object returned by the implementation, e.g. when the response
+        could not be posted. Buffers, including BytesIO, are left open.
+        """
+        if isinstance(self.source, io.IOBase) and not isinstance(
+            self.source, io.BytesIO
+        ):
+            self.source.close()
+
+
+def _known_size(file_stat: os.stat_result) -> Optional[int]:
+    if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+        return None
+    return file_stat.st_size
+
+
+def _remaining_size(file: Any) -> Optional[int]:
+    """
+    The size of a file object from its current position, None if it is unknown.
+    """
+    try:
+        size = _known_size(os.fstat(file.fileno()))
+    except (AttributeError, OSError):
+        # e.g. file objects that are not backed by a file descriptor.
+        return None
+    return None if size is None else max(0, size - file.tell())
+
+
+def _view_chunks(view: memoryview, chunk_size: int) -> Iterator[memoryview]:
+    for offset in range(0, view.nbytes, chunk_size):
+        yield view[offset : offset + chunk_size]
+
+
+def _file_chunks(file: Any, chunk_size: int) -> Iterator[memoryview]:
+    size = _remaining_size(file)
+    if size is None:
+        while chunk := file.read(chunk_size):
+            yield memoryview(chunk)
+        return
+    if size == 0:
+        # Empty files cannot be memory mapped.
+        return
+
+    position = file.tell()
+    end = position + size
+    # The map keeps its own file descriptor, the file can be closed.
+    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    for offset in range(position, end, chunk_size):
+        yield view[offset : min(offset + chunk_size, end)]
+        if _MADV_DONTNEED is not None:
+            # madvise needs a page aligned start.
+            start = offset - offset % mmap.PAGESIZE
+            mapped.madvise(_MADV_DONTNEED, start, offset + chunk_size - start)
+
+
+def to_attachment(result: Any) -> Optional[Attachment]:
+    """
+    Return the result as an Attachment if it is binary, or None.
+    """
+    if isinstance(result, Attachment):
+        return result
+    if isinstance(result, (bytes, bytearray, memoryview, os.PathLike)):
+        return Attachment(result)
+    if isinstance(result, (io.RawIOBase, io.BufferedIOBase)):
+        return Attachment(result, filename=_file_name(result))
+    return None
+
+
+def _file_name(file: Any) -> Optional[str]:
+    name = getattr(file, "name", None)
+    return os.path.basename(name) if isinstance(name, str) else None
+
+
+class MultipartBody:
+    """
+    A multipart/form-data body with the JSON response and one attachment. The
+    attachment is streamed in chunks that are views of its content, so the body
+    never holds a copy of it.
+    """
+
+    def __init__(self, response: bytes, attachment: Attachment) -> None:
+        self.boundary = uuid.uuid4().hex
+        self._attachment = attachment
+        filename = f'; filename="{attachment.filename}"' if attachment.filename else ""
+        self._head: List[bytes] = [
+            (
+                f"--{self.boundary}\r\n"
+                'Content-Disposition: form-data; name="response"\r\n'
+                "Content-Type: application/json\r\n\r\n"
+            ).encode(),
+            response,
+            (
+                f"\r\n--{self.boundary}\r\n"
+                "Content-Disposition: form-data; "
+                f'name="{ATTACHMENT_PART_NAME}"{filename}\r\n'
+                f"Content-Type: {attachment.content_type}\r\n\r\n"
+            ).encode(),
+        ]
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def content_length(self) -> Optional[int]:
+        """
+        The length of the body, None if the size of the attachment is not known,
+        in which case the body is sent with chunked transfer encoding.
+        """
+        size = self._attachment.size
+        if size is None:
+            return None
+        return sum(len(chunk) for chunk in self._head) + size + len(self._tail)
+
+    async def __aiter__(self) -> AsyncIterator[Union[bytes, memoryview]]:
+        for head in self._head:
+            yield head
+        # The transport only needs bytes-like chunks.
+        for chunk in self._attachment.chunks():
+            yield chunk
+        yield self._tail
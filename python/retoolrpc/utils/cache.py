@@ -0,0 +1,201 @@
+import asyncio
+import inspect
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Union
+
+from retoolrpc.utils.logger import Logger
+from retoolrpc.utils.metrics import Metrics
+from retoolrpc.utils.types import CacheConfig
+
+# The metrics of the cache are grouped under this name instead of a function name.
+CACHE_METRICS_NAME = "__cache__"
+
+Loader = Callable[[], Union[Awaitable[Any], Any]]
+
+
+class _Entry:
+    __slots__ = ("value", "fresh_until", "stale_until")
+
+    def __init__(self, value: Any, fresh_until: float, stale_until: float) -> None:
+        self.value = value
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+
+class AsyncCache:
+    """
+    An in-memory cache for values that are slow to load, e.g. reference data read
+    from a database, shared by all functions of the agent as `rpc.cache`.
+
+    `get_or_load` returns the cached value of a key, or calls its loader. Values
+    are fresh for `ttl_ms`; then, for `stale_ms`, the expired value is returned
+    right away while a background task reloads it. Concurrent calls for a key that
+    is loading wait for the same load instead of starting their own, and a failed
+    load is not cached. At most `max_size` values are kept, the least recently used
+    one is dropped first.
+
+    Hits, stale hits, misses, loads, load errors and evictions are counted in the
+    `__cache__` metrics of the agent, prefixed with `cache_`, along with the
+    `cache_size` gauge.
+    """
+
+    def __init__(
+        self,
+        config: CacheConfig = CacheConfig(),
+        metrics: Optional[Metrics] = None,
+        logger: Optional[Logger] = None,
+    ) -> None:
+        if config.ttl_ms <= 0:
+            raise ValueError("ttl_ms must be positive.")
+        if config.max_size <= 0:
+            raise ValueError("max_size must be positive.")
+        self.config = config
+        self._metrics = metrics or Metrics()
+        self._logger = logger or Logger()
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._loading: Dict[Hashable, "asyncio.Task[Any]"] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and time.monotonic() < entry.fresh_until
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Loader,
+        ttl_ms: Optional[int] = None,
+        stale_ms: Optional[int] = None,
+    ) -> Any:
+        """
+        Return the value of `key`, loading it with `loader`, a function or coroutine
+        function without arguments, if it is not cached. `ttl_ms` and `stale_ms`
+        override the defaults of the cache for this key.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if now < entry.fresh_until:
+                self._entries.move_to_end(key)
+                self._increment("cache_hits")
+                return entry.value
+            if now < entry.stale_until:
+                self._entries.move_to_end(key)
+                self._increment("cache_stale_hits")
+                if key not in self._loading:
+                    self._start_load(key, loader, ttl_ms, stale_ms, refresh=True)
+                return entry.value
+
+        self._increment("cache_misses")
+        task = self._loading.get(key)
+        if task is None:
+            task = self._start_load(key, loader, ttl_ms, stale_ms, refresh=False)
+        # A cancelled caller must not cancel the load other callers wait for.
+        return await asyncio.shield(task)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return the value of `key` if it is fresh, and `default` otherwise.
+        """
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry.fresh_until:
+            return default
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl_ms: Optional[int] = None,
+        stale_ms: Optional[int] = None,
+    ) -> None:
+        fresh_until = time.monotonic() + (ttl_ms or self.config.ttl_ms) / 1000
+        stale_until = (
+            fresh_until
+            + (stale_ms if stale_ms is not None else self.config.stale_ms) / 1000
+        )
+        self._entries[key] = _Entry(value, fresh_until, stale_until)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.config.max_size:
+            self._entries.popitem(last=False)
+            self._increment("cache_evictions")
+        self._metrics.set_gauge(CACHE_METRICS_NAME, "cache_size", len(self._entries))
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Drop the value of `key`. A load that is running is not cancelled.
+        """
+        self._entries.pop(key, None)
+        self._metrics.set_gauge(CACHE_METRICS_NAME, "cache_size", len(self._entries))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._metrics.set_gauge(CACHE_METRICS_NAME, "cache_size", 0)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return the metrics of the cache.
+        """
+        return self._metrics.snapshot().get(CACHE_METRICS_NAME, {})
+
+    async def close(self) -> None:
+        """
+        Cancel the loads that are running, e.g. background reloads when the agent
+        stops. Cached values are kept.
+        """
+        tasks = list(self._loading.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loading.clear()
+
+    def _increment(self, name: str) -> None:
+        self._metrics.increment(CACHE_METRICS_NAME, name)
+
+    def _start_load(
+        self,
+        key: Hashable,
+        loader: Loader,
+        ttl_ms: Optional[int],
+        stale_ms: Optional[int],
+        refresh: bool,
+    ) -> "asyncio.Task[Any]":
+        task = asyncio.ensure_future(self._load(key, loader, ttl_ms, stale_ms))
+        self._loading[key] = task
+
+        def loaded(task: "asyncio.Task[Any]") -> None:
+            if self._loading.get(key) is task:
+                del self._loading[key]
+            # The error is raised to the callers that wait for the load; if there
+            # are none, e.g. for a reload, it must not be reported as never
+            # retrieved.
+            error = None if task.cancelled() else task.exception()
+            if refresh and error is not None:
+                # The stale value is served until it expires, or a reload succeeds.
+                self._logger.warn(f"Error reloading cached value {key!r}: {str(error)}")
+
+        task.add_done_callback(loaded)
+        return task
+
+    async def _load(
+        self,
+        key: Hashable,
+        loader: Loader,
+        ttl_ms: Optional[int],
+        stale_ms: Optional[int],
+    ) -> Any:
+        self._increment("cache_loads")
+        try:
+            value = loader()
+            if inspect.isawaitable(value):
+                value = await value
+        except Exception:
+            # Callers that missed and joined a reload get its error too.
+            self._increment("cache_load_errors")
+            raise
+        self.set(key, value, ttl_ms, stale_ms)
+        return value
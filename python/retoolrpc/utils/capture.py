@@ -0,0 +1,136 @@
+import hashlib
+import itertools
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, TypedDict
+
+from retoolrpc.utils.serialization import dumps, loads
+
+
+class CapturedQuery(TypedDict):
+    """
+    A query of a capture file, written when the query is popped.
+    """
+
+    # Identifies the query within the capture, to match its outcome.
+    id: str
+    # When the agent received the query, in seconds since the epoch.
+    receivedAt: float
+    method: str
+    parameters: Any
+    # The context, with every value replaced by a keyed hash.
+    context: Dict[str, Any]
+    # How long the agent took to execute the query, in milliseconds. None for a
+    # query that did not finish, e.g. because the agent hung or crashed.
+    durationMs: Optional[float]
+    # "success", "error", or "unfinished" until the outcome is written.
+    status: str
+
+
+class CapturedOutcome(TypedDict):
+    """
+    The outcome of a captured query, written after its query once it finished.
+    """
+
+    id: str
+    durationMs: float
+    status: str
+
+
+class QueryRecorder:
+    """
+    Appends popped queries to a JSON lines capture file, to replay them offline
+    with `python -m retoolrpc.replay`. A query is written as soon as it is popped,
+    so that queries that hang or crash the agent are captured too, and its outcome
+    is written on its own line when it finishes.
+
+    Parameters are recorded as is. Context values identify users, so they are
+    replaced by hashes keyed with a random key per recorder: the same user keeps
+    the same hash within a capture, e.g. for rate limits keyed by user, but hashes
+    cannot be matched across captures or back to a user.
+    """
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Unbuffered appends: every record is a single write of a whole line.
+        self._file = open(path, "ab", buffering=0)
+        self._key = os.urandom(16)
+        # Ids are unique across the recorders appending to the same file, e.g. of
+        # an agent and the agent that replaces it.
+        self._id_prefix = self._key[:4].hex()
+        self._ids = itertools.count()
+
+    def record(
+        self,
+        method: str,
+        parameters: Any,
+        context: Optional[Dict[str, Any]],
+        received_at: float,
+    ) -> str:
+        """
+        Write a popped query and return its id, to record its outcome.
+        """
+        captured: CapturedQuery = {
+            "id": f"{self._id_prefix}-{next(self._ids)}",
+            "receivedAt": round(received_at, 6),
+            "method": method,
+            "parameters": parameters,
+            "context": {
+                key: self._redact(value) for key, value in (context or {}).items()
+            },
+            "durationMs": None,
+            "status": "unfinished",
+        }
+        self._file.write(dumps(captured) + b"\n")
+        return captured["id"]
+
+    def record_outcome(self, query_id: str, duration_ms: float, status: str) -> None:
+        outcome: CapturedOutcome = {
+            "id": query_id,
+            "durationMs": round(duration_ms, 3),
+            "status": status,
+        }
+        self._file.write(dumps(outcome) + b"\n")
+
+    def _redact(self, value: Any) -> Any:
+        if value is None:
+            return None
+        if isinstance(value, list):
+            return [self._redact(item) for item in value]
+        digest = hashlib.blake2b(
+            str(value).encode(), key=self._key, digest_size=8
+        ).hexdigest()
+        return f"redacted:{digest}"
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_capture(path: str) -> Iterator[CapturedQuery]:
+    """
+    Read the queries of a capture file with their outcomes, in the order they were
+    popped. A query waits for its outcome before it is yielded; queries without
+    one are yielded at the end of the file as "unfinished". A partly written last
+    line, e.g. from an agent that was killed, is skipped.
+    """
+    pending: "OrderedDict[str, CapturedQuery]" = OrderedDict()
+    with open(path, "rb") as capture_file:
+        for line in capture_file:
+            if not line.endswith(b"\n"):
+                break
+            if not line.strip():
+                continue
+            record = loads(line)
+            if "method" in record:
+                pending[record["id"]] = record
+            elif record["id"] in pending:
+                query = pending[record["id"]]
+                query["durationMs"] = record["durationMs"]
+                query["status"] = record["status"]
+            while pending:
+                query = next(iter(pending.values()))
+                if query["durationMs"] is None:
+                    break
+                yield pending.popitem(last=False)[1]
+    yield from pending.values()
@@ -0,0 +1,111 @@
+import time
+from collections import deque
+from typing import Any, Deque, Literal
+
+from retoolrpc.utils.errors import CircuitOpenError
+from retoolrpc.utils.metrics import Metrics
+from retoolrpc.utils.middleware import CallNext, FunctionCall
+from retoolrpc.utils.types import CircuitBreakerConfig
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker middleware for one function.
+
+    While closed, calls go through and their outcomes are recorded in a window of
+    the most recent calls; failed and slow calls count as failures. When the
+    failure rate of the window reaches the threshold, the circuit opens and calls
+    fail fast with a CircuitOpenError. After `open_duration_ms`, the circuit is
+    half-open and lets a few trial calls through: it closes again if they
+    succeed, and reopens if one fails.
+
+    The state is reported as the `circuit_state` gauge of the function, and fast
+    failures as the `circuit_rejected` counter.
+    """
+
+    def __init__(
+        self, function_name: str, config: CircuitBreakerConfig, metrics: Metrics
+    ) -> None:
+        self.function_name = function_name
+        self.config = config
+        self._metrics = metrics
+        self._outcomes: Deque[bool] = deque(maxlen=config.window_size)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_calls = 0
+        self._set_state("closed")
+
+    @property
+    def state(self) -> CircuitState:
+        return self._state
+
+    def _set_state(self, state: CircuitState) -> None:
+        self._state = state
+        self._metrics.set_gauge(self.function_name, "circuit_state", state)
+
+    def _before_call(self) -> None:
+        if self._state == "open":
+            retry_after_ms = (
+                self._opened_at + self.config.open_duration_ms / 1000 - time.monotonic()
+            ) * 1000
+            if retry_after_ms > 0:
+                self._reject(retry_after_ms)
+            self._set_state("half_open")
+
+        if self._state == "half_open":
+            if self._trial_calls >= self.config.half_open_calls:
+                self._reject(0)
+            self._trial_calls += 1
+
+    def _reject(self, retry_after_ms: float) -> None:
+        self._metrics.increment(self.function_name, "circuit_rejected")
+        raise CircuitOpenError(self.function_name, retry_after_ms)
+
+    def _record(self, failed: bool) -> None:
+        if self._state == "half_open":
+            self._trial_calls -= 1
+            if failed:
+                self._open()
+            elif self._trial_calls == 0:
+                self._outcomes.clear()
+                self._failures = 0
+                self._set_state("closed")
+            return
+        if self._state == "open":
+            # A call that started before the circuit opened.
+            return
+
+        if len(self._outcomes) == self._outcomes.maxlen:
+            self._failures -= self._outcomes[0]
+        self._outcomes.append(failed)
+        self._failures += failed
+        if (
+            len(self._outcomes) >= self.config.minimum_calls
+            and self._failures / len(self._outcomes)
+            >= self.config.failure_rate_threshold
+        ):
+            self._open()
+
+    def _open(self) -> None:
+        self._opened_at = time.monotonic()
+        self._trial_calls = 0
+        self._set_state("open")
+
+    async def __call__(self, call: FunctionCall, call_next: CallNext) -> Any:
+        self._before_call()
+        started_at = time.monotonic()
+        try:
+            result = await call_next(call)
+        except BaseException:
+            # Cancelled calls count as failed, so trial calls are always recorded.
+            self._record(True)
+            raise
+
+        slow_call_ms = self.config.slow_call_ms
+        self._record(
+            slow_call_ms is not None
+            and (time.monotonic() - started_at) * 1000 > slow_call_ms
+        )
+        return result
@@ -1,13 +1,59 @@
+import math
 import traceback
+from typing import Any, Optional
 
-from retoolrpc.utils.types import AgentServerError
+from retoolrpc.utils.types import AgentServerError, ErrorStackMode
 
 AGENT_SERVER_ERROR = "AgentServerError"
 FUNCTION_NOT_FOUND_ERROR = "FunctionNotFoundError"
 INVALID_ARGUMENTS_ERROR = "InvalidArgumentsError"
+RESULT_TOO_LARGE_ERROR = "ResultTooLargeError"
+RATE_LIMIT_EXCEEDED_ERROR = "RateLimitExceededError"
+CIRCUIT_OPEN_ERROR = "CircuitOpenError"
+AGENT_SHUTTING_DOWN_ERROR = "AgentShuttingDownError"
+DEFAULT_ERROR_STACK_FRAMES = 10
 
 
-def create_agent_server_error(error: Exception) -> AgentServerError:
+class AgentClientError(Exception):
+    """
+    Base class of errors caused by the query rather than by the implementation,
+    e.g. invalid arguments. Their stack is never sent.
+    """
+
+
+def format_stack(
+    error: Exception,
+    stack_mode: ErrorStackMode = "full",
+    stack_frames: int = DEFAULT_ERROR_STACK_FRAMES,
+) -> Optional[str]:
+    """
+    Format the traceback of an error for the given mode. Client errors have no
+    meaningful stack and are never formatted. In `truncated` mode, only the
+    source lines of the innermost `stack_frames` frames are looked up.
+    """
+    if stack_mode == "none" or isinstance(error, AgentClientError):
+        return None
+
+    # Source lines are only looked up for the frames that are formatted. Frames
+    # are formatted without the position markers of `traceback.format_tb`, which
+    # parse the source of every frame.
+    frames = traceback.StackSummary.extract(
+        traceback.walk_tb(error.__traceback__),
+        limit=-stack_frames if stack_mode == "truncated" else None,
+        lookup_lines=False,
+    )
+    return "".join(
+        f'  File "{frame.filename}", line {frame.lineno}, in {frame.name}\n'
+        + (f"    {frame.line}\n" if frame.line else "")
+        for frame in frames
+    )
+
+
+def create_agent_server_error(
+    error: Exception,
+    stack_mode: ErrorStackMode = "full",
+    stack_frames: int = DEFAULT_ERROR_STACK_FRAMES,
+) -> AgentServerError:
     """
     Convert a given error into an AgentServerError.
     """
@@ -15,7 +61,7 @@ def create_agent_server_error(error: Exception) -> AgentServerError:
         agent_error = AgentServerError(
             name=error.__class__.__name__,
             message=str(error),
-            stack="".join(traceback.format_tb(error.__traceback__)),
+            stack=format_stack(error, stack_mode, stack_frames),
             code=None,
             details=None,
         )
@@ -52,7 +98,7 @@ def create_agent_server_error(error: Exception) -> AgentServerError:
     )
 
 
-class FunctionNotFoundError(Exception):
+class FunctionNotFoundError(AgentClientError):
     """
     Exception raised when a function is not found on the remote agent server.
     """
@@ -64,7 +110,7 @@ class FunctionNotFoundError(Exception):
         self.name = FUNCTION_NOT_FOUND_ERROR
 
 
-class InvalidArgumentsError(Exception):
+class InvalidArgumentsError(AgentClientError):
     """
     Exception raised for invalid arguments.
     """
@@ -72,3 +118,73 @@ class InvalidArgumentsError(Exception):
     def __init__(self, message: str) -> None:
         super().__init__(message)
         self.name = INVALID_ARGUMENTS_ERROR
+
+
+class ResultTooLargeError(AgentClientError):
+    """
+    Exception raised when the result of a function exceeds its size limit.
+    """
+
+    def __init__(self, function_name: str, max_result_bytes: int) -> None:
+        super().__init__(
+            f'Result of function "{function_name}" exceeds the limit of '
+            f"{max_result_bytes} bytes."
+        )
+        self.name = RESULT_TOO_LARGE_ERROR
+        self.code = 413
+        self.details = {
+            "functionName": function_name,
+            "maxResultBytes": max_result_bytes,
+        }
+
+
+class RateLimitExceededError(AgentClientError):
+    """
+    Exception raised when a call exceeds the rate limit of a function.
+    """
+
+    def __init__(self, function_name: str, key: Any, retry_after_ms: float) -> None:
+        super().__init__(
+            f'Rate limit of function "{function_name}" exceeded. Retry after '
+            f"{math.ceil(retry_after_ms)}ms."
+        )
+        self.name = RATE_LIMIT_EXCEEDED_ERROR
+        self.code = 429
+        self.details = {
+            "functionName": function_name,
+            "key": key,
+            "retryAfterMs": math.ceil(retry_after_ms),
+        }
+
+
+class CircuitOpenError(AgentClientError):
+    """
+    Exception raised when a function is called while its circuit breaker is open.
+    """
+
+    def __init__(self, function_name: str, retry_after_ms: float) -> None:
+        super().__init__(
+            f'Function "{function_name}" is failing and temporarily unavailable. '
+            f"Retry after {math.ceil(retry_after_ms)}ms."
+        )
+        self.name = CIRCUIT_OPEN_ERROR
+        self.code = 503
+        self.details = {
+            "functionName": function_name,
+            "retryAfterMs": math.ceil(retry_after_ms),
+        }
+
+
+class AgentShuttingDownError(AgentClientError):
+    """
+    Exception reported for a query that was cancelled because the agent stopped
+    before it finished.
+    """
+
+    def __init__(self, function_name: str) -> None:
+        super().__init__(
+            f'Function "{function_name}" was cancelled: the agent is shutting down.'
+        )
+        self.name = AGENT_SHUTTING_DOWN_ERROR
+        self.code = 503
+        self.details = {"functionName": function_name}
@@ -0,0 +1,60 @@
+import os
+import signal
+import tempfile
+from typing import Optional
+
+
+def read_pid_file(path: str) -> Optional[int]:
+    """
+    Return the pid written in the pid file, or None if there is no valid one.
+    """
+    try:
+        with open(path, "r") as pid_file:
+            return int(pid_file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def take_over_pid_file(path: str) -> Optional[int]:
+    """
+    Write the pid of the current process to the pid file and ask the process it
+    replaces, if it is still running, to drain and exit with SIGTERM. Returns the
+    pid of the signalled process.
+
+    The file is replaced atomically. It must only be used by agents that take over
+    from each other, as any process with the previous pid is signalled.
+    """
+    previous_pid = read_pid_file(path)
+    current_pid = os.getpid()
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as pid_file:
+            pid_file.write(str(current_pid))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    if previous_pid is None or previous_pid == current_pid:
+        return None
+    try:
+        os.kill(previous_pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        # The previous agent already exited, or its pid was reused.
+        return None
+    return previous_pid
+
+
+def release_pid_file(path: str) -> None:
+    """
+    Remove the pid file unless another agent took it over in the meantime.
+    """
+    if read_pid_file(path) != os.getpid():
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -49,3 +49,24 @@ def is_client_error(status: int) -> bool:
     Check if the given HTTP status code indicates a client error.
     """
     return 400 <= status < 500
+
+
+def is_retryable_error(status: int) -> bool:
+    """
+    Check if the given HTTP status code indicates a transient client error, a
+    request timeout or rate limiting, that goes away when the request is retried.
+    """
+    return status in (408, 429)
+
+
+def is_registration_error(status: int) -> bool:
+    """
+    Check if the given HTTP status code indicates that the agent registration was
+    rejected, e.g. a stale versionHash or an expired registration. Authentication
+    and transient errors are not fixed by registering again.
+    """
+    return (
+        is_client_error(status)
+        and status not in (401, 403)
+        and not is_retryable_error(status)
+    )
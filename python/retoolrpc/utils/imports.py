@@ -0,0 +1,62 @@
+import importlib
+import threading
+from typing import Any, Callable, Optional
+
+
+def import_string(import_path: str) -> Any:
+    """
+    Import an object from a string in the `package.module:attribute` format.
+    Nested attributes are supported, e.g. `package.module:Class.method`.
+    """
+    module_path, separator, attribute_path = import_path.partition(":")
+    if not separator or not module_path or not attribute_path:
+        raise ValueError(
+            f'Invalid import path "{import_path}". '
+            'Expected the "package.module:attribute" format.'
+        )
+
+    obj: Any = importlib.import_module(module_path)
+    for attribute in attribute_path.split("."):
+        obj = getattr(obj, attribute)
+    return obj
+
+
+class LazyImplementation:
+    """
+    A function implementation that is imported the first time it is needed, so
+    heavy handler modules do not delay agent registration.
+    """
+
+    def __init__(self, import_path: str) -> None:
+        self.import_path = import_path
+        self.module_name = import_path.partition(":")[0]
+        self._implementation: Optional[Callable[..., Any]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def resolved(self) -> bool:
+        """
+        Whether the implementation has already been imported.
+        """
+        return self._implementation is not None
+
+    def resolve(self) -> Callable[..., Any]:
+        """
+        Import the implementation. Safe to call from several threads at once,
+        the import only happens once.
+        """
+        implementation = self._implementation
+        if implementation is None:
+            with self._lock:
+                implementation = self._implementation
+                if implementation is None:
+                    implementation = import_string(self.import_path)
+                    if not callable(implementation):
+                        raise TypeError(
+                            f'"{self.import_path}" does not refer to a callable.'
+                        )
+                    self._implementation = implementation
+        return implementation
+
+    def __repr__(self) -> str:
+        return f"LazyImplementation({self.import_path!r})"
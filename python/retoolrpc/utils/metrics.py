@@ -0,0 +1,60 @@
+from collections import defaultdict
+from typing import Any, Callable, DefaultDict, Dict, List
+
+# Called with the function name and the phase durations of a query, in ns.
+TimingsHook = Callable[[str, Dict[str, int]], None]
+
+
+class Metrics:
+    """
+    In-memory metrics of the agent, grouped by function name: counters that only
+    go up, e.g. `calls` and `errors`, and gauges that hold the latest value, e.g.
+    the state of a circuit breaker.
+
+    The phase durations of queries add up in `<phase>_ns` counters, e.g.
+    `execute_ns`, and are passed to the hooks added with `add_timings_hook`, e.g.
+    to export them as histograms.
+    """
+
+    def __init__(self) -> None:
+        self._counters: DefaultDict[str, DefaultDict[str, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self._gauges: DefaultDict[str, Dict[str, Any]] = defaultdict(dict)
+        self._timings_hooks: List[TimingsHook] = []
+
+    def increment(self, function_name: str, name: str, value: float = 1) -> None:
+        self._counters[function_name][name] += value
+
+    def set_gauge(self, function_name: str, name: str, value: Any) -> None:
+        self._gauges[function_name][name] = value
+
+    def add_timings_hook(self, hook: TimingsHook) -> None:
+        self._timings_hooks.append(hook)
+
+    def record_timings(self, function_name: str, timings: Dict[str, int]) -> None:
+        counters = self._counters[function_name]
+        for name, value in timings.items():
+            counters[name] += value
+        for hook in self._timings_hooks:
+            hook(function_name, timings)
+
+    def counter(self, function_name: str, name: str) -> float:
+        counters = self._counters.get(function_name)
+        return counters.get(name, 0) if counters else 0
+
+    def gauge(self, function_name: str, name: str) -> Any:
+        gauges = self._gauges.get(function_name)
+        return gauges.get(name) if gauges else None
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Return a copy of all metrics, by function name.
+        """
+        snapshot: Dict[str, Dict[str, Any]] = {}
+        for function_name in {*self._counters, *self._gauges}:
+            snapshot[function_name] = {
+                **self._counters.get(function_name, {}),
+                **self._gauges.get(function_name, {}),
+            }
+        return snapshot
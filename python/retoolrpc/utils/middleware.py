@@ -0,0 +1,69 @@
+import asyncio
+import inspect
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Union
+
+from retoolrpc.utils.types import RetoolContext
+
+
+class FunctionCall:
+    """
+    A call of a registered function, as seen by middlewares. Middlewares can
+    replace the arguments before calling the next middleware, and add entries to
+    `metadata`, which are sent with the response metadata. When the call fails,
+    `metadata` is also set as the `retoolrpc_metadata` attribute of the error.
+    """
+
+    def __init__(
+        self,
+        function_name: str,
+        arguments: Any,
+        context: RetoolContext,
+        query_uuid: Optional[str] = None,
+    ) -> None:
+        self.function_name = function_name
+        self.arguments = arguments
+        self.context = context
+        self.query_uuid = query_uuid
+        self.metadata: Dict[str, Any] = {}
+
+    def __repr__(self) -> str:
+        return f"FunctionCall({self.function_name!r}, query_uuid={self.query_uuid!r})"
+
+
+# The attribute of an error raised by a call that holds the metadata of the call.
+ERROR_METADATA_ATTRIBUTE = "retoolrpc_metadata"
+
+# Calls the rest of the pipeline, down to the implementation.
+CallNext = Callable[[FunctionCall], Awaitable[Any]]
+
+# A middleware receives the call and the rest of the pipeline. Async middlewares
+# await `call_next(call)` and can act on its result. Sync middlewares can inspect
+# or change the call and return `call_next(call)`, which is awaited for them.
+Middleware = Callable[[FunctionCall, CallNext], Union[Any, Awaitable[Any]]]
+
+
+def _link(middleware: Middleware, call_next: CallNext) -> CallNext:
+    if asyncio.iscoroutinefunction(middleware) or asyncio.iscoroutinefunction(
+        getattr(middleware, "__call__", None)
+    ):
+        # The middleware returns a coroutine, no wrapper frame is needed.
+        return lambda call: middleware(call, call_next)
+
+    async def call_sync_middleware(call: FunctionCall) -> Any:
+        result = middleware(call, call_next)
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+    return call_sync_middleware
+
+
+def compose(middlewares: Sequence[Middleware], handler: CallNext) -> CallNext:
+    """
+    Chain middlewares around a handler, the first middleware being the outermost.
+    The chain is built once, so a call only goes through one frame per middleware.
+    """
+    call_next = handler
+    for middleware in reversed(middlewares):
+        call_next = _link(middleware, call_next)
+    return call_next
@@ -1,5 +1,6 @@
+import asyncio
 import time
-from typing import Awaitable, Callable
+from typing import Awaitable, Callable, Optional, Union
 
 from retoolrpc.utils.logger import Logger
 from retoolrpc.utils.types import AgentServerStatus
@@ -8,32 +9,63 @@ CONNECTION_ERROR_INITIAL_TIMEOUT_MS = 50  # 50 milliseconds
 CONNECTION_ERROR_RETRY_MAX_MS = 1000 * 60 * 10  # 10 minutes
 
 
+class LoopState:
+    """
+    The progress of a loop_with_backoff, updated on every iteration so it can be
+    reported while the loop runs.
+    """
+
+    def __init__(self) -> None:
+        self.consecutive_errors = 0
+        self.last_error: Optional[str] = None
+        # The delay the loop is currently backing off for, 0 when it is healthy.
+        self.backoff_delay_ms = 0
+
+
 async def loop_with_backoff(
-    polling_interval_ms: int,
+    polling_interval_ms: Union[int, Callable[[], int]],
     logger: Logger,
     callback: Callable[[], Awaitable[AgentServerStatus]],
+    state: Optional[LoopState] = None,
 ) -> AgentServerStatus:
+    """
+    Run the callback until it stops returning "continue", backing off on errors.
+    The polling interval can be a callable to let the callback decide how long to
+    wait before the next iteration. The optional state is updated as the loop runs.
+    """
+    state = state or LoopState()
+    get_polling_interval_ms = (
+        polling_interval_ms
+        if callable(polling_interval_ms)
+        else lambda: polling_interval_ms
+    )
     delay_time_ms = CONNECTION_ERROR_INITIAL_TIMEOUT_MS
     last_loop_timestamp = time.time() * 1000  # Convert seconds to ms
 
     while True:
         try:
             result = await callback()
+            state.consecutive_errors = 0
+            state.backoff_delay_ms = 0
 
+            current_polling_interval_ms = get_polling_interval_ms()
             current_timestamp = time.time() * 1000  # Convert seconds to ms
             loop_duration_ms = current_timestamp - last_loop_timestamp
             last_loop_timestamp = current_timestamp
             logger.debug(
                 f"Loop time: {int(loop_duration_ms)}ms, delay time: {delay_time_ms}ms, "
-                f"polling interval: {polling_interval_ms}ms"
+                f"polling interval: {current_polling_interval_ms}ms"
             )
 
             if result != "continue":
                 return result
 
-            time.sleep(polling_interval_ms / 1000)
+            await asyncio.sleep(current_polling_interval_ms / 1000)
             delay_time_ms = max(delay_time_ms // 2, CONNECTION_ERROR_INITIAL_TIMEOUT_MS)
         except Exception as err:
             logger.error(f"Error running RPC agent: {str(err)}")
-            time.sleep(delay_time_ms / 1000)
+            state.consecutive_errors += 1
+            state.last_error = str(err)
+            state.backoff_delay_ms = delay_time_ms
+            await asyncio.sleep(delay_time_ms / 1000)
             delay_time_ms = min(delay_time_ms * 2, CONNECTION_ERROR_RETRY_MAX_MS)
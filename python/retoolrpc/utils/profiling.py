@@ -0,0 +1,150 @@
+import asyncio
+import cProfile
+import os
+import random
+import re
+import tracemalloc
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from retoolrpc.utils.logger import Logger
+from retoolrpc.utils.types import ProfilingConfig
+
+DEFAULT_PROFILE_MODE = "cprofile"
+DEFAULT_TRACEMALLOC_FRAMES = 25
+
+
+def _sanitize_file_component(value: str) -> str:
+    """
+    Replace characters that are not safe to use in a file name.
+    """
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", value) or "_"
+
+
+class Profiler:
+    """
+    Captures cProfile stats and/or tracemalloc snapshots for a sampled subset of
+    function executions, and writes them to the configured output directory.
+    """
+
+    def __init__(self, config: ProfilingConfig, logger: Logger) -> None:
+        self._output_dir = config.output_dir
+        self._sample_rate = config.sample_rate or 0.0
+        self._function_names = set(config.function_names or [])
+        mode = config.mode or DEFAULT_PROFILE_MODE
+        self._use_cprofile = mode in ("cprofile", "both")
+        self._use_tracemalloc = mode in ("tracemalloc", "both")
+        self._tracemalloc_frames = (
+            config.tracemalloc_frames or DEFAULT_TRACEMALLOC_FRAMES
+        )
+        self._toggle_signal = config.toggle_signal
+        self._signal_handler_installed = False
+        self._logger = logger
+        self.enabled = bool(config.enabled)
+
+    def toggle(self) -> bool:
+        """
+        Flip the profiler on or off and return the new state.
+        """
+        self.enabled = not self.enabled
+        self._logger.info(
+            f"Profiling {'enabled' if self.enabled else 'disabled'} "
+            f"(output directory: {self._output_dir})"
+        )
+        return self.enabled
+
+    def install_signal_handler(self) -> bool:
+        """
+        Toggle profiling whenever the process receives the configured signal.
+        Returns False if no signal is configured or signal handlers are not
+        supported in the running event loop.
+        """
+        if self._toggle_signal is None:
+            return False
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                self._toggle_signal, self.toggle
+            )
+        except (NotImplementedError, RuntimeError, ValueError):
+            return False
+        self._signal_handler_installed = True
+        return True
+
+    def remove_signal_handler(self) -> None:
+        """
+        Remove the handler installed by `install_signal_handler`, if any.
+        """
+        if not self._signal_handler_installed or self._toggle_signal is None:
+            return
+        asyncio.get_running_loop().remove_signal_handler(self._toggle_signal)
+        self._signal_handler_installed = False
+
+    def should_profile(self, function_name: str) -> bool:
+        """
+        Decide whether the current execution of the given function is profiled.
+        Explicitly listed functions are always profiled, others are sampled.
+        """
+        if not self.enabled:
+            return False
+        if function_name in self._function_names:
+            return True
+        return self._sample_rate > 0 and random.random() < self._sample_rate
+
+    @contextmanager
+    def profile(self, function_name: str, query_uuid: Optional[str]) -> Iterator[None]:
+        """
+        Profile the wrapped block and dump the results tagged with the query UUID
+        and function name. cProfile only observes the current thread, so other
+        coroutines running concurrently on the event loop are included as well.
+        """
+        profile: Optional[cProfile.Profile] = None
+        started_tracemalloc = False
+        if self._use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(self._tracemalloc_frames)
+            started_tracemalloc = True
+        if self._use_cprofile:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already active, e.g. an overlapping query.
+                profile = None
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            snapshot = tracemalloc.take_snapshot() if self._use_tracemalloc else None
+            if started_tracemalloc:
+                tracemalloc.stop()
+
+            try:
+                self._dump(function_name, query_uuid, profile, snapshot)
+            except OSError as err:
+                self._logger.error(f"Error writing profile: {str(err)}")
+
+    def _dump(
+        self,
+        function_name: str,
+        query_uuid: Optional[str],
+        profile: Optional[cProfile.Profile],
+        snapshot: Optional[tracemalloc.Snapshot],
+    ) -> List[str]:
+        os.makedirs(self._output_dir, exist_ok=True)
+        base_name = os.path.join(
+            self._output_dir,
+            f"{_sanitize_file_component(function_name)}"
+            f"-{_sanitize_file_component(query_uuid or 'local')}",
+        )
+
+        written = []
+        if profile is not None:
+            profile.dump_stats(f"{base_name}.prof")
+            written.append(f"{base_name}.prof")
+        if snapshot is not None:
+            snapshot.dump(f"{base_name}.tracemalloc")
+            written.append(f"{base_name}.tracemalloc")
+
+        self._logger.debug("Profile written: ", written)
+        return written
@@ -0,0 +1,101 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Literal, Optional, Tuple
+
+from retoolrpc.utils.errors import RateLimitExceededError
+from retoolrpc.utils.middleware import CallNext, FunctionCall
+
+DEFAULT_MAX_KEYS = 10000
+
+RateLimitKey = Literal["user_email", "organization_name"]
+
+# Retool sends the context with camelCase keys.
+CONTEXT_KEYS = {
+    "user_email": ("userEmail", "user_email"),
+    "organization_name": ("organizationName", "organization_name"),
+}
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens: float, updated_at: float) -> None:
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class RateLimiter:
+    """
+    A token bucket rate limiter middleware. Every function it wraps gets its own
+    buckets, one per user email or organization name from the context, or a single
+    one if `key` is None.
+
+    A call that finds the bucket empty waits for a token if it would get one within
+    `max_wait_ms`, and fails with a RateLimitExceededError otherwise. Waiting calls
+    take their token upfront, so they are served in order.
+
+    At most `max_keys` buckets are kept. The least recently used bucket is dropped
+    first, and starts full if its key calls again.
+    """
+
+    def __init__(
+        self,
+        rate_per_second: float,
+        burst: Optional[int] = None,
+        key: Optional[RateLimitKey] = None,
+        max_wait_ms: int = 0,
+        max_keys: int = DEFAULT_MAX_KEYS,
+    ) -> None:
+        if rate_per_second <= 0:
+            raise ValueError("rate_per_second must be positive.")
+        self._rate = rate_per_second
+        self._burst = burst or max(1, math.ceil(rate_per_second))
+        self._key = key
+        self._max_wait_ms = max_wait_ms
+        self._max_keys = max_keys
+        self._buckets: "OrderedDict[Tuple[str, Any], _Bucket]" = OrderedDict()
+
+    def _bucket(self, bucket_key: Tuple[str, Any], now: float) -> _Bucket:
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = _Bucket(self._burst, now)
+            self._buckets[bucket_key] = bucket
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(bucket_key)
+            bucket.tokens = min(
+                self._burst, bucket.tokens + (now - bucket.updated_at) * self._rate
+            )
+            bucket.updated_at = now
+        return bucket
+
+    def acquire_delay_ms(self, function_name: str, key_value: Any) -> float:
+        """
+        Take a token for a call and return how long the call has to wait for it, in
+        milliseconds. Raises RateLimitExceededError, without taking a token, if the
+        wait would be longer than `max_wait_ms`.
+        """
+        bucket = self._bucket((function_name, key_value), time.monotonic())
+        delay_ms = max(0.0, (1 - bucket.tokens) / self._rate * 1000)
+        if delay_ms > self._max_wait_ms:
+            raise RateLimitExceededError(function_name, key_value, delay_ms)
+        bucket.tokens -= 1
+        return delay_ms
+
+    def _key_value(self, context: Any) -> Any:
+        if not self._key or not context:
+            return None
+        for name in CONTEXT_KEYS[self._key]:
+            if context.get(name) is not None:
+                return context[name]
+        return None
+
+    async def __call__(self, call: FunctionCall, call_next: CallNext) -> Any:
+        key_value = self._key_value(call.context)
+        delay_ms = self.acquire_delay_ms(call.function_name, key_value)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+        return await call_next(call)
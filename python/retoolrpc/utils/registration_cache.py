@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+
+def hash_operations(operations: Dict[str, Any]) -> str:
+    """
+    Compute a stable hash of the operations metadata sent to registerAgent.
+    """
+    encoded = json.dumps(
+        operations, sort_keys=True, separators=(",", ":"), default=str
+    ).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class RegistrationCache:
+    """
+    A small file cache of registerAgent results, keyed by host, resource,
+    environment, version and agent UUID, as the versionHash is registered for the
+    agent UUID. Lets a restarted agent reuse its versionHash without registering
+    again when its operations have not changed.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        host_url: str,
+        resource_id: str,
+        environment_name: str,
+        version: str,
+        agent_uuid: str,
+    ) -> None:
+        key = hashlib.sha256(
+            "\n".join(
+                [host_url, resource_id, environment_name, version, agent_uuid]
+            ).encode()
+        ).hexdigest()
+        self._cache_dir = cache_dir
+        self._path = os.path.join(cache_dir, f"registration-{key[:32]}.json")
+
+    def get(self, operations_hash: str) -> Optional[str]:
+        """
+        Return the cached versionHash if it was registered for the same operations.
+        """
+        try:
+            with open(self._path, "r") as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if (
+            not isinstance(entry, dict)
+            or entry.get("operationsHash") != operations_hash
+        ):
+            return None
+        version_hash = entry.get("versionHash")
+        return version_hash if isinstance(version_hash, str) else None
+
+    def set(self, operations_hash: str, version_hash: str) -> None:
+        """
+        Store the versionHash returned by registerAgent. The file is replaced
+        atomically so concurrent agents never read a partial entry.
+        """
+        os.makedirs(self._cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump(
+                    {"operationsHash": operations_hash, "versionHash": version_hash},
+                    cache_file,
+                )
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def invalidate(self) -> None:
+        """
+        Remove the cached entry, e.g. after the server rejected the versionHash.
+        """
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
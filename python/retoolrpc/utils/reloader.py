@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sys
+from typing import Callable, Dict, Iterable, List, Optional
+
+from retoolrpc.utils.logger import Logger
+
+DEFAULT_RELOAD_INTERVAL_MS = 1000
+
+
+def _module_file(module_name: str) -> Optional[str]:
+    module = sys.modules.get(module_name)
+    module_file = getattr(module, "__file__", None)
+    return module_file if isinstance(module_file, str) else None
+
+
+def _modification_time(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class ModuleWatcher:
+    """
+    Polls the source files of imported modules and reports the modules whose files
+    changed. Polling avoids a dependency on platform specific file watching APIs.
+    """
+
+    def __init__(
+        self,
+        logger: Logger,
+        on_change: Callable[[List[str]], None],
+        interval_ms: int = DEFAULT_RELOAD_INTERVAL_MS,
+    ) -> None:
+        self._logger = logger
+        self._on_change = on_change
+        self._interval_ms = interval_ms
+        self._modification_times: Dict[str, Optional[float]] = {}
+
+    def watch(self, module_names: Iterable[str]) -> None:
+        """
+        Start watching the given modules. Modules that are not imported yet, or are
+        not backed by a file, are picked up once they are.
+        """
+        for module_name in module_names:
+            if module_name in self._modification_times:
+                continue
+            module_file = _module_file(module_name)
+            self._modification_times[module_name] = (
+                _modification_time(module_file) if module_file else None
+            )
+
+    def check(self) -> List[str]:
+        """
+        Return the watched modules whose files changed since the last check.
+        """
+        changed = []
+        for module_name, last_modified in self._modification_times.items():
+            module_file = _module_file(module_name)
+            if module_file is None:
+                continue
+
+            modified = _modification_time(module_file)
+            if last_modified is not None and modified != last_modified:
+                changed.append(module_name)
+            self._modification_times[module_name] = modified
+        return changed
+
+    async def run(self) -> None:
+        """
+        Check for changes periodically until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self._interval_ms / 1000)
+            try:
+                changed = self.check()
+                if changed:
+                    self._on_change(changed)
+            except Exception as err:
+                self._logger.error(f"Error reloading modules: {str(err)}")
@@ -0,0 +1,118 @@
+import asyncio
+import inspect
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+from retoolrpc.utils.logger import Logger
+
+# Creates a resource, e.g. a database pool. Can be a coroutine function.
+ResourceFactory = Callable[[], Union[Any, Awaitable[Any]]]
+# Closes a resource created by its factory. Can be a coroutine function.
+ResourceCloser = Callable[[Any], Union[Any, Awaitable[Any]]]
+
+
+class _Resource:
+    __slots__ = ("factory", "closer", "value", "pid", "lock", "lock_pid")
+
+    def __init__(self, factory: ResourceFactory, closer: Optional[ResourceCloser]):
+        self.factory = factory
+        self.closer = closer
+        self.value: Any = None
+        # The process the value was created in, None until it is created.
+        self.pid: Optional[int] = None
+        self.lock: Optional[asyncio.Lock] = None
+        self.lock_pid: Optional[int] = None
+
+
+async def _maybe_await(value: Any) -> Any:
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class Resources:
+    """
+    Long-lived resources of the functions of an agent, e.g. database pools or HTTP
+    clients, so they are not created for every call.
+
+    Resources are created by their factory when the agent starts listening, or on
+    first use, e.g. when a function is called without a listening agent. Functions
+    list the resources they use in their `resources` option and get them as
+    keyword arguments. A process forked from the agent, e.g. a worker, creates its
+    own resources on first use: connections inherited from the parent are neither
+    used nor closed. Resources are closed when the agent stops, in reverse order of
+    creation, with their closer, or else with their `aclose` or `close` method.
+    """
+
+    def __init__(self, logger: Logger) -> None:
+        self._logger = logger
+        self._resources: Dict[str, _Resource] = {}
+        self._created: List[str] = []
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._resources
+
+    def add(
+        self,
+        name: str,
+        factory: ResourceFactory,
+        close: Optional[ResourceCloser] = None,
+    ) -> None:
+        if name in self._resources:
+            raise ValueError(f'Resource "{name}" is already added.')
+        self._resources[name] = _Resource(factory, close)
+
+    async def get(self, name: str) -> Any:
+        """
+        Return the resource of this process, creating it if needed.
+        """
+        resource = self._resources.get(name)
+        if resource is None:
+            raise ValueError(f'Resource "{name}" is not added.')
+        pid = os.getpid()
+        if resource.pid == pid:
+            return resource.value
+
+        if resource.lock is None or resource.lock_pid != pid:
+            resource.lock, resource.lock_pid = asyncio.Lock(), pid
+        # Concurrent first uses wait for a single creation.
+        async with resource.lock:
+            if resource.pid != pid:
+                resource.value = await _maybe_await(resource.factory())
+                resource.pid = pid
+                if name in self._created:
+                    self._created.remove(name)
+                self._created.append(name)
+                self._logger.debug(f"Created resource {name}")
+        return resource.value
+
+    async def start(self) -> None:
+        """
+        Create the resources that this process has not created yet.
+        """
+        for name in self._resources:
+            await self.get(name)
+
+    async def close(self) -> None:
+        """
+        Close the resources created by this process. They are created again when
+        they are next used.
+        """
+        pid = os.getpid()
+        for name in reversed(self._created):
+            resource = self._resources[name]
+            if resource.pid != pid:
+                continue
+            value, resource.value, resource.pid = resource.value, None, None
+            resource.lock = None
+            try:
+                if resource.closer is not None:
+                    await _maybe_await(resource.closer(value))
+                elif hasattr(value, "aclose"):
+                    await _maybe_await(value.aclose())
+                elif hasattr(value, "close"):
+                    await _maybe_await(value.close())
+            except Exception as err:
+                # Other resources are still closed.
+                self._logger.warn(f"Error closing resource {name}: {str(err)}")
+        self._created = []
@@ -0,0 +1,137 @@
+from dataclasses import dataclass
+from typing import Any, Dict, Literal, Optional
+
+from retoolrpc.utils.serialization import dumps
+from retoolrpc.utils.types import AgentServerError
+from retoolrpc.version import __version__
+
+
+@dataclass(slots=True)
+class QueryTimings:
+    """
+    Durations of the phases of a query, in nanoseconds from `time.perf_counter_ns`:
+    decoding the popQuery response, parsing the arguments, running the function
+    (with its middlewares), encoding the result, and encoding and posting the
+    response. With lazy arguments, parsing happens while the function runs.
+    """
+
+    decode_ns: int = 0
+    parse_ns: int = 0
+    execute_ns: int = 0
+    serialize_ns: int = 0
+    post_ns: int = 0
+
+    def as_metadata(self) -> Dict[str, int]:
+        """
+        The timings sent with the response, which is posted after they are taken:
+        all but the post duration.
+        """
+        return {
+            "decodeNs": self.decode_ns,
+            "parseNs": self.parse_ns,
+            "executeNs": self.execute_ns,
+            "serializeNs": self.serialize_ns,
+        }
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "decode_ns": self.decode_ns,
+            "parse_ns": self.parse_ns,
+            "execute_ns": self.execute_ns,
+            "serialize_ns": self.serialize_ns,
+            "post_ns": self.post_ns,
+        }
+
+
+@dataclass(slots=True)
+class ExecutionResult:
+    """
+    The result of a function execution, with the arguments it was called with.
+    """
+
+    result: Any
+    arguments: Any
+    # Entries added by middlewares, sent with the response metadata.
+    metadata: Optional[Dict[str, Any]] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        if self.metadata is None:
+            return {"result": self.result, "arguments": self.arguments}
+        return {
+            "result": self.result,
+            "arguments": self.arguments,
+            "metadata": self.metadata,
+        }
+
+
+@dataclass(slots=True)
+class QueryResponse:
+    """
+    The fields of a postQueryResponse request that change with every query.
+    """
+
+    query_uuid: str
+    status: Literal["success", "error"]
+    data: Any
+    error: Optional[AgentServerError]
+    received_at: str
+    finished_at: str
+    parameters: Optional[Dict[str, Any]]
+    # Set for tabular and binary results.
+    result_format: Optional[str] = None
+    truncated: bool = False
+    # Entries added by middlewares.
+    extra_metadata: Optional[Dict[str, Any]] = None
+    timings: Optional[QueryTimings] = None
+
+
+class ResponseEnvelope:
+    """
+    Encodes postQueryResponse bodies, in the PostQueryResponseRequest format. The
+    fields that are the same for every query, such as the resource and agent, are
+    kept from the start of the agent.
+
+    The body is encoded with a single dumps call: splicing a pre-serialized
+    envelope with the serialized fields of the query costs more with orjson, as
+    every dumps call allocates its own output buffer and the parts are copied
+    again when joined.
+    """
+
+    def __init__(
+        self, resource_id: str, environment_name: str, agent_uuid: str
+    ) -> None:
+        self._resource_id = resource_id
+        self._environment_name = environment_name
+        self._agent_uuid = agent_uuid
+
+    def encode(self, response: QueryResponse, version_hash: Optional[str]) -> bytes:
+        # Entries added by middlewares come first, so they cannot overwrite the
+        # entries of the agent.
+        metadata: Dict[str, Any] = dict(response.extra_metadata or ())
+        metadata.update(
+            packageLanguage="python",
+            packageVersion=__version__,
+            agentReceivedQueryAt=response.received_at,
+            agentFinishedQueryAt=response.finished_at,
+            parameters=response.parameters,
+        )
+        if response.result_format is not None:
+            metadata["resultFormat"] = response.result_format
+        if response.truncated:
+            metadata["truncated"] = True
+        if response.timings is not None:
+            metadata["timings"] = response.timings.as_metadata()
+
+        return dumps(
+            {
+                "resourceId": self._resource_id,
+                "environmentName": self._environment_name,
+                "versionHash": version_hash,
+                "agentUuid": self._agent_uuid,
+                "queryUuid": response.query_uuid,
+                "metadata": metadata,
+                "status": response.status,
+                "data": response.data,
+                "error": response.error,
+            }
+        )
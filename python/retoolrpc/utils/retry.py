@@ -0,0 +1,72 @@
+import asyncio
+import random
+import time
+from typing import Any, Optional
+
+from retoolrpc.utils.middleware import CallNext, FunctionCall
+from retoolrpc.utils.types import RetryPolicy
+
+
+def backoff_ms(policy: RetryPolicy, attempt: int) -> float:
+    """
+    Return a random backoff before the retry that follows the given attempt.
+    """
+    ceiling = min(
+        policy.max_backoff_ms,
+        policy.initial_backoff_ms * policy.backoff_multiplier ** (attempt - 1),
+    )
+    return random.uniform(0, ceiling)
+
+
+class RetryMiddleware:
+    """
+    Retries a function on the retryable errors of its policy, and enforces its
+    timeout over all attempts. Without a policy, only the timeout applies. The
+    number of attempts is reported as `attempts` in the response metadata, also
+    when the call fails.
+    """
+
+    def __init__(
+        self, policy: Optional[RetryPolicy], timeout_ms: Optional[int] = None
+    ) -> None:
+        self._policy = policy
+        self._timeout_ms = timeout_ms
+
+    async def __call__(self, call: FunctionCall, call_next: CallNext) -> Any:
+        deadline = (
+            time.monotonic() + self._timeout_ms / 1000 if self._timeout_ms else None
+        )
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if deadline is None:
+                    return await call_next(call)
+                try:
+                    return await asyncio.wait_for(
+                        call_next(call), max(0.0, deadline - time.monotonic())
+                    )
+                except asyncio.TimeoutError as err:
+                    raise TimeoutError(
+                        f'Function "{call.function_name}" timed out after '
+                        f"{self._timeout_ms}ms."
+                    ) from err
+            except Exception as err:
+                policy = self._policy
+                if (
+                    policy is None
+                    or attempt >= policy.max_attempts
+                    or not isinstance(err, policy.retryable_exceptions)
+                ):
+                    raise
+
+                delay_ms = backoff_ms(policy, attempt)
+                if deadline is not None and (
+                    time.monotonic() + delay_ms / 1000 >= deadline
+                ):
+                    raise
+            finally:
+                if self._policy is not None:
+                    call.metadata["attempts"] = attempt
+
+            await asyncio.sleep(delay_ms / 1000)
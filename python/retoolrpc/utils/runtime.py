@@ -0,0 +1,71 @@
+import asyncio
+import sys
+from typing import Any, Callable, Coroutine, Optional, Union
+
+from retoolrpc.rpc import RetoolRPC
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None  # type: ignore[assignment]
+
+
+def run(
+    main: Union[RetoolRPC, Coroutine[Any, Any, Any]],
+    use_uvloop: Optional[bool] = None,
+    eager_tasks: bool = True,
+) -> Any:
+    """
+    Run an agent, or a coroutine that runs one, in a new event loop until it
+    returns, like `asyncio.run`.
+
+    The loop is a uvloop loop if uvloop is installed, or always or never when
+    `use_uvloop` is True or False. On Python 3.12+ tasks are started eagerly with
+    `eager_tasks`: a task that completes without suspending is never scheduled on
+    the loop. The agent awaits queries inline, so this applies to the tasks that
+    handlers create, e.g. with `asyncio.gather`.
+    """
+    coroutine = main.listen() if isinstance(main, RetoolRPC) else main
+    if use_uvloop and uvloop is None:
+        coroutine.close()
+        raise ImportError("uvloop is not installed, install it or set use_uvloop.")
+    loop_factory: Optional[Callable[[], asyncio.AbstractEventLoop]] = (
+        uvloop.new_event_loop
+        if uvloop is not None and use_uvloop is not False
+        else None
+    )
+
+    if sys.version_info < (3, 11):  # pragma: no cover
+        # No asyncio.Runner, and uvloop.install would replace the event loop policy
+        # of the whole process.
+        if loop_factory is None:
+            return asyncio.run(coroutine)
+        return _run_in_loop(loop_factory(), coroutine)
+
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        eager_task_factory = getattr(asyncio, "eager_task_factory", None)
+        if eager_tasks and eager_task_factory is not None:
+            runner.get_loop().set_task_factory(eager_task_factory)
+        return runner.run(coroutine)
+
+
+def _run_in_loop(
+    loop: asyncio.AbstractEventLoop, coroutine: Coroutine[Any, Any, Any]
+) -> Any:
+    """
+    Run a coroutine in the given loop like `asyncio.run`, then close the loop.
+    """
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from retoolrpc.utils.errors import InvalidArgumentsError
 from retoolrpc.utils.helpers import (
@@ -22,47 +22,56 @@ class ArgumentParser:
 
         for arg_name, arg_definition in self.schema.items():
             arg_value = arguments_to_parse.get(arg_name)
-            falsy_arg_value = is_falsy_argument_value(arg_value)
-
-            if falsy_arg_value and arg_definition["required"]:
-                parsed_errors.append(f'Argument "{arg_name}" is required but missing.')
-                continue
-
-            if not falsy_arg_value:
-                if arg_definition["array"]:
-                    if not isinstance(arg_value, list):
-                        parsed_errors.append(
-                            f'Argument "{arg_name}" should be an array.'
-                        )
-                        continue
-
-                    parse_value_type_items = [
-                        self.parse_value_type(item, arg_definition["type"])
-                        for item in arg_value
-                    ]
-                    if not all(item[0] for item in parse_value_type_items):
-                        parsed_errors.append(
-                            f'Argument "{arg_name}" should be an array of type '
-                            f'"{arg_definition["type"]}".'
-                        )
-
-                    parsed_arguments[arg_name] = [
-                        item[1] for item in parse_value_type_items
-                    ]
-                else:
-                    is_valid_type, parsed_value = self.parse_value_type(
-                        arg_value, arg_definition["type"]
+            if is_falsy_argument_value(arg_value):
+                if arg_definition["required"]:
+                    parsed_errors.append(
+                        f'Argument "{arg_name}" is required but missing.'
                     )
-                    if not is_valid_type:
-                        parsed_errors.append(
-                            f'Argument "{arg_name}" should be of type '
-                            f'"{arg_definition["type"]}".'
-                        )
+                continue
 
-                    parsed_arguments[arg_name] = parsed_value
+            parsed_value, parsed_error = self.parse_argument(arg_name, arg_value)
+            if parsed_error is not None:
+                parsed_errors.append(parsed_error)
+                if parsed_value is None:
+                    continue
+            parsed_arguments[arg_name] = parsed_value
 
         return parsed_arguments, parsed_errors
 
+    def parse_argument(
+        self, arg_name: str, arg_value: Any
+    ) -> Tuple[Any, Optional[str]]:
+        """
+        Parse a single argument that is not missing. Returns the parsed value and
+        an error message if it is invalid.
+        """
+        arg_definition = self.schema[arg_name]
+        if arg_definition["array"]:
+            if not isinstance(arg_value, list):
+                return None, f'Argument "{arg_name}" should be an array.'
+
+            parse_value_type_items = [
+                self.parse_value_type(item, arg_definition["type"])
+                for item in arg_value
+            ]
+            parsed_value = [item[1] for item in parse_value_type_items]
+            if not all(item[0] for item in parse_value_type_items):
+                return parsed_value, (
+                    f'Argument "{arg_name}" should be an array of type '
+                    f'"{arg_definition["type"]}".'
+                )
+            return parsed_value, None
+
+        is_valid_type, parsed_value = self.parse_value_type(
+            arg_value, arg_definition["type"]
+        )
+        if not is_valid_type:
+            return parsed_value, (
+                f'Argument "{arg_name}" should be of type '
+                f'"{arg_definition["type"]}".'
+            )
+        return parsed_value, None
+
     def parse_value_type(
         self, value: Any, expected_type: ArgumentType
     ) -> Tuple[bool, Any]:
@@ -0,0 +1,216 @@
+import dataclasses
+import datetime
+import decimal
+import enum
+import json
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+# orjson encodes dataclasses and dates itself, in its own way: have it pass them to
+# `_default` like the json module does.
+_ORJSON_OPTIONS = (
+    (
+        orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+    )
+    if orjson is not None
+    else 0
+)
+
+
+def _default(value: Any) -> Any:
+    """
+    Encode values the JSON encoders do not support natively, e.g. numpy scalars
+    and arrays, decimals and dates. Both encoders use it for the same types, so the
+    output does not depend on whether orjson is installed.
+    """
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {
+            field.name: getattr(value, field.name)
+            for field in dataclasses.fields(value)
+        }
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Serialize a value to JSON bytes, using orjson when it is installed.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=_default, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # e.g. integers larger than 64 bits, which the json module supports.
+            pass
+    return json.dumps(
+        value, default=_default, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+def loads(content: bytes) -> Any:
+    """
+    Deserialize JSON bytes, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _is_data_frame(value: Any) -> bool:
+    return hasattr(value, "columns") and hasattr(value, "to_dict")
+
+
+def _is_record_array(value: Any) -> bool:
+    return getattr(getattr(value, "dtype", None), "names", None) is not None
+
+
+def _column_values(values: Any) -> List[Any]:
+    return values.tolist() if hasattr(values, "tolist") else list(values)
+
+
+def to_columns(result: Any, columnar: bool = False) -> Optional[Dict[str, List[Any]]]:
+    """
+    Return the columns of a tabular result, or None if the result is not tabular.
+    Pandas data frames and numpy record arrays are always tabular. A dict of
+    equally long lists is only treated as columns if the function declared
+    columnar results.
+    """
+    if _is_data_frame(result):
+        return {str(name): _column_values(result[name]) for name in result.columns}
+    if _is_record_array(result):
+        return {name: _column_values(result[name]) for name in result.dtype.names}
+    if columnar and isinstance(result, dict):
+        columns = {str(name): _column_values(values) for name, values in result.items()}
+        if len({len(values) for values in columns.values()}) <= 1:
+            return columns
+    return None
+
+
+def columns_to_rows(columns: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """
+    Convert columns to the list of row dicts handlers usually return.
+    """
+    names = list(columns.keys())
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+
+def encode_result(
+    result: Any, columnar: bool, result_format: str
+) -> Tuple[Any, Optional[str]]:
+    """
+    Encode a function result for postQueryResponse. Tabular results are sent as
+    `{"columns": [...], "data": [[column values], ...]}` when the server accepts the
+    columnar format, which stores every column name once, and as a list of row dicts
+    otherwise. Returns the encoded result and its format, None for plain results.
+    """
+    columns = to_columns(result, columnar)
+    if columns is None:
+        return result, None
+    if result_format == "columnar":
+        return {"columns": list(columns.keys()), "data": list(columns.values())}, (
+            "columnar"
+        )
+    return columns_to_rows(columns), "rows"
+
+
+def _dict_items(value: Dict[Any, Any]) -> Iterator[Any]:
+    for key, item in value.items():
+        yield str(key)
+        yield item
+
+
+def _encoded_length(text: str) -> int:
+    # Both encoders write UTF-8, where characters outside ASCII take 2 to 4 bytes.
+    return len(text) if text.isascii() else len(text.encode("utf-8", "surrogatepass"))
+
+
+def estimate_size(value: Any, limit: Optional[int] = None) -> int:
+    """
+    Estimate the size of the JSON encoding of a value in bytes, without encoding
+    it. The value is walked lazily and the walk stops as soon as the estimate
+    exceeds `limit`, in which case the returned size is only a lower bound.
+    """
+    size = 0
+    stack: List[Iterator[Any]] = [iter((value,))]
+    while stack:
+        try:
+            item = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+
+        if isinstance(item, str):
+            size += _encoded_length(item) + 3  # Quotes and a separator
+        elif item is None or isinstance(item, bool):
+            size += 6
+        elif isinstance(item, (int, float)):
+            size += len(repr(item)) + 1
+        elif isinstance(item, dict):
+            size += 2
+            stack.append(_dict_items(item))
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            size += 2
+            stack.append(iter(item))
+        elif hasattr(item, "tolist"):
+            # Every element of an array takes at least a digit and a separator: an
+            # array that cannot fit is not converted.
+            element_count = getattr(item, "size", None)
+            if (
+                limit is not None
+                and isinstance(element_count, int)
+                and size + 2 * element_count > limit
+            ):
+                size += 2 * element_count
+            else:
+                stack.append(iter((item.tolist(),)))
+        else:
+            size += _encoded_length(str(item)) + 3
+
+        if limit is not None and size > limit:
+            break
+    return size
+
+
+def truncate_result(value: Any, limit: int) -> Optional[Any]:
+    """
+    Return the longest prefix of a list of rows, or of the rows of a columnar
+    result, whose estimated size fits in `limit`. Returns None for results that
+    are not lists of rows.
+    """
+    if isinstance(value, list):
+        size = 2
+        for index, row in enumerate(value):
+            size += estimate_size(row, limit - size)
+            if size > limit:
+                return value[:index]
+        return value
+
+    if isinstance(value, dict) and set(value) == {"columns", "data"}:
+        columns = value["data"]
+        size = estimate_size(value["columns"]) + 20
+        for index, row in enumerate(zip(*columns)):
+            size += estimate_size(row, limit - size)
+            if size > limit:
+                return {
+                    "columns": value["columns"],
+                    "data": [column[:index] for column in columns],
+                }
+        return value
+
+    return None
@@ -0,0 +1,129 @@
+import asyncio
+import os
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from retoolrpc.utils.logger import Logger
+from retoolrpc.utils.serialization import dumps
+from retoolrpc.utils.types import StatusServerConfig
+
+# Requests are a request line and a few headers, anything larger is rejected.
+MAX_REQUEST_BYTES = 8192
+READ_TIMEOUT_S = 5
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    503: "Service Unavailable",
+}
+
+
+class StatusServer:
+    """
+    A minimal HTTP server that reports the state of the agent on `/healthz`,
+    `/readyz` and `/status`. It runs in the event loop of the agent and only reads
+    state the agent already keeps, so it does not slow down polling.
+
+    `/healthz` answers as long as the event loop is responsive. `/readyz` answers
+    200 when the agent is registered, polling without errors and not draining, and
+    503 otherwise. Both return the same JSON body as `/status`.
+    """
+
+    def __init__(
+        self,
+        config: StatusServerConfig,
+        get_status: Callable[[], Dict[str, Any]],
+        logger: Logger,
+    ) -> None:
+        self._config = config
+        self._get_status = get_status
+        self._logger = logger
+        self._server: Optional[asyncio.Server] = None
+
+    async def start(self) -> None:
+        if self._config.unix_socket_path:
+            self._server = await asyncio.start_unix_server(
+                self._handle,
+                path=self._config.unix_socket_path,
+                limit=MAX_REQUEST_BYTES,
+            )
+            address = self._config.unix_socket_path
+        else:
+            self._server = await asyncio.start_server(
+                self._handle,
+                host=self._config.host,
+                port=self._config.port,
+                limit=MAX_REQUEST_BYTES,
+            )
+            host, port = self._server.sockets[0].getsockname()[:2]
+            address = f"http://{host}:{port}"
+        self._logger.info(f"Status server listening on {address}")
+
+    @property
+    def port(self) -> Optional[int]:
+        """
+        The TCP port the server listens on, e.g. when it was started on port 0.
+        """
+        if self._server is None or self._config.unix_socket_path:
+            return None
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        if self._config.unix_socket_path:
+            # Only removed on close from Python 3.13.
+            try:
+                os.unlink(self._config.unix_socket_path)
+            except FileNotFoundError:
+                pass
+
+    def respond(self, method: str, path: str) -> Tuple[int, Dict[str, Any]]:
+        """
+        Return the status code and JSON body for a request.
+        """
+        path = path.split("?", 1)[0]
+        if path not in ("/healthz", "/readyz", "/status"):
+            return 404, {"error": f"Unknown path {path}"}
+        if method not in ("GET", "HEAD"):
+            return 405, {"error": f"Method {method} not allowed"}
+
+        status = self._get_status()
+        if path == "/readyz" and not status["ready"]:
+            return 503, status
+        return 200, status
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), READ_TIMEOUT_S)
+            request_line = head.split(b"\r\n", 1)[0].decode("latin-1")
+            method, path, _ = request_line.split(" ", 2)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            status_code, body = 400, {"error": "Bad request"}
+            method = "GET"
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+        else:
+            status_code, body = self.respond(method, path)
+
+        content = dumps(body)
+        response = (
+            f"HTTP/1.1 {status_code} {_REASONS[status_code]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(content)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode()
+        try:
+            writer.write(response if method == "HEAD" else response + content)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
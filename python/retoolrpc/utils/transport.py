@@ -0,0 +1,105 @@
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import httpx
+from retoolrpc.utils.api import LongPollQueryRequest, PopQueryRequest, RetoolAPI
+
+DEFAULT_LONG_POLL_TIMEOUT_MS = 30000
+
+
+class QueryTransport(ABC):
+    """
+    Delivers pending queries to the agent. Transports only differ in how a query is
+    fetched; executing it and posting the response is the same for all of them.
+    """
+
+    # Whether a poll is cancelled when the agent stops. A poll that can wait for a
+    # long time is cancelled; otherwise the agent waits for it, so that a query the
+    # server already handed out is not lost.
+    cancel_poll_on_stop = False
+
+    @abstractmethod
+    async def pop_query(
+        self, api: RetoolAPI, options: PopQueryRequest
+    ) -> httpx.Response:
+        """
+        Fetch the next pending query. The response has the popQuery format.
+        """
+
+    @abstractmethod
+    def next_poll_delay_ms(self, received_query: bool) -> int:
+        """
+        How long the agent waits before fetching the next query, given whether the
+        last poll returned a query.
+        """
+
+
+class PollingTransport(QueryTransport):
+    """
+    Short polling: popQuery returns immediately and the agent waits for the polling
+    interval after every poll.
+    """
+
+    def __init__(self, polling_interval_ms: int) -> None:
+        self._polling_interval_ms = polling_interval_ms
+
+    async def pop_query(
+        self, api: RetoolAPI, options: PopQueryRequest
+    ) -> httpx.Response:
+        return await api.pop_query(options)
+
+    def next_poll_delay_ms(self, received_query: bool) -> int:
+        return self._polling_interval_ms
+
+
+class LongPollingTransport(QueryTransport):
+    """
+    Long polling: the server holds popQuery open for up to `long_poll_timeout_ms`
+    until a query is available, so the agent polls again right away. If the server
+    answers an empty poll early, it does not support long polling and the agent
+    falls back to waiting for the polling interval.
+    """
+
+    cancel_poll_on_stop = True
+
+    def __init__(
+        self,
+        polling_interval_ms: int,
+        polling_timeout_ms: int,
+        long_poll_timeout_ms: int = DEFAULT_LONG_POLL_TIMEOUT_MS,
+    ) -> None:
+        self._polling_interval_ms = polling_interval_ms
+        self._polling_timeout_ms = polling_timeout_ms
+        self._long_poll_timeout_ms = long_poll_timeout_ms
+        self._last_poll_duration_ms = 0.0
+        # The agent passes the same options until its versionHash changes.
+        self._options: Optional[PopQueryRequest] = None
+        self._long_poll_options: Optional[LongPollQueryRequest] = None
+
+    async def pop_query(
+        self, api: RetoolAPI, options: PopQueryRequest
+    ) -> httpx.Response:
+        if options is not self._options or self._long_poll_options is None:
+            self._options = options
+            self._long_poll_options = {
+                **options,
+                "waitTimeoutMs": self._long_poll_timeout_ms,
+            }
+        started_at = time.monotonic()
+        try:
+            return await api.pop_query(
+                self._long_poll_options,
+                timeout_ms=self._long_poll_timeout_ms + self._polling_timeout_ms,
+            )
+        finally:
+            self._last_poll_duration_ms = (time.monotonic() - started_at) * 1000
+
+    def next_poll_delay_ms(self, received_query: bool) -> int:
+        if received_query:
+            return 0
+        # An empty poll that returned well before the long poll timeout means the
+        # server does not hold requests open.
+        if self._last_poll_duration_ms < self._long_poll_timeout_ms / 2:
+            return self._polling_interval_ms
+        return 0
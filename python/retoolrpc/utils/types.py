@@ -1,3 +1,4 @@
+import signal
 from typing import (
     Any,
     Awaitable,
@@ -5,12 +6,135 @@ from typing import (
     Dict,
     List,
     Literal,
+    TYPE_CHECKING,
     NamedTuple,
     Optional,
+    Tuple,
+    Type,
     TypedDict,
     Union,
 )
 
+from retoolrpc.utils.imports import LazyImplementation
+
+if TYPE_CHECKING:
+    from retoolrpc.utils.middleware import Middleware
+    from retoolrpc.utils.transport import QueryTransport
+
+
+# Represents how tabular results are sent to Retool.
+ResultFormat = Literal["rows", "columnar"]
+
+# Represents how much of the stack of an error is sent to Retool.
+ErrorStackMode = Literal["full", "truncated", "none"]
+
+
+class ProfilingConfig(NamedTuple):
+    """
+    Configuration options for profiling function executions.
+    """
+
+    # The directory where profiles are written. Files are named after the function
+    # and the query UUID, e.g. `<function name>-<query uuid>.prof`.
+    output_dir: str
+
+    # Whether profiling is active at startup. It can be toggled at runtime.
+    enabled: Optional[bool] = True
+
+    # The fraction of executions (between 0 and 1) that are profiled.
+    sample_rate: Optional[float] = 0.0
+
+    # Names of the functions that are always profiled while profiling is enabled.
+    function_names: Optional[List[str]] = None
+
+    # What to capture: cProfile stats, tracemalloc snapshots or both.
+    mode: Optional[Literal["cprofile", "tracemalloc", "both"]] = "cprofile"
+
+    # The number of frames tracemalloc stores for each allocation.
+    tracemalloc_frames: Optional[int] = 25
+
+    # The signal that toggles profiling on and off while the agent is listening.
+    # None where SIGUSR1 does not exist, e.g. on Windows.
+    toggle_signal: Optional[int] = getattr(signal, "SIGUSR1", None)
+
+
+class StatusServerConfig(NamedTuple):
+    """
+    Configuration options for the local status server of the agent.
+    """
+
+    # The interface the server listens on. Only local by default.
+    host: str = "127.0.0.1"
+
+    # The TCP port of the server. Port 0 picks a free port.
+    port: int = 8181
+
+    # Listen on this Unix socket instead of a TCP port when set.
+    unix_socket_path: Optional[str] = None
+
+
+class RetryPolicy(NamedTuple):
+    """
+    How an idempotent function is retried when it fails with a transient error.
+    """
+
+    # The exception types that are retried. Other errors fail the query right away.
+    retryable_exceptions: Tuple[Type[BaseException], ...] = (
+        ConnectionError,
+        TimeoutError,
+    )
+
+    # The maximum number of attempts, including the first one.
+    max_attempts: int = 3
+
+    # The backoff before the first retry in milliseconds. It is multiplied by
+    # `backoff_multiplier` for every further retry, up to `max_backoff_ms`. The
+    # actual delay is random between 0 and the backoff (full jitter).
+    initial_backoff_ms: int = 100
+    max_backoff_ms: int = 5000
+    backoff_multiplier: float = 2.0
+
+
+class CircuitBreakerConfig(NamedTuple):
+    """
+    When a function fails fast instead of calling a dependency that is down.
+    """
+
+    # The fraction of failed calls (between 0 and 1) in the window that opens the
+    # circuit.
+    failure_rate_threshold: float = 0.5
+
+    # Calls slower than this, in milliseconds, count as failed. Disabled by default.
+    slow_call_ms: Optional[int] = None
+
+    # The number of most recent calls the failure rate is computed over, and the
+    # minimum number of calls before the circuit can open.
+    window_size: int = 20
+    minimum_calls: int = 10
+
+    # How long the circuit stays open before trial calls are let through, in
+    # milliseconds.
+    open_duration_ms: int = 30000
+
+    # The number of trial calls let through at a time while half-open.
+    half_open_calls: int = 1
+
+
+class CacheConfig(NamedTuple):
+    """
+    Configuration options for the cache shared by the functions of the agent.
+    """
+
+    # How long a loaded value is fresh, in milliseconds.
+    ttl_ms: int = 60000
+
+    # How long an expired value is still served while it is reloaded in the
+    # background, in milliseconds. Disabled by default.
+    stale_ms: int = 0
+
+    # The maximum number of values. The least recently used value is dropped first.
+    max_size: int = 1024
+
 
 class RetoolRPCConfig(NamedTuple):
     """
@@ -45,6 +169,106 @@ class RetoolRPCConfig(NamedTuple):
     # The optional log level.
     log_level: Optional[Literal["debug", "info", "warn", "error"]] = None
 
+    # The optional profiling configuration. Profiling is disabled by default.
+    profiling: Optional[ProfilingConfig] = None
+
+    # Whether implementations registered as import strings are imported in the
+    # background as soon as the agent starts. Otherwise they are imported on first
+    # call. Defaults to True.
+    prewarm_imports: Optional[bool] = True
+
+    # The optional directory used to cache the registerAgent result. When set, a
+    # restarted agent whose functions have not changed reuses the cached versionHash
+    # and starts polling immediately. It registers again if the server rejects it.
+    # Requires `agent_uuid`, as the versionHash is registered for the agent UUID.
+    registration_cache_dir: Optional[str] = None
+
+    # Whether the agent reloads the modules of registered implementations when their
+    # source files change, without restarting. Meant for development. Defaults to False.
+    hot_reload: Optional[bool] = False
+
+    # How often source files are checked for changes in hot reload mode, in
+    # milliseconds. Defaults to 1000.
+    hot_reload_interval_ms: Optional[int] = 1000
+
+    # How queries are delivered to the agent: `polling` waits for the polling
+    # interval after every poll, `long_polling` lets the server hold each poll open
+    # until a query is available. A custom `QueryTransport` can also be passed.
+    # Defaults to `polling`.
+    transport: Optional[Union[Literal["polling", "long_polling"], "QueryTransport"]] = (
+        "polling"
+    )
+
+    # How long the server may hold a long poll open, in milliseconds. Defaults to
+    # 30000.
+    long_poll_timeout_ms: Optional[int] = 30000
+
+    # How tabular results (data frames, record arrays and columnar functions) are
+    # sent: `columnar` sends every column name once with a list of values per
+    # column, `rows` sends a list of row dicts for servers that require it.
+    # Defaults to `rows`.
+    result_format: Optional[ResultFormat] = "rows"
+
+    # The optional maximum size of a function result in bytes, estimated while the
+    # result is walked so oversized results are rejected before they are encoded.
+    # Functions can set their own limit. Binary results are streamed and are not
+    # limited. Defaults to no limit.
+    max_result_bytes: Optional[int] = None
+
+    # Whether a result over the limit is truncated to the rows that fit, which is
+    # flagged as `truncated` in the response metadata, instead of failing with a
+    # ResultTooLargeError. Only lists of rows and tables can be truncated.
+    # Defaults to False.
+    truncate_oversized_results: Optional[bool] = False
+
+    # Whether function arguments are decoded lazily. Implementations then receive a
+    # read-only mapping whose arguments are decoded and validated when accessed, and
+    # with simdjson installed large parameters are not decoded at all until then.
+    # Only accessed arguments are reported back in the response metadata.
+    # Defaults to False.
+    lazy_arguments: Optional[bool] = False
+
+    # How much of the stack of a failed function is sent with the error: the
+    # `full` traceback, the innermost `error_stack_frames` frames when
+    # `truncated`, or `none`. Errors caused by the query, such as invalid
+    # arguments, are always sent without a stack. Defaults to `full`.
+    error_stack_mode: Optional[ErrorStackMode] = "full"
+
+    # The number of frames sent in `truncated` mode. Defaults to 10.
+    error_stack_frames: Optional[int] = 10
+
+    # The signals that make a listening agent drain and exit: it stops polling,
+    # finishes the query it is running and posts its response. Set to None to
+    # keep the default signal handling. Defaults to SIGTERM only, so that Ctrl-C
+    # still interrupts the agent right away; add SIGINT to drain on Ctrl-C too.
+    shutdown_signals: Optional[Tuple[int, ...]] = (signal.SIGTERM,)
+
+    # How long a draining agent waits for its running query to finish, in
+    # milliseconds, before cancelling it. Defaults to 30 seconds.
+    drain_timeout_ms: Optional[int] = 30000
+
+    # An optional pid file for rolling restarts. Once registered, the agent writes
+    # its pid to the file and sends SIGTERM to the agent whose pid was there, which
+    # then drains while the new agent already takes queries.
+    pid_file: Optional[str] = None
+
+    # Serve `/healthz`, `/readyz` and `/status` from a local HTTP server while the
+    # agent is listening, for orchestrators and debugging. Defaults to no server.
+    status_server: Optional[StatusServerConfig] = None
+
+    # An optional file the agent appends the queries it executes to, with their
+    # execution time, to replay them offline with `python -m retoolrpc.replay`.
+    # Parameters are written as is, context values are replaced by hashes.
+    capture_file: Optional[str] = None
+
+    # The defaults of `rpc.cache`, the cache shared by all functions.
+    cache: Optional[CacheConfig] = None
+
+    # The number of threads that run sync implementations of functions with a
+    # `timeout_ms`. Calls wait for a free thread once all of them are busy, e.g.
+    # with hung implementations. Defaults to 8.
+    timeout_max_workers: Optional[int] = 8
+
 
 # Represents the type of the argument. Right now we are supporting only string,
 # boolean, number, dict, and json.
@@ -107,7 +331,57 @@ class Permissions(TypedDict, total=False):
     userEmails: Optional[List[str]]
 
 
-class FunctionSpecWithoutName(TypedDict):
+# The implementation of a Retool RPC function.
+Implementation = Callable[
+    [Dict[str, Any], Optional[RetoolContext]], Union[Any, Awaitable[Any]]
+]
+
+
+class FunctionOptions(TypedDict, total=False):
+    """
+    Optional settings of a Retool RPC function.
+    """
+
+    # Whether the function returns a dict of columns (column name to list of values)
+    # that should be sent as a table. Pandas data frames and numpy record arrays are
+    # always sent as tables.
+    columnar: bool
+
+    # The maximum size of the result in bytes, overriding `max_result_bytes` of
+    # the config.
+    max_result_bytes: int
+
+    # Whether a result over the limit is truncated, overriding
+    # `truncate_oversized_results` of the config.
+    truncate_oversized_results: bool
+
+    # Middlewares that wrap only this function, inside the middlewares added with
+    # `RetoolRPC.use`.
+    middlewares: List["Middleware"]
+
+    # Whether the function can safely run more than once for the same query, which
+    # is required for `retry` to apply.
+    idempotent: bool
+
+    # How the function is retried on transient errors. Only applies to idempotent
+    # functions.
+    retry: RetryPolicy
+
+    # The maximum duration of a call in milliseconds, including retries. A sync
+    # implementation then runs in one of the agent's `timeout_max_workers` threads;
+    # a call that times out is not waited for, but its thread runs until the
+    # implementation returns.
+    timeout_ms: int
+
+    # Fails calls fast while the function keeps failing or is too slow.
+    circuit_breaker: CircuitBreakerConfig
+
+    # Names of resources added with `RetoolRPC.add_resource` that the implementation
+    # gets as keyword arguments, e.g. `implementation(args, context, db=pool)`.
+    resources: List[str]
+
+
+class FunctionSpecWithoutName(FunctionOptions):
     """
     Represents the specification for registering a Retool RPC function.
     """
@@ -115,16 +389,15 @@ class FunctionSpecWithoutName(TypedDict):
     # The arguments of the function.
     arguments: Dict[str, Argument]
 
-    # The implementation of the function.
-    implementation: Callable[
-        [Dict[str, Any], Optional[RetoolContext]], Union[Any, Awaitable[Any]]
-    ]
+    # The implementation of the function, imported on demand if it was registered
+    # as an import string.
+    implementation: Union[Implementation, LazyImplementation]
 
     # The optional permissions configuration for the function.
     permissions: Optional[Permissions]
 
 
-class RegisterFunctionSpec(TypedDict):
+class RegisterFunctionSpec(FunctionOptions):
     """
     Represents the specification for registering a Retool RPC function.
     """
@@ -135,10 +408,10 @@ class RegisterFunctionSpec(TypedDict):
     # The arguments of the function.
     arguments: Dict[str, Argument]
 
-    # The implementation of the function.
-    implementation: Callable[
-        [Dict[str, Any], Optional[RetoolContext]], Union[Any, Awaitable[Any]]
-    ]
+    # The implementation of the function. It can also be an import string in the
+    # `package.module:function` format, in which case the module is only imported
+    # in the background after the agent starts, or when the function is first called.
+    implementation: Union[Implementation, str]
 
     # The optional permissions configuration for the function.
     permissions: Optional[Permissions]
@@ -0,0 +1,139 @@
+"""
+Allocation benchmark: time and peak traced memory per query for the agent's query
+path (popQuery response decoding, execution, response encoding), with the HTTP
+calls replaced by in-process stubs.
+
+Usage: python scripts/benchmarks/bench_allocations.py [--queries 20000]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+
+from retoolrpc import RetoolRPC, RetoolRPCConfig
+from retoolrpc.utils.serialization import dumps
+from retoolrpc.utils.transport import QueryTransport
+
+QUERY = json.dumps(
+    {
+        "query": {
+            "queryUuid": "7b1c2ef0-3a3b-4d07-9f0e-0c8a2d9f4c11",
+            "queryInfo": {
+                "method": "greet",
+                "parameters": {"name": "Steph", "count": 3},
+                "context": {
+                    "user_name": "Steph Curry",
+                    "user_email": "steph@warriors.com",
+                    "user_groups": ["Warriors"],
+                    "organization_name": "Golden State Warriors",
+                },
+            },
+        }
+    }
+).encode()
+
+
+class StubResponse:
+    """
+    The parts of an httpx.Response the agent reads, without the cost of building
+    one, which would hide the cost of the agent itself.
+    """
+
+    is_success = True
+    status_code = 200
+    text = ""
+
+    def __init__(self, content: bytes = b"") -> None:
+        self.content = content
+
+
+class StubTransport(QueryTransport):
+    async def pop_query(self, api, options):
+        return StubResponse(QUERY)
+
+    def next_poll_delay_ms(self, received_query: bool) -> int:
+        return 0
+
+
+class StubAPI:
+    """
+    Stands in for RetoolAPI: encodes the response body like it and drops it.
+    """
+
+    def __init__(self) -> None:
+        self.posted_bytes = 0
+
+    async def post_query_response(self, options, attachment=None):
+        content = options if isinstance(options, bytes) else dumps(options)
+        self.posted_bytes += len(content)
+        return StubResponse()
+
+
+def create_agent() -> RetoolRPC:
+    rpc = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="benchmark",
+            host="http://localhost:3001",
+            resource_id="benchmark",
+            transport=StubTransport(),
+            log_level="error",
+        )
+    )
+    rpc.register(
+        {
+            "name": "greet",
+            "arguments": {
+                "name": {
+                    "type": "string",
+                    "description": "",
+                    "array": False,
+                    "required": True,
+                },
+                "count": {
+                    "type": "number",
+                    "description": "",
+                    "array": False,
+                    "required": True,
+                },
+            },
+            "implementation": lambda args, context: f"Hello {args['name']}",
+            "permissions": None,
+        }
+    )
+    rpc._retool_api = StubAPI()  # type: ignore[assignment]
+    rpc._version_hash = "benchmark"
+    return rpc
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=20000)
+    args = parser.parse_args()
+
+    rpc = create_agent()
+    for _ in range(1000):
+        await rpc.fetch_query_and_execute()
+
+    started_at = time.perf_counter()
+    for _ in range(args.queries):
+        await rpc.fetch_query_and_execute()
+    elapsed_us = (time.perf_counter() - started_at) * 1e6 / args.queries
+
+    # Peak memory of a single query, and the blocks allocated over many queries.
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    await rpc.fetch_query_and_execute()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{elapsed_us:7.2f} us/query, peak {peak - baseline:6d} bytes/query, "
+        f"body {rpc._retool_api.posted_bytes // (args.queries + 1001)} bytes"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""
+Argument decoding benchmark: time and peak traced memory to decode a popQuery
+response with a large `rows` parameter and call a handler that only reads a small
+argument, with eager and lazy argument decoding. The buffers of simdjson are allocated
+natively and do not show up in the traced memory, they are about the size of the
+response.
+
+Usage: python scripts/benchmarks/bench_arguments.py [--rows 200000] [--repeat 5]
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Any, Callable
+
+from retoolrpc.utils import arguments
+from retoolrpc.utils.arguments import LazyArguments, decode_query
+from retoolrpc.utils.schema import parse_function_arguments
+
+SCHEMA: Any = {
+    "table": {"type": "string", "description": "", "required": True, "array": False},
+    "rows": {"type": "json", "description": "", "required": False, "array": False},
+}
+
+
+def make_content(rows: int) -> bytes:
+    return json.dumps(
+        {
+            "query": {
+                "queryUuid": "benchmark",
+                "queryInfo": {
+                    "method": "tableName",
+                    "context": {"user_email": "steph@warriors.com"},
+                    "parameters": {
+                        "table": "players",
+                        "rows": [
+                            {"id": i, "name": f"Player {i}", "points": i * 0.5}
+                            for i in range(rows)
+                        ],
+                    },
+                },
+            }
+        }
+    ).encode()
+
+
+def eager_json(content: bytes) -> Any:
+    parameters = json.loads(content)["query"]["queryInfo"]["parameters"]
+    return parse_function_arguments(parameters, SCHEMA)["table"]
+
+
+def eager(content: bytes) -> Any:
+    parameters = decode_query(content)["query"]["queryInfo"]["parameters"]
+    return parse_function_arguments(parameters, SCHEMA)["table"]
+
+
+def lazy(content: bytes) -> Any:
+    parameters = decode_query(content, True)["query"]["queryInfo"]["parameters"]
+    return LazyArguments(parameters, SCHEMA)["table"]
+
+
+def measure(label: str, decode: Callable[[bytes], Any], content: bytes, repeat: int):
+    durations = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        decode(content)
+        durations.append((time.perf_counter() - started_at) * 1000)
+
+    tracemalloc.start()
+    decode(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<24} {min(durations):>10.1f} ms {peak / 1e6:>10.1f} MB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    content = make_content(args.rows)
+    print(f"{len(content) / 1e6:.1f} MB popQuery response")
+    print(f"{'':<24} {'decode':>13} {'peak':>13}")
+    measure("eager (json)", eager_json, content, args.repeat)
+    measure("eager (orjson)", eager, content, args.repeat)
+    if arguments.simdjson is not None:
+        measure("lazy (simdjson)", lazy, content, args.repeat)
+    simdjson, arguments.simdjson = arguments.simdjson, None
+    measure("lazy (orjson/json)", lazy, content, args.repeat)
+    arguments.simdjson = simdjson
+
+
+if __name__ == "__main__":
+    main()
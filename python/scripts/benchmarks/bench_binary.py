@@ -0,0 +1,115 @@
+"""
+Binary result benchmark: peak RSS of an agent process that returns a large file,
+base64 encoded into the JSON data or as an attachment streamed from a memory map.
+
+Usage: python scripts/benchmarks/bench_binary.py [--size-mb 500]
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+
+from stub_server import StubRetoolServer
+
+from retoolrpc import RetoolRPC, RetoolRPCConfig
+
+
+async def run_agent(mode: str, url: str, path: str) -> None:
+    """
+    Runs in a child process: register, execute the single queued query and print
+    the peak RSS in MB.
+    """
+    rpc = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="benchmark",
+            host=url,
+            resource_id="benchmark",
+            log_level="error",
+        )
+    )
+    implementations = {
+        "base64": (
+            lambda args, context: base64.b64encode(
+                pathlib.Path(path).read_bytes()
+            ).decode()
+        ),
+        "attachment": lambda args, context: pathlib.Path(path),
+    }
+    rpc.register(
+        {
+            "name": "export",
+            "arguments": {},
+            "implementation": implementations[mode],
+            "permissions": None,
+        }
+    )
+    await rpc.register_agent()
+    await rpc.fetch_query_and_execute()
+    print(peak_rss_mb())
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is inherited from the parent across fork and exec on Linux, the
+    # high water mark in /proc is not.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def measure(mode: str, path: str) -> None:
+    server = await StubRetoolServer().start()
+    response = server.enqueue("export", {})
+    started_at = time.perf_counter()
+    agent = await asyncio.create_subprocess_exec(
+        sys.executable,
+        __file__,
+        "--agent",
+        mode,
+        server.url,
+        path,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await agent.communicate()
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+    body = await response
+    await server.stop()
+
+    size = body.get("attachmentSize") or len(body["data"])
+    print(
+        f"{mode:<12} sent {size / 1e6:>8.1f} MB, peak RSS "
+        f"{float(stdout):>8.1f} MB, {elapsed_ms:>8.0f} ms"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "export.bin")
+        with open(path, "wb") as file:
+            for _ in range(args.size_mb):
+                file.write(os.urandom(1024 * 1024))
+
+        print(f"{args.size_mb} MB file")
+        for mode in ("base64", "attachment"):
+            await measure(mode, path)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--agent"]:
+        asyncio.run(run_agent(*sys.argv[2:5]))
+    else:
+        asyncio.run(main())
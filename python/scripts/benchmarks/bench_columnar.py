@@ -0,0 +1,50 @@
+"""
+Result encoding benchmark: payload size and encode time of a tabular result sent as
+a list of row dicts and in the columnar format, with the json module and orjson.
+
+Usage: python scripts/benchmarks/bench_columnar.py [--rows 100000]
+"""
+
+import argparse
+import json
+import time
+
+from retoolrpc.utils.serialization import dumps, encode_result
+
+
+def make_columns(rows: int) -> dict:
+    return {
+        "id": list(range(rows)),
+        "user_email": [f"user{i}@example.com" for i in range(rows)],
+        "organization_name": ["Golden State Warriors"] * rows,
+        "points": [i * 0.5 for i in range(rows)],
+        "active": [i % 2 == 0 for i in range(rows)],
+    }
+
+
+def measure(label: str, encode, value) -> None:
+    started_at = time.perf_counter()
+    payload = encode(value)
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+    print(f"{label:<20} {len(payload) / 1e6:>8.2f} MB {elapsed_ms:>10.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    columns = make_columns(args.rows)
+    rows, _ = encode_result(columns, True, "rows")
+    columnar, _ = encode_result(columns, True, "columnar")
+
+    print(f"{args.rows} rows, {len(columns)} columns")
+    print(f"{'':<20} {'payload':>11} {'encode':>13}")
+    measure("rows (json)", lambda value: json.dumps(value).encode(), rows)
+    measure("rows (dumps)", dumps, rows)
+    measure("columnar (json)", lambda value: json.dumps(value).encode(), columnar)
+    measure("columnar (dumps)", dumps, columnar)
+
+
+if __name__ == "__main__":
+    main()
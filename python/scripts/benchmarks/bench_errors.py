@@ -0,0 +1,62 @@
+"""
+Error storm benchmark: errors converted per second by create_agent_server_error
+for an error raised 50 frames deep and for invalid arguments, in each stack mode.
+
+Usage: python scripts/benchmarks/bench_errors.py [--errors 20000]
+"""
+
+import argparse
+import time
+from typing import Callable
+
+from retoolrpc.utils.errors import InvalidArgumentsError, create_agent_server_error
+
+DEPTH = 50
+
+
+def deep_error(depth: int = DEPTH) -> None:
+    if depth == 0:
+        raise RuntimeError("Deadlock detected")
+    deep_error_step(depth - 1)
+
+
+def deep_error_step(depth: int) -> None:
+    deep_error(depth)
+
+
+def invalid_arguments() -> None:
+    raise InvalidArgumentsError('Argument "id" is required but missing.')
+
+
+def measure(label: str, raise_error: Callable[[], None], errors: int, **options):
+    stack_size = 0
+    started_at = time.perf_counter()
+    for _ in range(errors):
+        try:
+            raise_error()
+        except Exception as err:
+            stack = create_agent_server_error(err, **options)["stack"]
+            stack_size = len(stack or "")
+    elapsed = time.perf_counter() - started_at
+    print(f"{label:<28} {errors / elapsed:>10.0f} errors/s {stack_size:>8} B stack")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--errors", type=int, default=20000)
+    args = parser.parse_args()
+
+    measure("deep error, full", deep_error, args.errors, stack_mode="full")
+    measure(
+        "deep error, 10 frames",
+        deep_error,
+        args.errors,
+        stack_mode="truncated",
+        stack_frames=10,
+    )
+    measure("deep error, none", deep_error, args.errors, stack_mode="none")
+    measure("invalid arguments", invalid_arguments, args.errors)
+
+
+if __name__ == "__main__":
+    main()
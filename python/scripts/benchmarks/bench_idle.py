@@ -0,0 +1,92 @@
+"""
+Idle benchmark: CPU time an agent process spends polling the stub server when
+there are no queries, per poll and per second.
+
+Usage: python scripts/benchmarks/bench_idle.py [--seconds 10] [--interval-ms 100]
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+
+from stub_server import StubRetoolServer
+
+from retoolrpc import RetoolRPC, RetoolRPCConfig
+
+
+async def run_agent(url: str, seconds: float, interval_ms: int) -> None:
+    """
+    Runs in a child process: listen, then print the CPU time used over a window
+    of idle polling, and the bounds of the window.
+    """
+    rpc = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="benchmark",
+            host=url,
+            resource_id="benchmark",
+            polling_interval_ms=interval_ms,
+            shutdown_signals=None,
+            log_level="error",
+        )
+    )
+    rpc.register(
+        {
+            "name": "echo",
+            "arguments": {},
+            "implementation": lambda args, context: "echo",
+            "permissions": None,
+        }
+    )
+    listen_task = asyncio.create_task(rpc.listen())
+    # Warm up: registration, imports and the first polls.
+    await asyncio.sleep(1)
+
+    started_at, cpu_started_at = time.perf_counter(), time.process_time()
+    await asyncio.sleep(seconds)
+    finished_at, cpu_finished_at = time.perf_counter(), time.process_time()
+
+    rpc.stop()
+    await listen_task
+    print(started_at, finished_at, cpu_finished_at - cpu_started_at)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--interval-ms", type=int, default=100)
+    args = parser.parse_args()
+
+    server = await StubRetoolServer().start()
+    agent = await asyncio.create_subprocess_exec(
+        sys.executable,
+        __file__,
+        "--agent",
+        server.url,
+        str(args.seconds),
+        str(args.interval_ms),
+        stdout=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await agent.communicate()
+    await server.stop()
+
+    # perf_counter is a system-wide monotonic clock, the timestamps of the child
+    # and of the stub server can be compared.
+    started_at, finished_at, cpu_s = map(float, stdout.split())
+    polls = sum(
+        1
+        for timestamp, endpoint in server.request_log
+        if endpoint == "popQuery" and started_at <= timestamp <= finished_at
+    )
+    print(
+        f"{polls / args.seconds:6.1f} polls/s, "
+        f"CPU {cpu_s * 1000 / polls:6.2f} ms/poll, "
+        f"{cpu_s / args.seconds * 100:5.1f}% of a core"
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--agent"]:
+        asyncio.run(run_agent(sys.argv[2], float(sys.argv[3]), int(sys.argv[4])))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,74 @@
+"""
+Middleware benchmark: time per execute_function call with 0, 1 and 10 pass-through
+middlewares, async and sync.
+
+Usage: python scripts/benchmarks/bench_middleware.py [--calls 100000]
+"""
+
+import argparse
+import asyncio
+import time
+
+from retoolrpc import FunctionCall, RetoolRPC, RetoolRPCConfig
+
+CONTEXT = {
+    "user_name": "Steph Curry",
+    "user_email": "steph@warriors.com",
+    "user_groups": [],
+    "organization_name": "Golden State Warriors",
+}
+
+
+async def async_middleware(call: FunctionCall, call_next):
+    return await call_next(call)
+
+
+def sync_middleware(call: FunctionCall, call_next):
+    return call_next(call)
+
+
+async def measure(label: str, middlewares: list, calls: int) -> None:
+    rpc = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="benchmark",
+            host="http://localhost:3001",
+            resource_id="benchmark",
+            log_level="error",
+        )
+    )
+    rpc.register(
+        {
+            "name": "echo",
+            "arguments": {},
+            "implementation": lambda args, context: "echo",
+            "permissions": None,
+            "middlewares": middlewares,
+        }
+    )
+
+    for _ in range(1000):
+        await rpc.execute_function("echo", {}, CONTEXT)
+    started_at = time.perf_counter()
+    for _ in range(calls):
+        await rpc.execute_function("echo", {}, CONTEXT)
+    elapsed_us = (time.perf_counter() - started_at) * 1e6 / calls
+    print(f"{label:<24} {elapsed_us:>8.2f} us/call")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=100000)
+    args = parser.parse_args()
+
+    await measure("0 middlewares", [], args.calls)
+    for count in (1, 10):
+        await measure(
+            f"{count} async middlewares", [async_middleware] * count, args.calls
+        )
+        await measure(
+            f"{count} sync middlewares", [sync_middleware] * count, args.calls
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
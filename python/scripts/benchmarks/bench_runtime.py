@@ -0,0 +1,147 @@
+"""
+Runtime benchmark: per-query overhead of the agent on the default asyncio loop and
+on uvloop, with and without eager tasks (Python 3.12+). Each configuration runs in
+its own process.
+
+- inline: queries awaited in-process one after the other, like the agent awaits
+  them, without HTTP. Eager tasks only apply to the tasks handlers create.
+- stub: queries sent back to back through the local stub server, with long polling
+  so the polling interval does not hide the overhead.
+
+Handlers either return right away (echo) or gather a few subtasks that complete
+without waiting (fanOut).
+
+Usage: python scripts/benchmarks/bench_runtime.py [--calls 50000] [--queries 200]
+"""
+
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+
+from stub_server import StubRetoolServer
+
+import retoolrpc
+from retoolrpc import RetoolRPC, RetoolRPCConfig
+
+CONTEXT = {
+    "user_name": "Steph Curry",
+    "user_email": "steph@warriors.com",
+    "user_groups": [],
+    "organization_name": "Golden State Warriors",
+}
+
+
+async def lookup(key: str) -> str:
+    return key
+
+
+async def fan_out(args, context):
+    return await asyncio.gather(*(lookup(str(key)) for key in range(8)))
+
+
+def create_agent(host: str) -> RetoolRPC:
+    rpc = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="benchmark",
+            host=host,
+            resource_id="benchmark",
+            transport="long_polling",
+            shutdown_signals=None,
+            log_level="error",
+        )
+    )
+    rpc.register(
+        {
+            "name": "echo",
+            "arguments": {},
+            "implementation": lambda args, context: "echo",
+            "permissions": None,
+        }
+    )
+    rpc.register(
+        {
+            "name": "fanOut",
+            "arguments": {},
+            "implementation": fan_out,
+            "permissions": None,
+        }
+    )
+    return rpc
+
+
+async def measure_inline(calls: int) -> str:
+    rpc = create_agent("http://localhost:3001")
+    results = []
+    for method in ["echo", "fanOut"]:
+        started_at = time.perf_counter()
+        for _ in range(calls):
+            await rpc.execute_function(method, {}, CONTEXT)
+        elapsed_us = (time.perf_counter() - started_at) * 1e6 / calls
+        results.append(f"{method} {elapsed_us:5.2f}us")
+    return "inline " + ", ".join(results)
+
+
+async def measure_stub(queries: int) -> str:
+    server = await StubRetoolServer().start()
+    rpc = create_agent(server.url)
+    listen_task = asyncio.create_task(rpc.listen())
+    while not server.request_counts["registerAgent"]:
+        await asyncio.sleep(0.001)
+
+    results = []
+    for method in ["echo", "fanOut"]:
+        for _ in range(10):
+            await server.enqueue(method, {})
+        latencies = []
+        for _ in range(queries):
+            enqueued_at = time.perf_counter()
+            await server.enqueue(method, {})
+            latencies.append((time.perf_counter() - enqueued_at) * 1000)
+        results.append(f"{method} {statistics.median(latencies):6.2f}ms p50")
+
+    rpc.stop()
+    await listen_task
+    await server.stop()
+    return "stub " + ", ".join(results)
+
+
+async def measure(calls: int, queries: int) -> None:
+    print(f"{await measure_inline(calls)} | {await measure_stub(queries)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--child", choices=["asyncio", "uvloop"])
+    parser.add_argument("--eager", action="store_true")
+    args = parser.parse_args()
+
+    if args.child:
+        retoolrpc.run(
+            measure(args.calls, args.queries),
+            use_uvloop=args.child == "uvloop",
+            eager_tasks=args.eager,
+        )
+        return
+
+    for loop in ["asyncio", "uvloop"]:
+        for eager in [False, True]:
+            if eager and sys.version_info < (3, 12):
+                continue
+            label = f"{loop}{' + eager tasks' if eager else ''}"
+            command = [sys.executable, __file__, "--child", loop]
+            command += ["--calls", str(args.calls), "--queries", str(args.queries)]
+            if eager:
+                command.append("--eager")
+            output = subprocess.run(
+                command, capture_output=True, text=True, check=False
+            )
+            print(f"{label:<22} {(output.stdout or output.stderr).strip()}")
+
+
+if __name__ == "__main__":
+    main()
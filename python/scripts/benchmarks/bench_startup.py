@@ -0,0 +1,96 @@
+"""
+Startup-time benchmark: how long it takes until the agent has registered and
+served its first query when handler modules are slow to import.
+
+Compares registering an already imported implementation (eager) with registering
+an import string (lazy) that is imported in the background while the agent
+registers.
+
+Usage: python scripts/benchmarks/bench_startup.py [--import-seconds 2]
+"""
+
+import argparse
+import asyncio
+import importlib
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from stub_server import StubRetoolServer
+
+from retoolrpc import RetoolRPC, RetoolRPCConfig
+
+HEAVY_MODULE_SOURCE = """
+import time
+
+# Simulates importing numpy, pandas and ORM models.
+time.sleep({import_seconds})
+
+
+def handler(args, context):
+    return "ready"
+"""
+
+
+async def measure(mode: str) -> None:
+    server = await StubRetoolServer().start()
+    started_at = time.perf_counter()
+
+    rpc = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="benchmark",
+            host=server.url,
+            resource_id="benchmark",
+            polling_interval_ms=100,
+            log_level="error",
+        )
+    )
+    module_name = f"heavy_{mode}"
+    rpc.register(
+        {
+            "name": "handler",
+            "arguments": {},
+            "implementation": (
+                importlib.import_module(module_name).handler
+                if mode == "eager"
+                else f"{module_name}:handler"
+            ),
+            "permissions": None,
+        }
+    )
+
+    listen_task = asyncio.create_task(rpc.listen())
+    while not server.request_counts["registerAgent"]:
+        await asyncio.sleep(0.001)
+    registered_after = time.perf_counter() - started_at
+
+    await server.enqueue("handler", {})
+    first_query_after = time.perf_counter() - started_at
+
+    listen_task.cancel()
+    await server.stop()
+    print(
+        f"{mode:>5}: registerAgent sent after {registered_after * 1000:8.1f}ms, "
+        f"first query served after {first_query_after * 1000:8.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--import-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as module_dir:
+        for mode in ("eager", "lazy"):
+            Path(module_dir, f"heavy_{mode}.py").write_text(
+                HEAVY_MODULE_SOURCE.format(import_seconds=args.import_seconds)
+            )
+        sys.path.insert(0, module_dir)
+
+        for mode in ("eager", "lazy"):
+            asyncio.run(measure(mode))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Transport benchmark: latency from enqueueing a query on the stub server until its
+response is posted, and the number of popQuery requests, for short polling and
+long polling.
+
+Usage: python scripts/benchmarks/bench_transport.py [--queries 20] [--idle-ms 500]
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from stub_server import StubRetoolServer
+
+from retoolrpc import RetoolRPC, RetoolRPCConfig
+
+
+async def measure(transport: str, queries: int, idle_ms: int) -> None:
+    server = await StubRetoolServer().start()
+    rpc = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="benchmark",
+            host=server.url,
+            resource_id="benchmark",
+            polling_interval_ms=1000,
+            transport=transport,  # type: ignore[arg-type]
+            long_poll_timeout_ms=10000,
+            log_level="error",
+        )
+    )
+    rpc.register(
+        {
+            "name": "echo",
+            "arguments": {},
+            "implementation": lambda args, context: "echo",
+            "permissions": None,
+        }
+    )
+    listen_task = asyncio.create_task(rpc.listen())
+    while not server.request_counts["registerAgent"]:
+        await asyncio.sleep(0.001)
+
+    random.seed(0)
+    latencies = []
+    started_at = time.perf_counter()
+    for _ in range(queries):
+        # Idle gap between queries, like users clicking around in an app.
+        await asyncio.sleep(random.uniform(0, 2 * idle_ms) / 1000)
+        enqueued_at = time.perf_counter()
+        await server.enqueue("echo", {})
+        latencies.append((time.perf_counter() - enqueued_at) * 1000)
+    elapsed = time.perf_counter() - started_at
+
+    listen_task.cancel()
+    await server.stop()
+    polls = server.request_counts["popQuery"]
+    print(
+        f"{transport:>12}: latency mean {statistics.mean(latencies):7.1f}ms, "
+        f"p95 {sorted(latencies)[int(len(latencies) * 0.95) - 1]:7.1f}ms, "
+        f"{polls} popQuery requests ({polls / elapsed:.2f}/s)"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--idle-ms", type=int, default=500)
+    args = parser.parse_args()
+
+    for transport in ("polling", "long_polling"):
+        asyncio.run(measure(transport, args.queries, args.idle_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+A minimal local stand-in for the Retool RPC endpoints, used by the benchmarks.
+
+It implements `registerAgent`, `popQuery` (including long polling via
+`waitTimeoutMs`) and `postQueryResponse` (including attachments, which are read
+without buffering them) over plain HTTP/1.1 with keep-alive, keeps request
+counters, and lets a benchmark enqueue queries and wait for their responses.
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+API_PREFIX = "/api/v1/retoolrpc/"
+
+
+class StubRetoolServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.version_hash = str(uuid.uuid4())
+        self.request_counts: Counter = Counter()
+        self.request_log: List[Tuple[float, str]] = []
+        self.registered_operations: Optional[Dict[str, Any]] = None
+        self.responses: Dict[str, Dict[str, Any]] = {}
+        self._queries: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self._waiters: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> "StubRetoolServer":
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def enqueue(
+        self,
+        method: str,
+        parameters: Dict[str, Any],
+        context: Optional[Dict[str, Any]] = None,
+    ) -> "asyncio.Future[Dict[str, Any]]":
+        """
+        Queue a query for the agent and return a future that resolves with the
+        agent's postQueryResponse body.
+        """
+        query_uuid = str(uuid.uuid4())
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[query_uuid] = future
+        self._queries.put_nowait(
+            {
+                "queryUuid": query_uuid,
+                "queryInfo": {
+                    "method": method,
+                    "parameters": parameters,
+                    "context": context or {},
+                },
+            }
+        )
+        return future
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                content_length = int(headers.get("content-length", 0))
+                content_type = headers.get("content-type", "")
+                if content_type.startswith("multipart/form-data"):
+                    body = await self._read_multipart(
+                        reader, content_length, content_type.split("boundary=")[1]
+                    )
+                else:
+                    body = await reader.readexactly(content_length)
+                status, payload = await self._dispatch(path, body)
+                encoded = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(encoded)}\r\n"
+                    "\r\n".encode() + encoded
+                )
+                await writer.drain()
+        except (asyncio.CancelledError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_multipart(
+        self, reader: asyncio.StreamReader, content_length: int, boundary: str
+    ) -> bytes:
+        """
+        Return the JSON response part of a postQueryResponse with an attachment,
+        with the size of the attachment added to it. The attachment itself is
+        read in chunks and discarded.
+        """
+        delimiter = f"\r\n--{boundary}\r\n".encode()
+        head = b""
+        while delimiter not in head or not head.endswith(b"\r\n\r\n"):
+            head += await reader.readuntil(b"\r\n\r\n")
+        remaining = content_length - len(head)
+        while remaining > 0:
+            remaining -= len(await reader.read(min(remaining, 1024 * 1024)))
+
+        response = head.split(b"\r\n\r\n", 1)[1].split(delimiter, 1)[0]
+        options = json.loads(response)
+        tail = len(f"\r\n--{boundary}--\r\n")
+        options["attachmentSize"] = content_length - len(head) - tail
+        return json.dumps(options).encode()
+
+    async def _dispatch(self, path: str, body: bytes) -> Tuple[int, Any]:
+        endpoint = path[len(API_PREFIX) :] if path.startswith(API_PREFIX) else path
+        self.request_counts[endpoint] += 1
+        self.request_log.append((time.perf_counter(), endpoint))
+        options = json.loads(body) if body else {}
+
+        if endpoint == "registerAgent":
+            self.registered_operations = options.get("operations")
+            return 200, {"versionHash": self.version_hash}
+
+        if endpoint == "popQuery":
+            return 200, {"query": await self._pop(options)}
+
+        if endpoint == "postQueryResponse":
+            query_uuid = options.get("queryUuid")
+            self.responses[query_uuid] = options
+            waiter = self._waiters.pop(query_uuid, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(options)
+            return 200, {"success": True}
+
+        return 404, {"error": f"Unknown endpoint {path}"}
+
+    async def _pop(self, options: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        wait_timeout_ms = options.get("waitTimeoutMs")
+        if wait_timeout_ms:
+            try:
+                return await asyncio.wait_for(
+                    self._queries.get(), timeout=wait_timeout_ms / 1000
+                )
+            except asyncio.TimeoutError:
+                return None
+
+        try:
+            return self._queries.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
@@ -1,14 +1,49 @@
-from datetime import datetime
-from typing import Dict
+import asyncio
+import dataclasses
+import decimal
+import importlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import uuid
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Dict, Optional
 from uuid import uuid4
 
+import httpx
 import pytest
+import retoolrpc
 import toml
 from pytest_httpx import HTTPXMock
-from retoolrpc import RetoolRPC
-from retoolrpc.utils.errors import InvalidArgumentsError
+from retoolrpc import (
+    AsyncCache,
+    Attachment,
+    CacheConfig,
+    CircuitBreakerConfig,
+    FunctionCall,
+    RateLimiter,
+    RetoolRPC,
+    RetryPolicy,
+    StatusServerConfig,
+)
+from retoolrpc.replay import replay
+from retoolrpc.utils import runtime, serialization
+from retoolrpc.utils.capture import read_capture
+from retoolrpc.utils.errors import (
+    CircuitOpenError,
+    FunctionNotFoundError,
+    InvalidArgumentsError,
+    RateLimitExceededError,
+    create_agent_server_error,
+)
+from retoolrpc.utils.reloader import ModuleWatcher
 from retoolrpc.utils.schema import parse_function_arguments
+from retoolrpc.utils.transport import QueryTransport
 from retoolrpc.utils.types import (
+    ProfilingConfig,
     RetoolContext,
     RetoolRPCConfig,
 )
@@ -84,228 +119,2014 @@ def rpc_agent():
 
     rpc_agent.register(
         {
-            "name": "plusTwoNumbers",
-            "arguments": {
-                "number1": {
-                    "type": "number",
-                    "description": "first number",
-                    "array": False,
-                    "required": True,
-                },
-                "number2": {
-                    "type": "number",
-                    "description": "second number",
-                    "array": False,
-                    "required": True,
-                },
-            },
-            "implementation": plus_two_numbers_implementation,
+            "name": "plusTwoNumbers",
+            "arguments": {
+                "number1": {
+                    "type": "number",
+                    "description": "first number",
+                    "array": False,
+                    "required": True,
+                },
+                "number2": {
+                    "type": "number",
+                    "description": "second number",
+                    "array": False,
+                    "required": True,
+                },
+            },
+            "implementation": plus_two_numbers_implementation,
+            "permissions": None,
+        }
+    )
+
+    yield rpc_agent
+
+
+@pytest.mark.asyncio
+async def test_no_query_result(rpc_agent: RetoolRPC, httpx_mock: HTTPXMock):
+    # Mock the registration request
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
+        json={"versionHash": VERSION_HASH},
+        status_code=200,
+    )
+
+    result = await rpc_agent.register_agent()
+    assert result == "done"
+
+    # Mock the fetch query request
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={"query": None},
+        status_code=200,
+    )
+
+    result = await rpc_agent.fetch_query_and_execute()
+    assert result == "continue"
+
+
+@pytest.mark.asyncio
+async def test_successful_query_result(rpc_agent: RetoolRPC, httpx_mock: HTTPXMock):
+    popQueryResponse = {
+        "query": {
+            "queryUuid": QUERY_UUID,
+            "queryInfo": {
+                "resourceId": RESOURCE_ID,
+                "environmentName": ENVIRONMENT_NAME,
+                "context": {
+                    "userEmail": "admin@seed.retool.com",
+                    "organizationName": "seed.retool.com",
+                },
+                "method": "plusTwoNumbers",
+                "parameters": {
+                    "number1": 1,
+                    "number2": 2,
+                },
+            },
+        },
+    }
+
+    # Mock the popQuery HTTP request
+    httpx_mock.add_response(
+        method="POST",
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json=popQueryResponse,
+        status_code=200,
+    )
+
+    # Mock the postQueryResponse HTTP request
+    httpx_mock.add_response(
+        method="POST",
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse",
+        json={
+            "resourceId": RESOURCE_ID,
+            "environmentName": ENVIRONMENT_NAME,
+            "versionHash": VERSION_HASH,
+            "agentUuid": AGENT_UUID,
+            "queryUuid": QUERY_UUID,
+            "status": "success",
+            "data": 3,
+            "metadata": {
+                "packageLanguage": "javascript",
+                "packageVersion": __version__,
+                "agentReceivedQueryAt": datetime.now().isoformat(),
+                "agentFinishedQueryAt": datetime.now().isoformat(),
+                "parameters": {
+                    "number1": 1,
+                    "number2": 2,
+                },
+            },
+        },
+        status_code=200,
+    )
+
+    result = await rpc_agent.fetch_query_and_execute()
+
+    assert result == "continue"
+
+
+@pytest.mark.asyncio
+async def test_should_continue_after_returning_error_result(
+    rpc_agent: RetoolRPC, httpx_mock: HTTPXMock
+):
+    pop_query_response = {
+        "query": {
+            "queryUuid": QUERY_UUID,
+            "queryInfo": {
+                "resourceId": RESOURCE_ID,
+                "environmentName": ENVIRONMENT_NAME,
+                "context": {
+                    "userEmail": "admin@seed.retool.com",
+                    "organizationName": "seed.retool.com",
+                },
+                "method": "throwsError",
+                "parameters": {},
+            },
+        }
+    }
+
+    post_query_response = {
+        "resourceId": RESOURCE_ID,
+        "environmentName": ENVIRONMENT_NAME,
+        "versionHash": VERSION_HASH,
+        "agentUuid": AGENT_UUID,
+        "queryUuid": QUERY_UUID,
+        "status": "error",
+        "metadata": {
+            "packageLanguage": "python",
+            "packageVersion": __version__,
+            "agentReceivedQueryAt": datetime.now().isoformat(),
+            "agentFinishedQueryAt": datetime.now().isoformat(),
+            "parameters": None,  # error thrown, no parameters
+        },
+        "error": {"name": "AgentServerError", "message": "This is the error message."},
+    }
+
+    # Mock the popQuery HTTP request
+    httpx_mock.add_response(
+        method="POST",
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json=pop_query_response,
+        status_code=200,
+    )
+
+    # Mock the postQueryResponse HTTP request
+    httpx_mock.add_response(
+        method="POST",
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse",
+        json=post_query_response,
+        status_code=200,
+    )
+
+    result = await rpc_agent.fetch_query_and_execute()
+
+    assert result == "continue"
+
+
+@pytest.mark.asyncio
+async def test_plus_two_numbers(rpc_agent: RetoolRPC):
+    response = await rpc_agent.execute_function(
+        "plusTwoNumbers",
+        {
+            "number1": 2,
+            "number2": 3,
+        },
+        CONTEXT,
+    )
+
+    assert response["result"] == 5
+
+
+@pytest.mark.asyncio
+async def test_invalid_function_name(rpc_agent: RetoolRPC):
+    with pytest.raises(Exception) as excinfo:
+        await rpc_agent.execute_function(
+            "does not exist",
+            {
+                "number1": 2,
+                "number2": 3,
+            },
+            CONTEXT,
+        )
+
+    assert (
+        str(excinfo.value)
+        == 'Function "does not exist" not found on remote agent server.'
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_current_date(rpc_agent: RetoolRPC):
+    response = await rpc_agent.execute_function(
+        "asyncGetCurrentDate",
+        {},
+        CONTEXT,
+    )
+
+    assert response["result"] == CURRENT_DATE
+
+
+@pytest.mark.asyncio
+async def test_throws_error(rpc_agent: RetoolRPC):
+    with pytest.raises(Exception) as excinfo:
+        await rpc_agent.execute_function(
+            "throwsError",
+            {},
+            {
+                "user_name": "Steph Curry",
+                "user_email": "steph@warriors.com",
+                "user_groups": ["Warriors", "USA"],
+                "organization_name": "Golden State Warriors",
+            },
+        )
+
+    assert str(excinfo.value) == "This is the error message."
+
+
+@pytest.mark.asyncio
+async def test_profiles_selected_functions(tmp_path):
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            profiling=ProfilingConfig(
+                output_dir=str(tmp_path),
+                function_names=["double"],
+                mode="both",
+            ),
+        )
+    )
+    rpc_agent.register(
+        {
+            "name": "double",
+            "arguments": {},
+            "implementation": lambda args, context: 2 * 2,
+            "permissions": None,
+        }
+    )
+
+    response = await rpc_agent.execute_function("double", {}, CONTEXT, QUERY_UUID)
+    assert response["result"] == 4
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        f"double-{QUERY_UUID}.prof",
+        f"double-{QUERY_UUID}.tracemalloc",
+    ]
+
+    assert rpc_agent.toggle_profiling() is False
+    await rpc_agent.execute_function("double", {}, CONTEXT, "another-query")
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1"), reason="No SIGUSR1")
+async def test_profiling_signal_handler_removed_on_shutdown(
+    httpx_mock: HTTPXMock, tmp_path
+):
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            prewarm_imports=False,
+            profiling=ProfilingConfig(output_dir=str(tmp_path)),
+        )
+    )
+    # The agent stops right away, as it is not allowed to register.
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent", status_code=401
+    )
+    await rpc_agent.listen()
+    assert signal.getsignal(signal.SIGUSR1) == signal.SIG_DFL
+
+
+@pytest.mark.asyncio
+async def test_lazy_implementation_import(rpc_agent: RetoolRPC, tmp_path, monkeypatch):
+    (tmp_path / "lazy_handlers.py").write_text(
+        "def triple(args, context):\n    return args['number'] * 3\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "lazy_handlers", raising=False)
+
+    rpc_agent.register(
+        {
+            "name": "triple",
+            "arguments": {
+                "number": {
+                    "type": "number",
+                    "description": "A number",
+                    "array": False,
+                    "required": True,
+                },
+            },
+            "implementation": "lazy_handlers:triple",
+            "permissions": None,
+        }
+    )
+    assert "lazy_handlers" not in sys.modules
+
+    response = await rpc_agent.execute_function("triple", {"number": 2}, CONTEXT)
+    assert response["result"] == 6
+    assert "lazy_handlers" in sys.modules
+
+
+@pytest.mark.asyncio
+async def test_prewarm_lazy_implementations(
+    rpc_agent: RetoolRPC, tmp_path, monkeypatch
+):
+    (tmp_path / "prewarmed_handlers.py").write_text(
+        "def hello(args, context):\n    return 'hello'\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "prewarmed_handlers", raising=False)
+
+    rpc_agent.register(
+        {
+            "name": "hello",
+            "arguments": {},
+            "implementation": "prewarmed_handlers:hello",
+            "permissions": None,
+        }
+    )
+    rpc_agent.register(
+        {
+            "name": "missing",
+            "arguments": {},
+            "implementation": "prewarmed_handlers:does_not_exist",
+            "permissions": None,
+        }
+    )
+
+    await rpc_agent.prewarm()
+    assert "prewarmed_handlers" in sys.modules
+
+    with pytest.raises(AttributeError):
+        await rpc_agent.execute_function("missing", {}, CONTEXT)
+
+
+@pytest.mark.asyncio
+async def test_reuses_cached_registration(tmp_path, httpx_mock: HTTPXMock):
+    def create_agent(agent_uuid: Optional[str] = AGENT_UUID) -> RetoolRPC:
+        agent = RetoolRPC(
+            RetoolRPCConfig(
+                api_token="secret-api-token",
+                host=SERVER_HOST,
+                resource_id=RESOURCE_ID,
+                environment_name=ENVIRONMENT_NAME,
+                agent_uuid=agent_uuid,
+                registration_cache_dir=str(tmp_path),
+            )
+        )
+        agent.register(
+            {
+                "name": "hello",
+                "arguments": {},
+                "implementation": lambda args, context: "hello",
+                "permissions": None,
+            }
+        )
+        return agent
+
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
+        json={"versionHash": VERSION_HASH},
+        status_code=200,
+    )
+    assert create_agent()._use_cached_registration() is False
+    assert await create_agent().register_agent() == "done"
+
+    restarted_agent = create_agent()
+    assert restarted_agent._use_cached_registration() is True
+    assert restarted_agent._version_hash == VERSION_HASH
+    # The versionHash was registered for another agent UUID.
+    assert create_agent(str(uuid4()))._use_cached_registration() is False
+    assert create_agent(None)._use_cached_registration() is False
+
+    # The server rejects the cached versionHash, so the agent registers again.
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={"error": "Invalid versionHash"},
+        status_code=400,
+    )
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
+        json={"versionHash": "new-version-hash"},
+        status_code=200,
+    )
+    assert await restarted_agent.fetch_query_and_execute() == "continue"
+    assert restarted_agent._version_hash == "new-version-hash"
+    assert (
+        len(
+            httpx_mock.get_requests(url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent")
+        )
+        == 2
+    )
+
+
+@pytest.mark.asyncio
+async def test_reregisters_after_rejected_version_hash(
+    rpc_agent: RetoolRPC, httpx_mock: HTTPXMock
+):
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
+        json={"versionHash": VERSION_HASH},
+        status_code=200,
+    )
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={"error": "Stale versionHash"},
+        status_code=409,
+    )
+    assert await rpc_agent.register_agent() == "done"
+
+    # Registers again in place, but gives up after repeated rejections.
+    results = [await rpc_agent.fetch_query_and_execute() for _ in range(4)]
+    assert results == ["continue", "continue", "continue", "stop"]
+    registrations = httpx_mock.get_requests(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent"
+    )
+    assert len(registrations) == 4
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("status_code", [408, 429])
+async def test_retries_transient_client_errors(
+    rpc_agent: RetoolRPC, httpx_mock: HTTPXMock, status_code
+):
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
+        json={"error": "Too many requests"},
+        status_code=status_code,
+    )
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={"error": "Too many requests"},
+        status_code=status_code,
+    )
+
+    # Raised for the loop to back off and retry, instead of stopping the agent.
+    with pytest.raises(Exception, match=str(status_code)):
+        await rpc_agent.register_agent()
+    with pytest.raises(Exception, match=str(status_code)):
+        await rpc_agent.fetch_query_and_execute()
+    # The rejected poll is not taken for a rejected registration.
+    registrations = httpx_mock.get_requests(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent"
+    )
+    assert len(registrations) == 1
+
+
+@pytest.mark.asyncio
+async def test_stops_on_authentication_error(
+    rpc_agent: RetoolRPC, httpx_mock: HTTPXMock
+):
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={"error": "Unauthorized"},
+        status_code=401,
+    )
+
+    assert await rpc_agent.fetch_query_and_execute() == "stop"
+
+
+@pytest.mark.asyncio
+async def test_register_while_listening(rpc_agent: RetoolRPC, httpx_mock: HTTPXMock):
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
+        json={"versionHash": VERSION_HASH},
+        status_code=200,
+    )
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={"query": None},
+        status_code=200,
+    )
+    registrations_url = f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent"
+    assert await rpc_agent.register_agent() == "done"
+
+    # Nothing changed, no new registration.
+    assert await rpc_agent.fetch_query_and_execute() == "continue"
+    assert len(httpx_mock.get_requests(url=registrations_url)) == 1
+
+    rpc_agent.register(
+        {
+            "name": "hello",
+            "arguments": {},
+            "implementation": lambda args, context: "hello",
+            "permissions": None,
+        }
+    )
+    assert rpc_agent.unregister("throwsError") is True
+    assert rpc_agent.unregister("throwsError") is False
+
+    assert await rpc_agent.fetch_query_and_execute() == "continue"
+    registrations = httpx_mock.get_requests(url=registrations_url)
+    assert len(registrations) == 2
+    operations = json.loads(registrations[1].content)["operations"]
+    assert "hello" in operations
+    assert "throwsError" not in operations
+
+    with pytest.raises(FunctionNotFoundError):
+        await rpc_agent.execute_function("throwsError", {}, CONTEXT)
+
+    # A rejected function does not stop the agent, which keeps its registration.
+    httpx_mock.add_response(
+        url=registrations_url, json={"error": "Invalid operation"}, status_code=400
+    )
+    rpc_agent.register(
+        {
+            "name": "invalid",
+            "arguments": {},
+            "implementation": lambda args, context: "invalid",
+            "permissions": None,
+        }
+    )
+    assert await rpc_agent.fetch_query_and_execute() == "continue"
+    assert await rpc_agent.fetch_query_and_execute() == "continue"
+    assert rpc_agent._version_hash == VERSION_HASH
+    assert len(httpx_mock.get_requests(url=registrations_url)) == 3
+    pop_query_requests = httpx_mock.get_requests(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery"
+    )
+    assert json.loads(pop_query_requests[-1].content)["versionHash"] == VERSION_HASH
+
+
+@pytest.mark.asyncio
+async def test_hot_reload_handler_modules(rpc_agent: RetoolRPC, tmp_path, monkeypatch):
+    module_path = tmp_path / "reloaded_handlers.py"
+    module_path.write_text("def version(args, context):\n    return 1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "reloaded_handlers", raising=False)
+    module = importlib.import_module("reloaded_handlers")
+
+    for name, implementation in [
+        ("version", module.version),
+        ("lazyVersion", "reloaded_handlers:version"),
+    ]:
+        rpc_agent.register(
+            {
+                "name": name,
+                "arguments": {},
+                "implementation": implementation,
+                "permissions": None,
+            }
+        )
+    assert (await rpc_agent.execute_function("lazyVersion", {}, CONTEXT))["result"] == 1
+
+    watcher = ModuleWatcher(rpc_agent._logger, on_change=rpc_agent.reload_modules)
+    watcher.watch(["reloaded_handlers"])
+    module_path.write_text("def version(args, context):\n    return 2\n")
+    stat = os.stat(module_path)
+    os.utime(module_path, (stat.st_atime, stat.st_mtime + 10))
+    assert watcher.check() == ["reloaded_handlers"]
+
+    rpc_agent.reload_modules(["reloaded_handlers"])
+    for name in ("version", "lazyVersion"):
+        assert (await rpc_agent.execute_function(name, {}, CONTEXT))["result"] == 2
+
+
+@pytest.mark.asyncio
+async def test_long_polling_transport(httpx_mock: HTTPXMock):
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            polling_interval_ms=1000,
+            transport="long_polling",
+            long_poll_timeout_ms=20000,
+        )
+    )
+    rpc_agent.register(
+        {
+            "name": "hello",
+            "arguments": {},
+            "implementation": lambda args, context: "hello",
+            "permissions": None,
+        }
+    )
+    pop_query_url = f"{SERVER_HOST}/api/v1/retoolrpc/popQuery"
+    httpx_mock.add_response(
+        url=pop_query_url,
+        json={
+            "query": {
+                "queryUuid": QUERY_UUID,
+                "queryInfo": {"method": "hello", "parameters": {}, "context": {}},
+            }
+        },
+    )
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse", json={}
+    )
+    httpx_mock.add_response(url=pop_query_url, json={"query": None})
+
+    # A query was received, poll again right away.
+    assert await rpc_agent.fetch_query_and_execute() == "continue"
+    assert rpc_agent._next_poll_delay_ms == 0
+    assert (
+        json.loads(httpx_mock.get_requests(url=pop_query_url)[0].content)[
+            "waitTimeoutMs"
+        ]
+        == 20000
+    )
+
+    # The server answered an empty poll immediately, so it does not hold polls open.
+    assert await rpc_agent.fetch_query_and_execute() == "continue"
+    assert rpc_agent._next_poll_delay_ms == 1000
+
+
+def test_incomplete_transport_fails_at_construction():
+    class PopOnlyTransport(QueryTransport):
+        async def pop_query(self, api, options):
+            return await api.pop_query(options)
+
+    with pytest.raises(TypeError):
+        PopOnlyTransport()  # type: ignore[abstract]
+
+
+@pytest.mark.asyncio
+async def test_cache():
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            cache=CacheConfig(ttl_ms=50, stale_ms=5000, max_size=2),
+        )
+    )
+    loads = []
+
+    async def load_teams():
+        loads.append("teams")
+        await asyncio.sleep(0.01)
+        return ["Warriors"]
+
+    async def get_teams(args, context):
+        return await rpc_agent.cache.get_or_load("teams", load_teams)
+
+    rpc_agent.register(
+        {
+            "name": "getTeams",
+            "arguments": {},
+            "implementation": get_teams,
+            "permissions": None,
+        }
+    )
+
+    # Concurrent calls wait for a single load.
+    results = await asyncio.gather(
+        *(rpc_agent.execute_function("getTeams", {}, CONTEXT) for _ in range(3))
+    )
+    assert [result["result"] for result in results] == [["Warriors"]] * 3
+    assert loads == ["teams"]
+
+    # An expired value is served while it is reloaded in the background.
+    await asyncio.sleep(0.06)
+    assert await rpc_agent.cache.get_or_load("teams", load_teams) == ["Warriors"]
+    assert "teams" not in rpc_agent.cache
+    await asyncio.sleep(0.02)
+    assert "teams" in rpc_agent.cache
+    assert await rpc_agent.cache.get_or_load("teams", load_teams) == ["Warriors"]
+    assert loads == ["teams", "teams"]
+
+    # Failed loads are not cached.
+    def fail():
+        raise ValueError("Database is down")
+
+    with pytest.raises(ValueError):
+        await rpc_agent.cache.get_or_load("players", fail)
+    assert await rpc_agent.cache.get_or_load("players", lambda: ["Steph"]) == ["Steph"]
+
+    # The least recently used value is dropped.
+    rpc_agent.cache.set("coaches", ["Steve"])
+    assert rpc_agent.cache.get("teams") is None
+    assert rpc_agent.cache.get("coaches") == ["Steve"]
+
+    assert rpc_agent.metrics.snapshot()["__cache__"] == {
+        "cache_misses": 5,
+        "cache_hits": 1,
+        "cache_stale_hits": 1,
+        "cache_loads": 4,
+        "cache_load_errors": 1,
+        "cache_evictions": 1,
+        "cache_size": 2,
+    }
+    await rpc_agent.cache.close()
+
+
+@pytest.mark.asyncio
+async def test_cache_reload_error(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("retoolrpc.utils.cache.time.monotonic", lambda: now[0])
+    cache = AsyncCache(CacheConfig(ttl_ms=10, stale_ms=30))
+    cache.set("teams", ["Warriors"])
+    reloading = asyncio.Event()
+
+    async def fail():
+        await reloading.wait()
+        raise ValueError("Database is down")
+
+    # A stale hit serves the expired value while the reload fails.
+    now[0] += 0.02
+    assert await cache.get_or_load("teams", fail) == ["Warriors"]
+
+    # A miss that joins the failing reload gets its error, not None.
+    now[0] += 0.05
+    missed = asyncio.create_task(cache.get_or_load("teams", fail))
+    await asyncio.sleep(0)
+    reloading.set()
+    with pytest.raises(ValueError, match="Database is down"):
+        await missed
+    assert cache.stats()["cache_load_errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_pop_query_reuses_client_and_body(
+    rpc_agent: RetoolRPC, httpx_mock: HTTPXMock
+):
+    pop_query_url = f"{SERVER_HOST}/api/v1/retoolrpc/popQuery"
+    for _ in range(3):
+        httpx_mock.add_response(url=pop_query_url, json={"query": None})
+
+    rpc_agent._version_hash = VERSION_HASH
+    await rpc_agent.fetch_query_and_execute()
+    client = rpc_agent._retool_api._client
+    body = rpc_agent._retool_api._pop_query_body
+    await rpc_agent.fetch_query_and_execute()
+    assert rpc_agent._retool_api._client is client
+    assert rpc_agent._retool_api._pop_query_body is body
+
+    # A new registration changes the body.
+    rpc_agent._version_hash = "new-version-hash"
+    await rpc_agent.fetch_query_and_execute()
+    requests = httpx_mock.get_requests(url=pop_query_url)
+    assert [json.loads(request.content)["versionHash"] for request in requests] == [
+        VERSION_HASH,
+        VERSION_HASH,
+        "new-version-hash",
+    ]
+    assert requests[0].headers["Authorization"] == "Bearer secret-api-token"
+
+    await rpc_agent._retool_api.aclose()
+    assert client.is_closed
+
+
+async def post_query_response(
+    rpc_agent: RetoolRPC, httpx_mock: HTTPXMock, method: str
+) -> httpx.Request:
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={
+            "query": {
+                "queryUuid": QUERY_UUID,
+                "queryInfo": {"method": method, "parameters": {}, "context": {}},
+            }
+        },
+    )
+    post_query_response_url = f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse"
+
+    async def read_body(request: httpx.Request) -> httpx.Response:
+        # Like a server, read the streamed body before responding.
+        await request.aread()
+        return httpx.Response(200, json={})
+
+    httpx_mock.add_callback(read_body, url=post_query_response_url)
+
+    assert await rpc_agent.fetch_query_and_execute() == "continue"
+    return httpx_mock.get_requests(url=post_query_response_url)[-1]
+
+
+@pytest.mark.asyncio
+async def test_post_query_response_body(rpc_agent: RetoolRPC, httpx_mock: HTTPXMock):
+    rpc_agent._version_hash = VERSION_HASH
+    request = await post_query_response(rpc_agent, httpx_mock, "asyncGetCurrentDate")
+    body = json.loads(request.content)
+
+    metadata = body.pop("metadata")
+    assert body == {
+        "resourceId": RESOURCE_ID,
+        "environmentName": ENVIRONMENT_NAME,
+        "versionHash": VERSION_HASH,
+        "agentUuid": AGENT_UUID,
+        "queryUuid": QUERY_UUID,
+        "status": "success",
+        "data": CURRENT_DATE.isoformat(),
+        "error": None,
+    }
+    assert metadata["packageLanguage"] == "python"
+    assert metadata["packageVersion"] == __version__
+    assert metadata["parameters"] == {}
+    assert set(metadata) == {
+        "packageLanguage",
+        "packageVersion",
+        "agentReceivedQueryAt",
+        "agentFinishedQueryAt",
+        "parameters",
+        "timings",
+    }
+    received_at = datetime.fromisoformat(metadata["agentReceivedQueryAt"])
+    assert received_at.utcoffset() == timedelta(0)
+    assert set(metadata["timings"]) == {
+        "decodeNs",
+        "parseNs",
+        "executeNs",
+        "serializeNs",
+    }
+    assert all(
+        isinstance(value, int) and value >= 0 for value in metadata["timings"].values()
+    )
+
+    # The metrics also have the post duration.
+    timings = []
+    rpc_agent.metrics.add_timings_hook(
+        lambda function_name, query_timings: timings.append(
+            (function_name, query_timings)
+        )
+    )
+    await post_query_response(rpc_agent, httpx_mock, "asyncGetCurrentDate")
+    assert [function_name for function_name, _ in timings] == ["asyncGetCurrentDate"]
+    assert timings[0][1]["post_ns"] > 0
+    assert rpc_agent.metrics.counter("asyncGetCurrentDate", "execute_ns") > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "result_format,expected_data",
+    [
+        (
+            "columnar",
+            {"columns": ["id", "name"], "data": [[1, 2], ["Steph", "Klay"]]},
+        ),
+        ("rows", [{"id": 1, "name": "Steph"}, {"id": 2, "name": "Klay"}]),
+    ],
+)
+async def test_columnar_results(
+    httpx_mock: HTTPXMock, result_format: str, expected_data
+):
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            result_format=result_format,  # type: ignore[arg-type]
+        )
+    )
+    rpc_agent.register(
+        {
+            "name": "players",
+            "arguments": {},
+            "implementation": lambda args, context: {
+                "id": [1, 2],
+                "name": ["Steph", "Klay"],
+            },
+            "permissions": None,
+            "columnar": True,
+        }
+    )
+    rpc_agent.register(
+        {
+            "name": "player",
+            "arguments": {},
+            "implementation": lambda args, context: {"id": [1, 2], "name": "Steph"},
+            "permissions": None,
+            "columnar": True,
+        }
+    )
+
+    body = json.loads(
+        (await post_query_response(rpc_agent, httpx_mock, "players")).content
+    )
+    assert body["data"] == expected_data
+    assert body["metadata"]["resultFormat"] == result_format
+
+    # Columns of different lengths are not tabular and are sent unchanged.
+    body = json.loads(
+        (await post_query_response(rpc_agent, httpx_mock, "player")).content
+    )
+    assert body["data"] == {"id": [1, 2], "name": "Steph"}
+    assert "resultFormat" not in body["metadata"]
+
+
+@pytest.mark.asyncio
+async def test_columnar_record_array_results(httpx_mock: HTTPXMock):
+    np = pytest.importorskip("numpy")
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            result_format="columnar",
+        )
+    )
+    rpc_agent.register(
+        {
+            "name": "points",
+            "arguments": {},
+            "implementation": lambda args, context: np.array(
+                [(1, 30.5), (2, 22.0)], dtype=[("id", "i8"), ("points", "f8")]
+            ),
+            "permissions": None,
+        }
+    )
+
+    body = json.loads(
+        (await post_query_response(rpc_agent, httpx_mock, "points")).content
+    )
+    assert body["data"] == {"columns": ["id", "points"], "data": [[1, 2], [30.5, 22.0]]}
+    assert body["metadata"]["resultFormat"] == "columnar"
+
+
+@pytest.mark.asyncio
+async def test_result_size_limits(httpx_mock: HTTPXMock):
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            max_result_bytes=1000,
+        )
+    )
+    rows = [{"id": i, "name": f"Player {i}"} for i in range(100)]
+    for name, options in {
+        "rows": {},
+        "truncatedRows": {"truncate_oversized_results": True},
+        "largeRows": {"max_result_bytes": 10000},
+        "text": {"truncate_oversized_results": True},
+    }.items():
+        rpc_agent.register(
+            {
+                "name": name,
+                "arguments": {},
+                "implementation": lambda args, context, name=name: (
+                    "x" * 2000 if name == "text" else rows
+                ),
+                "permissions": None,
+                **options,  # type: ignore[typeddict-item]
+            }
+        )
+
+    body = json.loads(
+        (await post_query_response(rpc_agent, httpx_mock, "rows")).content
+    )
+    assert body["status"] == "error"
+    assert body["data"] is None
+    assert body["error"]["name"] == "ResultTooLargeError"
+    assert body["error"]["code"] == 413
+    assert body["error"]["details"]["maxResultBytes"] == 1000
+
+    body = json.loads(
+        (await post_query_response(rpc_agent, httpx_mock, "truncatedRows")).content
+    )
+    assert body["status"] == "success"
+    assert body["metadata"]["truncated"] is True
+    assert body["data"] == rows[: len(body["data"])]
+    assert 0 < len(json.dumps(body["data"], separators=(",", ":"))) <= 1000
+
+    body = json.loads(
+        (await post_query_response(rpc_agent, httpx_mock, "largeRows")).content
+    )
+    assert body["data"] == rows
+    assert "truncated" not in body["metadata"]
+
+    # Only rows can be truncated.
+    body = json.loads(
+        (await post_query_response(rpc_agent, httpx_mock, "text")).content
+    )
+    assert body["error"]["name"] == "ResultTooLargeError"
+
+
+def test_result_size_estimate_counts_encoded_bytes():
+    for value in ["é" * 100, "日本" * 50, [{"name": f"Jürgen {i}"} for i in range(50)]]:
+        assert serialization.estimate_size(value) >= len(serialization.dumps(value))
+
+    np = pytest.importorskip("numpy")
+
+    class UnconvertibleArray(np.ndarray):
+        def tolist(self):
+            raise AssertionError("converted")
+
+    # An array that cannot fit is not converted to a list.
+    array = np.zeros(1000).view(UnconvertibleArray)
+    assert serialization.estimate_size({"column": array}, limit=1000) > 1000
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_simdjson", [True, False])
+async def test_lazy_arguments(httpx_mock: HTTPXMock, monkeypatch, use_simdjson):
+    from retoolrpc.utils import arguments
+
+    if use_simdjson:
+        pytest.importorskip("simdjson")
+    else:
+        monkeypatch.setattr(arguments, "simdjson", None)
+
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            lazy_arguments=True,
+        )
+    )
+    rpc_agent.register(
+        {
+            "name": "firstRow",
+            "arguments": {
+                "table": {
+                    "type": "string",
+                    "description": "Table",
+                    "required": True,
+                    "array": False,
+                },
+                "rows": {
+                    "type": "json",
+                    "description": "Rows",
+                    "required": False,
+                    "array": False,
+                },
+                "limit": {
+                    "type": "number",
+                    "description": "Limit",
+                    "required": False,
+                    "array": False,
+                },
+            },
+            "implementation": lambda args, context: (
+                args["table"],
+                args["rows"][0] if args.get("limit") else None,
+            ),
+            "permissions": None,
+        }
+    )
+
+    async def call(parameters):
+        httpx_mock.add_response(
+            url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+            json={
+                "query": {
+                    "queryUuid": QUERY_UUID,
+                    "queryInfo": {
+                        "method": "firstRow",
+                        "parameters": parameters,
+                        "context": CONTEXT,
+                    },
+                }
+            },
+        )
+        post_query_response_url = f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse"
+        httpx_mock.add_response(url=post_query_response_url, json={})
+        assert await rpc_agent.fetch_query_and_execute() == "continue"
+        return json.loads(
+            httpx_mock.get_requests(url=post_query_response_url)[-1].content
+        )
+
+    rows = [{"id": i} for i in range(10)]
+    body = await call({"table": "players", "rows": rows, "limit": 0})
+    assert body["data"] == ["players", None]
+    # Only the accessed arguments are materialized.
+    assert body["metadata"]["parameters"] == {"table": "players", "limit": 0}
+
+    body = await call({"table": "players", "rows": rows, "limit": "1"})
+    assert body["data"] == ["players", {"id": 0}]
+    assert body["metadata"]["parameters"]["limit"] == 1.0
+
+    body = await call({"rows": rows})
+    assert body["error"]["name"] == "InvalidArgumentsError"
+    assert "required" in body["error"]["message"]
+
+    body = await call({"table": "players", "limit": "many"})
+    assert body["error"]["name"] == "InvalidArgumentsError"
+    assert '"limit" should be of type "number"' in body["error"]["message"]
+
+
+@pytest.mark.asyncio
+async def test_middlewares(httpx_mock: HTTPXMock):
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+        )
+    )
+    calls = []
+
+    def sync_middleware(call: FunctionCall, call_next):
+        calls.append(f"sync {call.function_name}")
+        call.arguments = {**call.arguments, "name": call.arguments["name"].upper()}
+        return call_next(call)
+
+    async def async_middleware(call: FunctionCall, call_next):
+        calls.append(f"async {call.function_name}")
+        result = await call_next(call)
+        call.metadata["greeted"] = call.context["user_email"]
+        call.metadata["packageVersion"] = "0.0.0"
+        return f"{result}!"
+
+    async def function_middleware(call: FunctionCall, call_next):
+        calls.append(f"function {call.function_name}")
+        return await call_next(call)
+
+    name_argument = {
+        "name": {
+            "type": "string",
+            "description": "Name",
+            "required": True,
+            "array": False,
+        }
+    }
+    rpc_agent.register(
+        {
+            "name": "hello",
+            "arguments": name_argument,
+            "implementation": lambda args, context: f"Hello {args['name']}",
+            "permissions": None,
+            "middlewares": [function_middleware],
+        }
+    )
+    rpc_agent.register(
+        {
+            "name": "plain",
+            "arguments": name_argument,
+            "implementation": lambda args, context: args["name"],
+            "permissions": None,
+        }
+    )
+    assert "plain" not in rpc_agent._pipelines
+
+    # Middlewares added after registration apply to registered functions.
+    rpc_agent.use(sync_middleware)
+    rpc_agent.use(async_middleware)
+
+    response = await rpc_agent.execute_function("hello", {"name": "Steph"}, CONTEXT)
+    assert response["result"] == "Hello STEPH!"
+    assert response["arguments"] == {"name": "STEPH"}
+    assert response["metadata"] == {
+        "greeted": "steph@warriors.com",
+        "packageVersion": "0.0.0",
+    }
+    assert calls == ["sync hello", "async hello", "function hello"]
+
+    calls.clear()
+    assert (await rpc_agent.execute_function("plain", {"name": "Klay"}, CONTEXT))[
+        "result"
+    ] == "KLAY!"
+    assert calls == ["sync plain", "async plain"]
+
+    # Middleware metadata is sent with the response.
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={
+            "query": {
+                "queryUuid": QUERY_UUID,
+                "queryInfo": {
+                    "method": "plain",
+                    "parameters": {"name": "Klay"},
+                    "context": CONTEXT,
+                },
+            }
+        },
+    )
+    post_query_response_url = f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse"
+    httpx_mock.add_response(url=post_query_response_url, json={})
+    assert await rpc_agent.fetch_query_and_execute() == "continue"
+    body = json.loads(httpx_mock.get_requests(url=post_query_response_url)[0].content)
+    assert body["metadata"]["greeted"] == "steph@warriors.com"
+    # Middlewares cannot overwrite the metadata of the agent.
+    assert body["metadata"]["packageVersion"] == __version__
+    assert body["metadata"]["parameters"] == {"name": "KLAY"}
+    assert "FunctionCall" in retoolrpc.__all__
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("retoolrpc.utils.rate_limit.time.monotonic", lambda: now[0])
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr("retoolrpc.utils.rate_limit.asyncio.sleep", sleep)
+
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+        )
+    )
+    rate_limiter = RateLimiter(
+        rate_per_second=2, burst=2, key="user_email", max_wait_ms=500, max_keys=2
+    )
+    rpc_agent.register(
+        {
+            "name": "hello",
+            "arguments": {},
+            "implementation": lambda args, context: "hello",
+            "permissions": None,
+            "middlewares": [rate_limiter],
+        }
+    )
+
+    def context(user_email: str) -> RetoolContext:
+        return {**CONTEXT, "user_email": user_email}
+
+    async def call(user_email: str):
+        return await rpc_agent.execute_function("hello", {}, context(user_email))
+
+    # The burst is served right away, the next call waits for a token.
+    for _ in range(3):
+        await call("steph@warriors.com")
+    assert sleeps == [0.5]
+
+    # The next token is more than max_wait_ms away.
+    with pytest.raises(RateLimitExceededError) as error:
+        await call("steph@warriors.com")
+    assert error.value.code == 429
+    assert error.value.details["retryAfterMs"] == 1000
+
+    # Other users have their own bucket.
+    await call("klay@warriors.com")
+    assert sleeps == [0.5]
+
+    now[0] += 1
+    await call("steph@warriors.com")
+    assert sleeps == [0.5]
+
+    # Least recently used buckets are dropped.
+    await call("draymond@warriors.com")
+    assert list(rate_limiter._buckets) == [
+        ("hello", "steph@warriors.com"),
+        ("hello", "draymond@warriors.com"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_keys_on_query_context(httpx_mock: HTTPXMock):
+    rpc_agent = drain_agent()
+    rpc_agent.register(
+        {
+            "name": "hello",
+            "arguments": {},
+            "implementation": lambda args, context: "hello",
+            "permissions": None,
+            "middlewares": [RateLimiter(rate_per_second=1, key="user_email")],
+        }
+    )
+    post_query_response_url = f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse"
+    httpx_mock.add_response(url=post_query_response_url, json={})
+    for user_email in ["steph@warriors.com", "klay@warriors.com", "klay@warriors.com"]:
+        httpx_mock.add_response(
+            url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+            json={
+                "query": {
+                    "queryUuid": QUERY_UUID,
+                    "queryInfo": {
+                        "method": "hello",
+                        "parameters": {},
+                        "context": {
+                            "userEmail": user_email,
+                            "organizationName": "warriors",
+                        },
+                    },
+                }
+            },
+        )
+        assert await rpc_agent.fetch_query_and_execute() == "continue"
+
+    statuses = [
+        json.loads(request.content)["status"]
+        for request in httpx_mock.get_requests(url=post_query_response_url)
+    ]
+    assert statuses == ["success", "success", "error"]
+
+
+@pytest.mark.asyncio
+async def test_retry_policy(httpx_mock: HTTPXMock, monkeypatch):
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr("retoolrpc.utils.retry.asyncio.sleep", sleep)
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+        )
+    )
+    failures = {"flaky": 2, "notIdempotent": 2, "broken": 1}
+
+    def implementation(function_name):
+        def run(args, context):
+            if failures[function_name] > 0:
+                failures[function_name] -= 1
+                raise ConnectionError("Deadlock detected")
+            return "done"
+
+        return run
+
+    retry = RetryPolicy(max_attempts=3, initial_backoff_ms=100)
+    for function_name, options in {
+        "flaky": {"idempotent": True, "retry": retry},
+        "notIdempotent": {"retry": retry},
+        "broken": {
+            "idempotent": True,
+            "retry": retry._replace(retryable_exceptions=(TimeoutError,)),
+        },
+    }.items():
+        rpc_agent.register(
+            {
+                "name": function_name,
+                "arguments": {},
+                "implementation": implementation(function_name),
+                "permissions": None,
+                **options,  # type: ignore[typeddict-item]
+            }
+        )
+
+    response = await rpc_agent.execute_function("flaky", {}, CONTEXT)
+    assert response["result"] == "done"
+    assert response["metadata"] == {"attempts": 3}
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.1 and 0 <= sleeps[1] <= 0.2
+
+    with pytest.raises(ConnectionError):
+        await rpc_agent.execute_function("notIdempotent", {}, CONTEXT)
+    assert failures["notIdempotent"] == 1
+
+    # Errors that are not retryable fail right away.
+    with pytest.raises(ConnectionError) as excinfo:
+        await rpc_agent.execute_function("broken", {}, CONTEXT)
+    assert len(sleeps) == 2
+    assert excinfo.value.retoolrpc_metadata == {"attempts": 1}  # type: ignore
+
+    # The attempts of a failed call are sent with the error response.
+    failures["flaky"] = 3
+    body = json.loads(
+        (await post_query_response(rpc_agent, httpx_mock, "flaky")).content
+    )
+    assert body["status"] == "error"
+    assert body["metadata"]["attempts"] == 3
+
+
+@pytest.mark.asyncio
+async def test_timeout():
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+        )
+    )
+    attempts = []
+
+    async def slow(args, context):
+        attempts.append(1)
+        await asyncio.sleep(1)
+
+    rpc_agent.register(
+        {
+            "name": "slow",
+            "arguments": {},
+            "implementation": slow,
+            "permissions": None,
+            "idempotent": True,
+            "retry": RetryPolicy(initial_backoff_ms=1),
+            "timeout_ms": 50,
+        }
+    )
+
+    with pytest.raises(TimeoutError, match="timed out after 50ms"):
+        await rpc_agent.execute_function("slow", {}, CONTEXT)
+    # The timeout covers all attempts.
+    assert len(attempts) == 1
+
+    # Sync implementations run in a thread, so they can time out too.
+    finished = threading.Event()
+    rpc_agent.register(
+        {
+            "name": "slowSync",
+            "arguments": {},
+            "implementation": lambda args, context: finished.wait(1),
+            "permissions": None,
+            "timeout_ms": 50,
+        }
+    )
+    with pytest.raises(TimeoutError, match="timed out after 50ms"):
+        await rpc_agent.execute_function("slowSync", {}, CONTEXT)
+    finished.set()
+
+    # Their threads are owned by the agent, not taken from the default executor.
+    rpc_agent.register(
+        {
+            "name": "threadName",
+            "arguments": {},
+            "implementation": lambda args, context: threading.current_thread().name,
+            "permissions": None,
+            "timeout_ms": 1000,
+        }
+    )
+    result = await rpc_agent.execute_function("threadName", {}, CONTEXT)
+    assert result["result"].startswith("retoolrpc-timeout")
+    executor = rpc_agent._timeout_executor
+    await rpc_agent._shutdown([])
+    assert executor is not None and executor._shutdown
+    assert rpc_agent._timeout_executor is None
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(
+        "retoolrpc.utils.circuit_breaker.time.monotonic", lambda: now[0]
+    )
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+        )
+    )
+    dependency = {"up": False}
+
+    def call_dependency(args, context):
+        if not dependency["up"]:
+            raise ConnectionError("Dependency is down")
+        return "ok"
+
+    rpc_agent.register(
+        {
+            "name": "downstream",
+            "arguments": {},
+            "implementation": call_dependency,
+            "permissions": None,
+            "circuit_breaker": CircuitBreakerConfig(
+                failure_rate_threshold=0.5,
+                window_size=4,
+                minimum_calls=4,
+                open_duration_ms=10000,
+            ),
+        }
+    )
+
+    async def call():
+        return await rpc_agent.execute_function("downstream", {}, CONTEXT)
+
+    for _ in range(4):
+        with pytest.raises(ConnectionError):
+            await call()
+    assert rpc_agent.metrics.gauge("downstream", "circuit_state") == "open"
+
+    # Fails fast while open, without calling the dependency.
+    dependency["up"] = True
+    with pytest.raises(CircuitOpenError) as error:
+        await call()
+    assert error.value.code == 503
+    assert error.value.details["retryAfterMs"] == 10000
+    assert rpc_agent.metrics.counter("downstream", "circuit_rejected") == 1
+
+    # A failed trial call reopens the circuit.
+    now[0] += 10
+    dependency["up"] = False
+    with pytest.raises(ConnectionError):
+        await call()
+    assert rpc_agent.metrics.gauge("downstream", "circuit_state") == "open"
+
+    # A successful trial call closes it.
+    now[0] += 10
+    dependency["up"] = True
+    assert (await call())["result"] == "ok"
+    assert rpc_agent.metrics.gauge("downstream", "circuit_state") == "closed"
+    assert rpc_agent.metrics.snapshot()["downstream"] == {
+        "calls": 7,
+        "errors": 6,
+        "circuit_rejected": 1,
+        "circuit_state": "closed",
+    }
+
+
+def test_error_stack_modes():
+    # Alternate between two functions so the traceback is not collapsed.
+    def fail(depth: int):
+        if depth == 0:
+            raise ValueError("Deep failure")
+        call_fail(depth - 1)
+
+    def call_fail(depth: int):
+        fail(depth)
+
+    try:
+        fail(10)
+    except ValueError as err:
+        error = err
+
+    full = create_agent_server_error(error)
+    assert full["stack"] is not None and full["stack"].count("  File ") == 22
+
+    truncated = create_agent_server_error(error, "truncated", 3)
+    assert truncated["stack"] is not None and truncated["stack"].count("  File ") == 3
+    assert full["stack"].endswith(truncated["stack"])
+    assert truncated["message"] == "Deep failure"
+
+    assert create_agent_server_error(error, "none")["stack"] is None
+
+    try:
+        raise InvalidArgumentsError("Argument is required")
+    except InvalidArgumentsError as err:
+        client_error = create_agent_server_error(err)
+    assert client_error["name"] == "InvalidArgumentsError"
+    assert client_error["stack"] is None
+
+
+def parse_multipart(request) -> Dict[str, bytes]:
+    boundary = request.headers["Content-Type"].split("boundary=")[1].encode()
+    parts = {}
+    for part in request.content.split(b"--" + boundary)[1:-1]:
+        headers, _, body = part[2:-2].partition(b"\r\n\r\n")
+        name = headers.split(b'name="')[1].split(b'"')[0].decode()
+        parts[name] = body
+    return parts
+
+
+@pytest.mark.asyncio
+async def test_binary_results_are_sent_as_attachments(httpx_mock: HTTPXMock, tmp_path):
+    report = tmp_path / "report.csv"
+    report.write_bytes(b"id,name\n1,Steph\n")
+
+    def seeked(file):
+        file.seek(len(b"id,name\n"))
+        return file
+
+    def pipe(content: bytes):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, content)
+        os.close(write_fd)
+        return os.fdopen(read_fd, "rb")
+
+    results = {
+        "bytes": b"\x89PNG\r\n\x00binary",
+        "memoryview": memoryview(bytearray(b"\x00\x01\x02")),
+        "path": report,
+        "file": lambda: open(report, "rb"),
+        "seekedFile": lambda: seeked(open(report, "rb")),
+        "pipe": lambda: pipe(b"streamed"),
+        "attachment": Attachment(b"%PDF-1.7", content_type="application/pdf"),
+    }
+    rpc_agent = RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+        )
+    )
+    for name, result in results.items():
+        rpc_agent.register(
+            {
+                "name": name,
+                "arguments": {},
+                "implementation": lambda args, context, result=result: (
+                    result() if callable(result) else result
+                ),
+                "permissions": None,
+            }
+        )
+
+    expected = {
+        "bytes": (b"\x89PNG\r\n\x00binary", "application/octet-stream", None),
+        "memoryview": (b"\x00\x01\x02", "application/octet-stream", None),
+        "path": (b"id,name\n1,Steph\n", "application/octet-stream", "report.csv"),
+        "file": (b"id,name\n1,Steph\n", "application/octet-stream", "report.csv"),
+        "seekedFile": (b"1,Steph\n", "application/octet-stream", "report.csv"),
+        "pipe": (b"streamed", "application/octet-stream", None),
+        "attachment": (b"%PDF-1.7", "application/pdf", None),
+    }
+    for name, (content, content_type, filename) in expected.items():
+        request = await post_query_response(rpc_agent, httpx_mock, name)
+        parts = parse_multipart(request)
+        body = json.loads(parts["response"])
+
+        assert parts["attachment"] == content
+        assert body["metadata"]["resultFormat"] == "attachment"
+        # The size of a pipe is not known upfront, it is sent chunked.
+        size = None if name == "pipe" else len(content)
+        assert body["data"] == {
+            "part": "attachment",
+            "size": size,
+            "contentType": content_type,
+            "filename": filename,
+        }
+        assert ("Content-Length" in request.headers) == (size is not None)
+
+
+@pytest.mark.asyncio
+async def test_attachment_closed_when_post_fails(httpx_mock: HTTPXMock, tmp_path):
+    report = tmp_path / "report.csv"
+    report.write_bytes(b"id,name\n1,Steph\n")
+    rpc_agent = drain_agent()
+    files = []
+
+    def open_report(args, context):
+        files.append(open(report, "rb"))
+        return files[-1]
+
+    rpc_agent.register(
+        {
+            "name": "report",
+            "arguments": {},
+            "implementation": open_report,
+            "permissions": None,
+        }
+    )
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={
+            "query": {
+                "queryUuid": QUERY_UUID,
+                "queryInfo": {"method": "report", "parameters": {}, "context": {}},
+            }
+        },
+    )
+    httpx_mock.add_exception(
+        httpx.ConnectError("Connection refused"),
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse",
+    )
+    with pytest.raises(httpx.ConnectError):
+        await rpc_agent.fetch_query_and_execute()
+    assert files[0].closed
+
+
+@pytest.mark.asyncio
+async def test_unreadable_binary_result_is_reported(httpx_mock: HTTPXMock, tmp_path):
+    rpc_agent = drain_agent()
+    rpc_agent.register(
+        {
+            "name": "report",
+            "arguments": {},
+            "implementation": lambda args, context: tmp_path / "missing.csv",
             "permissions": None,
         }
     )
+    request = await post_query_response(rpc_agent, httpx_mock, "report")
+    assert not request.headers["content-type"].startswith("multipart/")
+    body = json.loads(request.content)
+    assert body["status"] == "error"
+    assert "missing.csv" in body["error"]["message"]
 
-    yield rpc_agent
+
+def drain_agent(**config) -> RetoolRPC:
+    return RetoolRPC(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host=SERVER_HOST,
+            resource_id=RESOURCE_ID,
+            prewarm_imports=False,
+            **config,
+        )
+    )
 
 
-@pytest.mark.asyncio
-async def test_no_query_result(rpc_agent: RetoolRPC, httpx_mock: HTTPXMock):
-    # Mock the registration request
+def add_slow_query_responses(httpx_mock: HTTPXMock) -> None:
     httpx_mock.add_response(
         url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
         json={"versionHash": VERSION_HASH},
-        status_code=200,
     )
-
-    result = await rpc_agent.register_agent()
-    assert result == "done"
-
-    # Mock the fetch query request
     httpx_mock.add_response(
         url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
-        json={"query": None},
-        status_code=200,
+        json={
+            "query": {
+                "queryUuid": QUERY_UUID,
+                "queryInfo": {"method": "slow", "parameters": {}, "context": {}},
+            }
+        },
     )
 
-    result = await rpc_agent.fetch_query_and_execute()
-    assert result == "continue"
-
 
 @pytest.mark.asyncio
-async def test_successful_query_result(rpc_agent: RetoolRPC, httpx_mock: HTTPXMock):
-    popQueryResponse = {
-        "query": {
-            "queryUuid": QUERY_UUID,
-            "queryInfo": {
-                "resourceId": RESOURCE_ID,
-                "environmentName": ENVIRONMENT_NAME,
-                "context": {
-                    "userEmail": "admin@seed.retool.com",
-                    "organizationName": "seed.retool.com",
-                },
-                "method": "plusTwoNumbers",
-                "parameters": {
-                    "number1": 1,
-                    "number2": 2,
-                },
-            },
-        },
-    }
-
-    # Mock the popQuery HTTP request
-    httpx_mock.add_response(
-        method="POST",
-        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
-        json=popQueryResponse,
-        status_code=200,
+async def test_drains_running_query_on_sigterm(httpx_mock: HTTPXMock, tmp_path):
+    previous_agent = subprocess.Popen(
+        [sys.executable, "-c", "import time; time.sleep(30)"]
     )
+    pid_file = tmp_path / "agent.pid"
+    pid_file.write_text(str(previous_agent.pid))
 
-    # Mock the postQueryResponse HTTP request
-    httpx_mock.add_response(
-        method="POST",
-        url=f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse",
-        json={
-            "resourceId": RESOURCE_ID,
-            "environmentName": ENVIRONMENT_NAME,
-            "versionHash": VERSION_HASH,
-            "agentUuid": AGENT_UUID,
-            "queryUuid": QUERY_UUID,
-            "status": "success",
-            "data": 3,
-            "metadata": {
-                "packageLanguage": "javascript",
-                "packageVersion": __version__,
-                "agentReceivedQueryAt": datetime.now().isoformat(),
-                "agentFinishedQueryAt": datetime.now().isoformat(),
-                "parameters": {
-                    "number1": 1,
-                    "number2": 2,
-                },
-            },
-        },
-        status_code=200,
-    )
+    rpc_agent = drain_agent(pid_file=str(pid_file))
+    started, finish = asyncio.Event(), asyncio.Event()
 
-    result = await rpc_agent.fetch_query_and_execute()
+    async def slow(args, context):
+        started.set()
+        await finish.wait()
+        return "done"
 
-    assert result == "continue"
+    rpc_agent.register(
+        {"name": "slow", "arguments": {}, "implementation": slow, "permissions": None}
+    )
+    add_slow_query_responses(httpx_mock)
+    post_query_response_url = f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse"
+    httpx_mock.add_response(url=post_query_response_url, json={})
+
+    listening = asyncio.create_task(rpc_agent.listen())
+    await asyncio.wait_for(started.wait(), 5)
+
+    # The new agent took over the pid file and asked the previous one to exit.
+    assert pid_file.read_text() == str(os.getpid())
+    assert previous_agent.wait(5) == -signal.SIGTERM
+
+    # The agent handles SIGTERM, raising it does not kill the test run.
+    assert signal.getsignal(signal.SIGTERM) not in (signal.SIG_DFL, signal.SIG_IGN)
+    signal.raise_signal(signal.SIGTERM)
+    await asyncio.sleep(0.05)
+    assert not listening.done()
+    finish.set()
+    await asyncio.wait_for(listening, 5)
+
+    # The running query finished and was posted, and no query was popped after.
+    (post_request,) = httpx_mock.get_requests(url=post_query_response_url)
+    assert json.loads(post_request.content)["data"] == "done"
+    assert (
+        len(httpx_mock.get_requests(url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery"))
+        == 1
+    )
+    assert not pid_file.exists()
 
 
 @pytest.mark.asyncio
-async def test_should_continue_after_returning_error_result(
-    rpc_agent: RetoolRPC, httpx_mock: HTTPXMock
-):
-    pop_query_response = {
-        "query": {
-            "queryUuid": QUERY_UUID,
-            "queryInfo": {
-                "resourceId": RESOURCE_ID,
-                "environmentName": ENVIRONMENT_NAME,
-                "context": {
-                    "userEmail": "admin@seed.retool.com",
-                    "organizationName": "seed.retool.com",
-                },
-                "method": "throwsError",
-                "parameters": {},
-            },
-        }
-    }
-
-    post_query_response = {
-        "resourceId": RESOURCE_ID,
-        "environmentName": ENVIRONMENT_NAME,
-        "versionHash": VERSION_HASH,
-        "agentUuid": AGENT_UUID,
-        "queryUuid": QUERY_UUID,
-        "status": "error",
-        "metadata": {
-            "packageLanguage": "python",
-            "packageVersion": __version__,
-            "agentReceivedQueryAt": datetime.now().isoformat(),
-            "agentFinishedQueryAt": datetime.now().isoformat(),
-            "parameters": None,  # error thrown, no parameters
-        },
-        "error": {"name": "AgentServerError", "message": "This is the error message."},
-    }
+async def test_drain_timeout_cancels_running_query(httpx_mock: HTTPXMock):
+    rpc_agent = drain_agent(shutdown_signals=None, drain_timeout_ms=50)
+    started, cancelled = asyncio.Event(), asyncio.Event()
+
+    async def slow(args, context):
+        started.set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
 
-    # Mock the popQuery HTTP request
+    rpc_agent.register(
+        {"name": "slow", "arguments": {}, "implementation": slow, "permissions": None}
+    )
+    add_slow_query_responses(httpx_mock)
+    post_query_response_url = f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse"
+    httpx_mock.add_response(url=post_query_response_url, json={})
+
+    listening = asyncio.create_task(rpc_agent.listen())
+    await asyncio.wait_for(started.wait(), 5)
+    rpc_agent.stop()
+    await asyncio.wait_for(listening, 5)
+    assert cancelled.is_set()
+
+    # The cancelled query still gets a response.
+    body = json.loads(httpx_mock.get_requests(url=post_query_response_url)[0].content)
+    assert body["status"] == "error"
+    assert body["error"]["name"] == "AgentShuttingDownError"
+
+    # An idle agent stops right away.
     httpx_mock.add_response(
-        method="POST",
-        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
-        json=pop_query_response,
-        status_code=200,
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery", json={"query": None}
     )
+    listening = asyncio.create_task(rpc_agent.listen())
+    await asyncio.sleep(0.05)
+    rpc_agent.stop()
+    await asyncio.wait_for(listening, 1)
 
-    # Mock the postQueryResponse HTTP request
+
+@pytest.mark.asyncio
+async def test_stop_waits_for_short_poll(httpx_mock: HTTPXMock):
+    # Ctrl-C interrupts the agent unless SIGINT is added to the shutdown signals.
+    assert drain_agent()._shutdown_signals == (signal.SIGTERM,)
+
+    rpc_agent = drain_agent(shutdown_signals=None)
+    rpc_agent.register(
+        {
+            "name": "slow",
+            "arguments": {},
+            "implementation": lambda args, context: "done",
+            "permissions": None,
+        }
+    )
     httpx_mock.add_response(
-        method="POST",
-        url=f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse",
-        json=post_query_response,
-        status_code=200,
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
+        json={"versionHash": VERSION_HASH},
     )
+    polling, answer = asyncio.Event(), asyncio.Event()
+
+    async def pop_query(request: httpx.Request) -> httpx.Response:
+        polling.set()
+        await answer.wait()
+        return httpx.Response(
+            200,
+            json={
+                "query": {
+                    "queryUuid": QUERY_UUID,
+                    "queryInfo": {"method": "slow", "parameters": {}, "context": {}},
+                }
+            },
+        )
 
-    result = await rpc_agent.fetch_query_and_execute()
+    httpx_mock.add_callback(pop_query, url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery")
+    post_query_response_url = f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse"
+    httpx_mock.add_response(url=post_query_response_url, json={})
 
-    assert result == "continue"
+    listening = asyncio.create_task(rpc_agent.listen())
+    await asyncio.wait_for(polling.wait(), 5)
+    rpc_agent.stop()
+    await asyncio.sleep(0.05)
+    assert not listening.done()
+
+    # The query popped by the running poll is executed before the agent stops.
+    answer.set()
+    await asyncio.wait_for(listening, 5)
+    body = json.loads(httpx_mock.get_requests(url=post_query_response_url)[0].content)
+    assert body["data"] == "done"
 
 
 @pytest.mark.asyncio
-async def test_plus_two_numbers(rpc_agent: RetoolRPC):
-    response = await rpc_agent.execute_function(
-        "plusTwoNumbers",
+async def test_status_server(httpx_mock: HTTPXMock, tmp_path):
+    rpc_agent = drain_agent(
+        shutdown_signals=None,
+        polling_interval_ms=100,
+        status_server=StatusServerConfig(unix_socket_path=str(tmp_path / "status")),
+    )
+    rpc_agent.register(
         {
-            "number1": 2,
-            "number2": 3,
-        },
-        CONTEXT,
+            "name": "hello",
+            "arguments": {},
+            "implementation": lambda args, context: "hello",
+            "permissions": None,
+        }
     )
+    await rpc_agent.execute_function("hello", {}, CONTEXT)
 
-    assert response["result"] == 5
-
+    async def get(path: str) -> httpx.Response:
+        # Requests to the status server are not mocked by pytest_httpx.
+        reader, writer = await asyncio.open_unix_connection(str(tmp_path / "status"))
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: agent\r\n\r\n".encode())
+        head, _, body = (await reader.read()).partition(b"\r\n\r\n")
+        writer.close()
+        return httpx.Response(int(head.split(b" ")[1]), content=body)
 
-@pytest.mark.asyncio
-async def test_invalid_function_name(rpc_agent: RetoolRPC):
-    with pytest.raises(Exception) as excinfo:
-        await rpc_agent.execute_function(
-            "does not exist",
-            {
-                "number1": 2,
-                "number2": 3,
-            },
-            CONTEXT,
-        )
+    # Registration fails with a server error, the agent backs off.
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent", status_code=502
+    )
+    listening = asyncio.create_task(rpc_agent.listen())
+    await asyncio.sleep(0.02)
+    assert (await get("/healthz")).status_code == 200
+    response = await get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["state"] == "registering"
+    assert response.json()["consecutiveErrors"] == 1
+    assert response.json()["backoffDelayMs"] == 50
 
-    assert (
-        str(excinfo.value)
-        == 'Function "does not exist" not found on remote agent server.'
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/registerAgent",
+        json={"versionHash": VERSION_HASH},
+    )
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery", json={"query": None}
     )
+    await asyncio.sleep(0.1)
+    response = await get("/readyz")
+    assert response.status_code == 200
+    status = response.json()
+    assert status["state"] == "registered"
+    assert status["versionHash"] == VERSION_HASH
+    assert status["lastPollAt"] is not None
+    assert status["backoffDelayMs"] == 0
+    assert status["inFlightQueries"] == 0
+    assert status["functions"] == {"hello": {"calls": 1}}
+    assert (await get("/status")).json()["state"] == "registered"
+    assert (await get("/metrics")).status_code == 404
+
+    rpc_agent.stop()
+    await asyncio.wait_for(listening, 1)
+    assert not (tmp_path / "status").exists()
 
 
 @pytest.mark.asyncio
-async def test_get_current_date(rpc_agent: RetoolRPC):
-    response = await rpc_agent.execute_function(
-        "asyncGetCurrentDate",
-        {},
-        CONTEXT,
-    )
-
-    assert response["result"] == CURRENT_DATE
+async def test_capture_and_replay_queries(httpx_mock: HTTPXMock, tmp_path):
+    capture_file = tmp_path / "capture.jsonl"
+    rpc_agent = drain_agent(capture_file=str(capture_file))
 
+    async def greet(args, context):
+        return f"Hello {args['name']}"
 
-@pytest.mark.asyncio
-async def test_throws_error(rpc_agent: RetoolRPC):
-    with pytest.raises(Exception) as excinfo:
-        await rpc_agent.execute_function(
-            "throwsError",
-            {},
-            {
-                "user_name": "Steph Curry",
-                "user_email": "steph@warriors.com",
-                "user_groups": ["Warriors", "USA"],
-                "organization_name": "Golden State Warriors",
+    rpc_agent.register(
+        {
+            "name": "greet",
+            "arguments": {
+                "name": {
+                    "type": "string",
+                    "description": "",
+                    "array": False,
+                    "required": True,
+                }
+            },
+            "implementation": greet,
+            "permissions": None,
+        }
+    )
+    for name in ["Steph", "Klay", None]:
+        httpx_mock.add_response(
+            url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+            json={
+                "query": {
+                    "queryUuid": QUERY_UUID,
+                    "queryInfo": {
+                        "method": "greet",
+                        "parameters": {"name": name},
+                        "context": CONTEXT,
+                    },
+                }
             },
         )
+        httpx_mock.add_response(
+            url=f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse", json={}
+        )
+        assert await rpc_agent.fetch_query_and_execute() == "continue"
+
+    captured = list(read_capture(str(capture_file)))
+    assert [query["parameters"] for query in captured] == [
+        {"name": "Steph"},
+        {"name": "Klay"},
+        {"name": None},
+    ]
+    assert [query["status"] for query in captured] == ["success", "success", "error"]
+    context = captured[0]["context"]
+    assert context["user_email"].startswith("redacted:")
+    assert len(context["user_groups"]) == 2
+    assert "warriors" not in capture_file.read_text().lower()
+    # The same user is redacted the same way within a capture.
+    assert captured[1]["context"] == context
+
+    # A query is captured before it runs, and its outcome once it finishes.
+    async def hang(args, context):
+        await asyncio.sleep(60)
 
-    assert str(excinfo.value) == "This is the error message."
+    rpc_agent.register(
+        {"name": "hang", "arguments": {}, "implementation": hang, "permissions": None}
+    )
+    httpx_mock.add_response(
+        url=f"{SERVER_HOST}/api/v1/retoolrpc/popQuery",
+        json={
+            "query": {
+                "queryUuid": QUERY_UUID,
+                "queryInfo": {"method": "hang", "parameters": {}, "context": CONTEXT},
+            }
+        },
+    )
+    hanging = asyncio.create_task(rpc_agent.fetch_query_and_execute())
+    await asyncio.sleep(0.05)
+    hanging.cancel()
+    *_, unfinished = read_capture(str(capture_file))
+    assert unfinished["method"] == "hang"
+    assert unfinished["status"] == "unfinished"
+    assert unfinished["durationMs"] is None
+    with pytest.raises(asyncio.CancelledError):
+        await hanging
+    rpc_agent.unregister("hang")
+
+    # A partly written line is skipped.
+    with open(capture_file, "ab") as file:
+        file.write(b'{"receivedAt": 1')
+    report = await replay(rpc_agent, read_capture(str(capture_file)), speed=None)
+    assert report.functions["greet"].calls == 3
+    assert report.functions["greet"].errors == 1
+    assert "greet" in report.format()
+
+    # Queries keep their captured pace, divided by the speed.
+    queries = [
+        {**captured[0], "receivedAt": 1000.0},
+        {**captured[1], "receivedAt": 1000.2},
+    ]
+    report = await replay(rpc_agent, queries, speed=2)  # type: ignore[arg-type]
+    assert report.elapsed_s >= 0.1
+
+
+def test_run_on_uvloop():
+    uvloop = pytest.importorskip("uvloop")
+
+    async def done():
+        return "done"
+
+    async def main():
+        # Tasks that complete without suspending are done once created.
+        task = asyncio.create_task(done())
+        return type(asyncio.get_running_loop()), task.done()
+
+    loop_type, eager = retoolrpc.run(main())
+    assert loop_type is uvloop.Loop
+    assert eager is (sys.version_info >= (3, 12))
+    loop_type, _ = retoolrpc.run(main(), use_uvloop=False, eager_tasks=False)
+    assert loop_type is not uvloop.Loop
+
+    # Without asyncio.Runner, the uvloop loop is not installed for the process.
+    policy = asyncio.get_event_loop_policy()
+    loop_type, _ = runtime._run_in_loop(uvloop.new_event_loop(), main())
+    assert loop_type is uvloop.Loop
+    assert asyncio.get_event_loop_policy() is policy
 
 
 def test_empty_function_arguments():
@@ -827,6 +2648,125 @@ def test_throw_number_is_string_values_for_numbers_and_booleans_are_invalid():
     assert str(excinfo.value) == error_message
 
 
+@pytest.mark.asyncio
+async def test_resources(httpx_mock: HTTPXMock):
+    rpc_agent = drain_agent(shutdown_signals=None)
+    events = []
+
+    class Pool:
+        async def aclose(self):
+            events.append("pool closed")
+
+    async def create_pool():
+        events.append("pool created")
+        await asyncio.sleep(0.01)
+        return Pool()
+
+    rpc_agent.add_resource("db", create_pool)
+    rpc_agent.add_resource(
+        "client", lambda: "client", close=lambda client: events.append("closed")
+    )
+    called = asyncio.Event()
+
+    async def slow(args, context, db, client):
+        called.set()
+        return [type(db).__name__, client]
+
+    rpc_agent.register(
+        {
+            "name": "slow",
+            "arguments": {},
+            "implementation": slow,
+            "permissions": None,
+            "resources": ["db", "client"],
+            "middlewares": [lambda call, call_next: call_next(call)],
+        }
+    )
+    add_slow_query_responses(httpx_mock)
+    post_query_response_url = f"{SERVER_HOST}/api/v1/retoolrpc/postQueryResponse"
+    httpx_mock.add_response(url=post_query_response_url, json={})
+
+    # Created when the agent starts, closed in reverse order when it stops.
+    listening = asyncio.create_task(rpc_agent.listen())
+    await asyncio.wait_for(called.wait(), 5)
+    assert events == ["pool created"]
+    with pytest.raises(ValueError, match='"other" uses resources .*: cache'):
+        rpc_agent.register(
+            {
+                "name": "other",
+                "arguments": {},
+                "implementation": lambda args, context, cache: cache,
+                "permissions": None,
+                "resources": ["cache"],
+            }
+        )
+    rpc_agent.stop()
+    await listening
+    request = httpx_mock.get_requests(url=post_query_response_url)[0]
+    assert json.loads(request.content)["data"] == ["Pool", "client"]
+    assert events == ["pool created", "closed", "pool closed"]
+
+    # Created on first use without a listening agent, once for concurrent calls.
+    events.clear()
+    results = await asyncio.gather(
+        *(rpc_agent.execute_function("slow", {}, CONTEXT) for _ in range(3))
+    )
+    assert [result["result"] for result in results] == [["Pool", "client"]] * 3
+    assert events == ["pool created"]
+
+    # A pool created by another process, e.g. before a fork, is neither used nor
+    # closed.
+    inherited_pool = await rpc_agent.resources.get("db")
+    rpc_agent.resources._resources["db"].pid = -1
+    assert await rpc_agent.resources.get("db") is not inherited_pool
+    await rpc_agent.resources.close()
+    assert events == ["pool created", "pool created", "pool closed", "closed"]
+
+    # Functions cannot use resources that were not added.
+    rpc_agent.register(
+        {
+            "name": "cached",
+            "arguments": {},
+            "implementation": lambda args, context, cache: cache,
+            "permissions": None,
+            "resources": ["db", "cache"],
+        }
+    )
+    with pytest.raises(ValueError, match='"cached" uses resources .*: cache'):
+        await rpc_agent.listen()
+    assert events == ["pool created", "pool created", "pool closed", "closed"]
+
+
+def test_dumps_does_not_depend_on_orjson(monkeypatch):
+    @dataclasses.dataclass
+    class Player:
+        name: str
+        born: date
+        teams: frozenset
+
+    value = {
+        "player": Player("Stéph", date(1988, 3, 14), frozenset(["Warriors"])),
+        "at": datetime(2012, 12, 21, 1, 2, 3, 45, tzinfo=timezone.utc),
+        "time": time(1, 2),
+        "id": uuid.UUID(int=1),
+        "amount": decimal.Decimal("1.5"),
+        "state": signal.Signals.SIGTERM,
+        30: "number",
+    }
+    encoded = serialization.dumps(value)
+    monkeypatch.setattr(serialization, "orjson", None)
+    assert serialization.dumps(value) == encoded
+    assert json.loads(encoded) == {
+        "player": {"name": "Stéph", "born": "1988-03-14", "teams": ["Warriors"]},
+        "at": "2012-12-21T01:02:03.000045+00:00",
+        "time": "01:02:00",
+        "id": "00000000-0000-0000-0000-000000000001",
+        "amount": "1.5",
+        "state": signal.SIGTERM.value,
+        "30": "number",
+    }
+
+
 def test_retool_rpc_version():
     with open("pyproject.toml", "r") as tomlFile:
         pyprojectToml = toml.load(tomlFile)
@@ -0,0 +1,204 @@
+from typing import Optional
+
+import pytest
+import pytest_asyncio
+
+pytest.importorskip("aiosqlite")
+pytest.importorskip("sqlalchemy.ext.asyncio")
+
+from retoolrpc import RetoolRPC  # noqa: E402
+from retoolrpc.addons.sqlalchemy import SQLAlchemyMixin  # noqa: E402
+from retoolrpc.utils.types import RetoolContext, RetoolRPCConfig  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine  # noqa: E402
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column  # noqa: E402
+
+CONTEXT: RetoolContext = {
+    "user_name": "Steph Curry",
+    "user_email": "steph@warriors.com",
+    "user_groups": ["Warriors", "Dub Nation"],
+    "organization_name": "Golden State Warriors",
+}
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Player(Base):
+    __tablename__ = "players"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str]
+    team: Mapped[str]
+    number: Mapped[Optional[int]]
+
+
+class RetoolRPCSQLAlchemy(SQLAlchemyMixin, RetoolRPC):
+    pass
+
+
+@pytest_asyncio.fixture
+async def rpc_agent():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+    statements = []
+    event.listen(
+        engine.sync_engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    rpc_agent = RetoolRPCSQLAlchemy(
+        RetoolRPCConfig(
+            api_token="secret-api-token",
+            host="http://localhost:3001",
+            resource_id="resource-id",
+        )
+    )
+    rpc_agent.register_model(
+        Player,
+        async_sessionmaker(engine, expire_on_commit=False),
+        write_attributes=["name", "team", "number"],
+    )
+    rpc_agent.statements = statements  # type: ignore[attr-defined]
+
+    yield rpc_agent
+    await engine.dispose()
+
+
+async def call(rpc_agent: RetoolRPC, function_name: str, args: dict):
+    response = await rpc_agent.execute_function(function_name, args, CONTEXT)
+    return response["result"]
+
+
+@pytest.mark.asyncio
+async def test_registers_model_functions(rpc_agent: RetoolRPC):
+    assert sorted(rpc_agent._functions) == [
+        "Player > create",
+        "Player > createOrUpdate",
+        "Player > delete",
+        "Player > findAll",
+        "Player > findBy",
+        "Player > findByPk",
+        "Player > findByPks",
+        "Player > update",
+    ]
+    assert rpc_agent._functions["Player > create"]["arguments"]["number"]["type"] == (
+        "number"
+    )
+
+
+@pytest.mark.asyncio
+async def test_crud_functions(rpc_agent: RetoolRPC):
+    created = await call(
+        rpc_agent,
+        "Player > create",
+        {"name": "Steph Curry", "team": "Warriors", "number": 30},
+    )
+    assert created == {
+        "id": 1,
+        "name": "Steph Curry",
+        "team": "Warriors",
+        "number": 30,
+    }
+
+    assert await call(
+        rpc_agent, "Player > update", {"primaryKey": 1, "number": 31}
+    ) == {"updated": 1}
+    assert (await call(rpc_agent, "Player > findByPk", {"primaryKey": 1}))[
+        "number"
+    ] == 31
+
+    upserted = await call(
+        rpc_agent,
+        "Player > createOrUpdate",
+        {"findAttributes": {"name": "Klay Thompson"}, "team": "Warriors"},
+    )
+    assert upserted["id"] == 2
+
+    assert await call(rpc_agent, "Player > findBy", {"team": "Warriors"}) == {
+        "records": [
+            {"id": 1, "name": "Steph Curry", "team": "Warriors", "number": 31},
+            {"id": 2, "name": "Klay Thompson", "team": "Warriors", "number": None},
+        ],
+        "nextCursor": None,
+    }
+
+    assert await call(rpc_agent, "Player > delete", {"primaryKey": 2}) == {"deleted": 1}
+    assert await call(rpc_agent, "Player > findByPk", {"primaryKey": 2}) is None
+
+
+@pytest.mark.asyncio
+async def test_find_all_uses_keyset_pagination(rpc_agent: RetoolRPC):
+    for number in range(5):
+        await call(
+            rpc_agent,
+            "Player > create",
+            {"name": f"Player {number}", "team": "Warriors", "number": number},
+        )
+
+    pages = []
+    cursor = None
+    while True:
+        page = await call(rpc_agent, "Player > findAll", {"limit": 2, "cursor": cursor})
+        pages.append([record["number"] for record in page["records"]])
+        cursor = page["nextCursor"]
+        if cursor is None:
+            break
+
+    assert pages == [[0, 1], [2, 3], [4]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "function_name, args",
+    [
+        ("Player > findBy", {"team": "Warriors"}),
+        ("Player > findByPks", {"primaryKeys": [1, 2, 4, 5, 6]}),
+    ],
+)
+async def test_find_by_uses_keyset_pagination(
+    rpc_agent: RetoolRPC, function_name, args
+):
+    for number in range(6):
+        await call(
+            rpc_agent,
+            "Player > create",
+            {
+                "name": f"Player {number}",
+                "team": "Warriors" if number != 2 else "Lakers",
+                "number": number,
+            },
+        )
+
+    pages = []
+    cursor = None
+    while True:
+        page = await call(
+            rpc_agent, function_name, {**args, "limit": 2, "cursor": cursor}
+        )
+        pages.append([record["number"] for record in page["records"]])
+        cursor = page["nextCursor"]
+        if cursor is None:
+            break
+
+    assert pages == [[0, 1], [3, 4], [5]]
+
+
+@pytest.mark.asyncio
+async def test_find_by_pks_runs_a_single_statement(rpc_agent: RetoolRPC):
+    for number in range(3):
+        await call(
+            rpc_agent,
+            "Player > create",
+            {"name": f"Player {number}", "team": "Warriors", "number": number},
+        )
+
+    rpc_agent.statements.clear()  # type: ignore[attr-defined]
+    page = await call(rpc_agent, "Player > findByPks", {"primaryKeys": [1, 3]})
+
+    assert [record["number"] for record in page["records"]] == [0, 2]
+    assert len(rpc_agent.statements) == 1  # type: ignore[attr-defined]